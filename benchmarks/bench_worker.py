@@ -0,0 +1,416 @@
+#!/usr/bin/env python
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Throughput and latency benchmarks for the SQL worker.
+
+Drives SQLWorker.process with a stub channel against SQLite, both in
+memory and on disk, for every subcommand at several payload sizes and
+writes messages/sec, p50/p99 latency and peak RSS as JSON:
+
+    python benchmarks/bench_worker.py --output results.json
+    python benchmarks/bench_worker.py --compare results.json
+
+Peak RSS is the high water mark of the whole run at the end of each
+scenario, so it only ever grows from one scenario to the next.
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import mock
+import sqlalchemy
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from replugin import sqlworker
+
+
+#: Rows per message
+SIZES = (1, 1000, 100000)
+QUICK_SIZES = (1, 100, 1000)
+
+#: Tables to reflect
+TABLE_COUNTS = (10, 1000)
+QUICK_TABLE_COUNTS = (10, 100)
+
+#: Most messages sent per scenario
+MAX_MESSAGES = 200
+
+
+class StubChannel(object):
+    """
+    Channel which counts what the worker publishes.
+    """
+
+    consumer_tags = []
+
+    def __init__(self):
+        self.published = 0
+        self.failed = 0
+
+    def basic_publish(self, exchange='', routing_key='', body='', *args,
+                      **kwargs):
+        self.published += 1
+        if '"status": "failed"' in body:
+            self.failed += 1
+
+    def basic_ack(self, *args, **kwargs):
+        pass
+
+    def basic_consume(self, *args, **kwargs):
+        return 'bench'
+
+    def basic_qos(self, *args, **kwargs):
+        pass
+
+    def basic_cancel(self, *args, **kwargs):
+        pass
+
+
+class StubProperties(object):
+    """
+    Message properties the worker reads.
+    """
+
+    correlation_id = 'bench'
+    reply_to = 'bench'
+
+
+class NullOutput(object):
+    """
+    Output object which drops everything.
+    """
+
+    def info(self, *args, **kwargs):
+        pass
+
+    error = warn = debug = info
+
+
+def _percentile(values, percent):
+    """
+    Returns the given percentile of a sorted list.
+    """
+    index = int(round(percent / 100.0 * (len(values) - 1)))
+    return values[min(index, len(values) - 1)]
+
+
+def _messages(size):
+    """
+    Returns how many messages to send for a payload of size rows.
+    """
+    return max(3, min(MAX_MESSAGES, 100000 // max(size, 1)))
+
+
+def _rows(size, offset=0):
+    """
+    Returns size row dicts for the bench tables.
+    """
+    return [{'id': offset + i, 'a': i, 'b': 'x' * 16} for i in range(size)]
+
+
+class Bench(object):
+    """
+    Runs the scenarios against one configured database.
+    """
+
+    def __init__(self, workdir, db_name, uri, only=None):
+        self.db_name = db_name
+        self.only = only
+        self.bulk_dir = os.path.join(workdir, 'bulk')
+        if not os.path.isdir(self.bulk_dir):
+            os.mkdir(self.bulk_dir)
+        config = {
+            'queue': 'bench',
+            'databases': {db_name: {'uri': uri, 'kwargs': {}}},
+            'bulk_load': {'directory': self.bulk_dir},
+        }
+        config_file = os.path.join(workdir, 'config-%s.json' % db_name)
+        with open(config_file, 'w') as config_fp:
+            json.dump(config, config_fp)
+        logger = logging.getLogger('bench')
+        logger.addHandler(logging.NullHandler())
+        logger.propagate = False
+        with mock.patch('pika.SelectConnection'):
+            self.worker = sqlworker.SQLWorker(
+                {}, config_file=config_file, logger=logger)
+        self.channel = StubChannel()
+        self.worker._on_channel_open(self.channel)
+        self.engine = self.worker._engines.get(db_name)
+        self.deliver = mock.Mock(delivery_tag=1)
+        self.properties = StubProperties()
+        self.output = NullOutput()
+
+    def table(self, name, rows=0):
+        """
+        (Re)creates a bench table holding rows rows.
+        """
+        self.engine.execute('DROP TABLE IF EXISTS %s' % name)
+        self.engine.execute(
+            'CREATE TABLE %s (id INTEGER PRIMARY KEY, a INTEGER, '
+            'b VARCHAR(32))' % name)
+        self.fill(name, rows)
+        self.worker._schema.invalidate(self.db_name, name)
+
+    def fill(self, name, rows, offset=0):
+        """
+        Inserts rows rows into a bench table without the worker.
+        """
+        if rows:
+            table = sqlalchemy.Table(
+                name, sqlalchemy.MetaData(),
+                autoload=True, autoload_with=self.engine)
+            self.engine.execute(table.insert(), _rows(rows, offset))
+
+    def run(self, subcommand, size, body, count, setup=None):
+        """
+        Sends count messages and returns their statistics.
+
+        Parameters:
+            * subcommand: The name to report
+            * size: The payload size to report
+            * body: Callable taking the message number returning its body
+            * count: The number of messages to send
+            * setup: Optional untimed callable run before each message
+        """
+        if self.only and self.only not in subcommand:
+            return None
+        failed = self.channel.failed
+        latencies = []
+        for number in range(count):
+            if setup is not None:
+                setup(number)
+            message = body(number)
+            message['parameters'].setdefault('database', self.db_name)
+            start = time.time()
+            self.worker.process(
+                self.channel, self.deliver, self.properties, message,
+                self.output)
+            latencies.append(time.time() - start)
+        latencies.sort()
+        total = sum(latencies)
+        return {
+            'subcommand': subcommand,
+            'database': self.db_name,
+            'size': size,
+            'messages': count,
+            'failed': self.channel.failed - failed,
+            'seconds': total,
+            'msgs_per_sec': count / total if total else None,
+            'p50_ms': _percentile(latencies, 50) * 1000,
+            'p99_ms': _percentile(latencies, 99) * 1000,
+            'peak_rss_kb': resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss,
+        }
+
+    def scenarios(self, sizes, table_counts):
+        """
+        Yields the result of every scenario.
+        """
+        for size in sizes:
+            count = _messages(size)
+
+            self.table('bench_insert')
+            yield self.run(
+                'Insert', size,
+                lambda n: {'parameters': {
+                    'subcommand': 'Insert', 'name': 'bench_insert',
+                    'rows': _rows(size, n * size)}},
+                count)
+
+            self.table('bench_upsert')
+            yield self.run(
+                'Upsert', size,
+                lambda n: {'parameters': {
+                    'subcommand': 'Upsert', 'name': 'bench_upsert',
+                    'keys': ['id'], 'rows': _rows(size)}},
+                count)
+
+            self.table('bench_update', size)
+            yield self.run(
+                'Update', size,
+                lambda n: {'parameters': {
+                    'subcommand': 'Update', 'name': 'bench_update',
+                    'updates': [
+                        {'values': {'a': n}, 'where': {'id': i}}
+                        for i in range(size)]}},
+                count)
+
+            self.table('bench_delete')
+            yield self.run(
+                'Delete', size,
+                lambda n: {'parameters': {
+                    'subcommand': 'Delete', 'name': 'bench_delete',
+                    'where': {'id': {'lt': size}}}},
+                count, setup=lambda n: self.fill('bench_delete', size))
+
+            self.table('bench_select', size)
+            yield self.run(
+                'ExecuteSQL', size,
+                lambda n: {'parameters': {
+                    'subcommand': 'ExecuteSQL', 'stream': True,
+                    'sql': 'SELECT id, a, b FROM bench_select'}},
+                count)
+
+            with open(os.path.join(self.bulk_dir, 'rows.csv'), 'w') as csv:
+                csv.write('id,a,b\n')
+                for row in _rows(size):
+                    csv.write('%(id)s,%(a)s,%(b)s\n' % row)
+            self.table('bench_load')
+            yield self.run(
+                'BulkLoad', size,
+                lambda n: {'parameters': {
+                    'subcommand': 'BulkLoad', 'name': 'bench_load',
+                    'path': 'rows.csv'}},
+                count,
+                setup=lambda n: self.engine.execute('DELETE FROM bench_load'))
+
+            self.table('bench_batch')
+            yield self.run(
+                'Batch', size,
+                lambda n: {'parameters': {
+                    'subcommand': 'Batch', 'steps': [
+                        {'subcommand': 'Insert', 'name': 'bench_batch',
+                         'rows': _rows(size)},
+                        {'subcommand': 'Delete', 'name': 'bench_batch',
+                         'where': {}}]}},
+                count)
+
+            # Column changes rewrite the table on SQLite so size matters
+            self.table('bench_columns', size)
+            ddl_count = min(count, 20)
+            yield self.run(
+                'AddTableColumns+DropTableColumns', size,
+                lambda n: {'parameters': {
+                    'subcommand': 'AddTableColumns', 'name': 'bench_columns',
+                    'columns': {'c': {'type': 'Integer'}}}}
+                if n % 2 == 0 else {'parameters': {
+                    'subcommand': 'DropTableColumns', 'name': 'bench_columns',
+                    'columns': ['c']}},
+                ddl_count * 2)
+            yield self.run(
+                'AlterTableColumns', size,
+                lambda n: {'parameters': {
+                    'subcommand': 'AlterTableColumns',
+                    'name': 'bench_columns',
+                    'columns': {'b': {
+                        'type': 'String', 'length': 32 + n % 2}}}},
+                ddl_count)
+
+        yield self.run(
+            'CreateTable+DropTable', 1,
+            lambda n: {'parameters': {
+                'subcommand': 'CreateTable', 'name': 'bench_ddl',
+                'columns': {'id': {'type': 'Integer', 'primary_key': True}}}}
+            if n % 2 == 0 else {'parameters': {
+                'subcommand': 'DropTable', 'name': 'bench_ddl'}},
+            MAX_MESSAGES // 2)
+
+        for tables in table_counts:
+            for i in range(tables):
+                self.table('bench_reflect_%s' % i)
+            yield self.run(
+                'Insert (cold reflection)', tables,
+                lambda n: {'parameters': {
+                    'subcommand': 'Insert', 'name': 'bench_reflect_%s' % n,
+                    'rows': [{'a': 1}]}},
+                tables,
+                setup=lambda n: self.worker._schema.invalidate(
+                    self.db_name, 'bench_reflect_%s' % n))
+            for i in range(tables):
+                self.engine.execute('DROP TABLE bench_reflect_%s' % i)
+
+
+def _compare(results, baseline):
+    """
+    Prints the change in throughput against a previous run.
+    """
+    previous = dict(
+        ((r['subcommand'], r['database'], r['size']), r)
+        for r in baseline['results'])
+    for result in results:
+        old = previous.get(
+            (result['subcommand'], result['database'], result['size']))
+        if not old or not old['msgs_per_sec'] or not result['msgs_per_sec']:
+            continue
+        print '%-36s %-6s %7s  %+7.1f%% msgs/sec  p99 %.2fms -> %.2fms' % (
+            result['subcommand'], result['database'], result['size'],
+            (result['msgs_per_sec'] / old['msgs_per_sec'] - 1) * 100,
+            old['p99_ms'], result['p99_ms'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument(
+        '--output', default='benchmark-results.json',
+        help='file to write the results to')
+    parser.add_argument(
+        '--compare', help='results of an earlier run to compare with')
+    parser.add_argument(
+        '--quick', action='store_true', help='use smaller payloads')
+    parser.add_argument(
+        '--only', help='only run subcommands whose name contains this')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='sqlworker-bench-')
+    results = []
+    try:
+        for db_name, uri in (
+                ('memory', 'sqlite://'),
+                ('file', 'sqlite:///%s' % os.path.join(workdir, 'bench.db'))):
+            bench = Bench(workdir, db_name, uri, args.only)
+            for result in bench.scenarios(
+                    QUICK_SIZES if args.quick else SIZES,
+                    QUICK_TABLE_COUNTS if args.quick else TABLE_COUNTS):
+                if result is None:
+                    continue
+                results.append(result)
+                print '%-36s %-6s %7s  %9.1f msgs/sec  p50 %8.2fms  ' \
+                    'p99 %8.2fms  rss %sKB%s' % (
+                        result['subcommand'], result['database'],
+                        result['size'], result['msgs_per_sec'] or 0,
+                        result['p50_ms'], result['p99_ms'],
+                        result['peak_rss_kb'],
+                        '  %s FAILED' % result['failed']
+                        if result['failed'] else '')
+            bench.worker._engines.dispose()
+    finally:
+        shutil.rmtree(workdir)
+
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'sqlalchemy': sqlalchemy.__version__,
+        'quick': args.quick,
+        'results': results,
+    }
+    with open(args.output, 'w') as output:
+        json.dump(report, output, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as baseline:
+            _compare(results, json.load(baseline))
+
+
+if __name__ == '__main__':
+    main()
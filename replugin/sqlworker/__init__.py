@@ -17,11 +17,19 @@
 SQL worker.
 """
 
-import sqlalchemy.types
-
-from sqlalchemy import Table, Column, MetaData, create_engine
+import itertools
+import json
+import os
+import Queue
+import tempfile
+import threading
+import time
+
+from sqlalchemy import (
+    Table, MetaData, and_, bindparam, or_, select, text)
 from sqlalchemy.exc import (
-    OperationalError, ProgrammingError, NoSuchTableError)
+    OperationalError, ProgrammingError, IntegrityError, NoSuchTableError,
+    StatementError)
 from sqlalchemy.orm import sessionmaker
 
 from alembic.migration import MigrationContext
@@ -29,6 +37,115 @@ from alembic.op import Operations
 
 from reworker.worker import Worker
 
+from replugin.sqlworker import bulkload
+from replugin.sqlworker.coalesce import Coalescer
+from replugin.sqlworker.columns import build_column, compile_columns
+from replugin.sqlworker.ddl import apply_changes
+from replugin.sqlworker.engines import EngineRegistry
+from replugin.sqlworker.idempotency import (
+    TABLE_NAME, ResultStore, message_key)
+from replugin.sqlworker.metrics import Metrics
+from replugin.sqlworker.online import ONLINE_DIALECTS, OnlineChange, Throttle
+from replugin.sqlworker.pool import WorkerPool
+from replugin.sqlworker.predicates import build_where, where_columns
+from replugin.sqlworker.profiling import Profiler
+from replugin.sqlworker.registry import SubcommandRegistry, subcommand
+from replugin.sqlworker.results import ResultPager
+from replugin.sqlworker.schema import SchemaCache
+from replugin.sqlworker.statements import StatementCache
+from replugin.sqlworker.upsert import UPSERT_DIALECTS, Upsert
+
+
+#: Default number of rows sent to the database in one executemany
+DEFAULT_CHUNK_SIZE = 1000
+
+#: Default cap on the encoded bytes of one streamed result
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+#: Default number of channel calls pool threads may queue for relaying
+DEFAULT_RELAY_QUEUE_SIZE = 256
+
+#: First words of raw SQL which change rows
+DML_VERBS = ('INSERT', 'UPDATE', 'DELETE', 'REPLACE', 'MERGE')
+
+#: First words of raw SQL which change the schema
+DDL_VERBS = ('CREATE', 'ALTER', 'DROP', 'TRUNCATE', 'RENAME')
+
+#: First words of raw SQL which only read
+READ_VERBS = ('SELECT', 'SHOW', 'EXPLAIN', 'DESCRIBE')
+
+
+def _is_read_only_sql(params):
+    """
+    Returns whether every statement of an ExecuteSQL call starts with
+    one of READ_VERBS.
+
+    Parameters:
+        * params: The message parameters
+    """
+    statements = params.get('sql', '')
+    if not isinstance(statements, list):
+        statements = [statements]
+    for statement in statements:
+        if isinstance(statement, dict):
+            statement = statement.get('sql', '')
+        words = unicode(statement).split(None, 1)
+        if not words or words[0].upper() not in READ_VERBS:
+            return False
+    return True
+
+
+def _compile_columns(columns, **kwargs):
+    """
+    Returns the Columns of a dict of column specs, raising
+    SQLWorkerError before any DDL is sent if a spec is not valid. See
+    replugin.sqlworker.columns.
+
+    Parameters:
+        * columns: Dict of column name to column spec
+        * kwargs: Extra keyword arguments for every Column
+    """
+    try:
+        return compile_columns(columns, **kwargs)
+    except ValueError, ve:
+        raise SQLWorkerError(str(ve))
+
+
+def _chunk_rows(rows, chunk_size):
+    """
+    Groups rows into lists of at most chunk_size rows which all use the
+    same columns so each list can be sent as one executemany.
+
+    Parameters:
+        * rows: An iterable of dictionaries mapping column names to values
+        * chunk_size: The largest number of rows to put in one list
+    """
+    chunk = []
+    keys = None
+    for row in rows:
+        row_keys = sorted(row.keys())
+        if chunk and (row_keys != keys or len(chunk) >= chunk_size):
+            yield chunk
+            chunk = []
+        keys = row_keys
+        chunk.append(row)
+    if chunk:
+        yield chunk
+
+
+def _row_keys(rows):
+    """
+    Returns the set of keys used by any of the row dictionaries.
+
+    Parameters:
+        * rows: A list of dictionaries mapping column names to values
+    """
+    keys = set()
+    for row in rows:
+        if isinstance(row, dict):
+            keys.update(row)
+    return keys
+
 
 class SQLWorkerError(Exception):
     """
@@ -42,14 +159,216 @@ class SQLWorker(Worker):
     Worker which provides basic functionality for SQL databases.
     """
 
-    #: allowed subcommands
-    subcommands = (
-        'CreateTable', 'ExecuteSQL', 'AlterTableColumns',
-        'AddTableColumns', 'DropTableColumns', 'DropTable',
-        'Insert', 'Delete')
+    #: allowed subcommands, filled from the registry when created
+    subcommands = ()
     dynamic = []
 
+    def __init__(self, *args, **kwargs):
+        """
+        Creates the worker and its database engine registry.
+        """
+        super(SQLWorker, self).__init__(*args, **kwargs)
+        self._registry = SubcommandRegistry()
+        self._registry.add_methods(self)
+        self._registry.load_entry_points(self, logger=self.app_logger)
+        self.subcommands = self._registry.names()
+        self._metrics = Metrics()
+        profiling = self._config.get('profiling', {})
+        self._profiler = Profiler(
+            profiling.get('directory', None),
+            profiling.get('sample_every', 0),
+            profiling.get('tracemalloc', False),
+            profiling.get('top', 25),
+            self.app_logger)
+        self._engines = EngineRegistry(
+            self._config.get('databases', {}), self._metrics,
+            self.app_logger, self._profiler)
+        self._schema = SchemaCache(
+            self._config.get('schema_cache_ttl', None), self._metrics,
+            self._replica_connection)
+        self._statements = StatementCache(
+            self._config.get('statement_cache_size', 500))
+        self._schema.add_listener(self._statements.invalidate)
+        # Connections checked out while processing a message
+        self._local = threading.local()
+        # Optional pool for processing messages concurrently
+        self._pool = None
+        concurrency = self._config.get('concurrency', {})
+        # Bounded so pool threads sending pages wait for the relay
+        self._channel_calls = Queue.Queue(concurrency.get(
+            'relay_queue_size', DEFAULT_RELAY_QUEUE_SIZE))
+        self._channel_thread = None
+        self._paused = False
+        self._max_in_flight = concurrency.get('max_in_flight', None)
+        if concurrency.get('workers', 0) > 0:
+            self._pool = WorkerPool(
+                concurrency['workers'],
+                concurrency.get('per_database', {}),
+                concurrency.get('default_per_database', None),
+                self.app_logger,
+                concurrency.get('weights', {}),
+                concurrency.get('default_weight', 1),
+                concurrency.get('fast_lane_burst', 8))
+            self._pool.start()
+        # Optional coalescing of small Insert messages
+        self._coalescer = None
+        coalesce = self._config.get('coalesce', None)
+        if coalesce:
+            self._coalescer = Coalescer(
+                coalesce.get('max_rows', 500),
+                coalesce.get('max_ms', 50),
+                coalesce.get('max_messages', 100))
+        # Ack messages once processed rather than on arrival
+        self._late_ack = self._config.get('late_ack', False)
+        # Optional store of results to replay for redelivered messages
+        self._results = None
+        idempotency = self._config.get('idempotency', None)
+        if idempotency:
+            if 'database' in idempotency:
+                store = self._engines.get(idempotency['database'])
+            else:
+                store = idempotency.get('path', os.path.join(
+                    tempfile.gettempdir(), 'sqlworker-results.db'))
+            self._results = ResultStore(
+                store, idempotency.get('ttl', None),
+                idempotency.get('table', TABLE_NAME))
+        metrics_config = self._config.get('metrics', {})
+        if metrics_config.get('http_port', None):
+            self._metrics.serve(
+                metrics_config.get('http_host', '127.0.0.1'),
+                metrics_config['http_port'])
+
+    def _on_channel_open(self, channel):
+        """
+        Called when the channel is opened. Sizes the prefetch window to
+        the worker pool and starts relaying channel calls made by the
+        pool threads.
+
+        Parameters:
+            * channel: The channel that was opened
+        """
+        super(SQLWorker, self)._on_channel_open(channel)
+        self._channel_thread = threading.current_thread()
+        if self._pool is not None:
+            prefetch = self._max_in_flight or self._pool.size
+            if self._coalescer is not None:
+                # Held messages stay unacked so need room of their own
+                prefetch += self._coalescer.max_messages
+            channel.basic_qos(prefetch_count=prefetch)
+            self._relay_channel_calls()
+        elif self._late_ack:
+            # Unacked messages are held by the broker for us, keep it few
+            channel.basic_qos(prefetch_count=self._max_in_flight or 1)
+        if self._config.get('metrics', {}).get('interval', None):
+            self._publish_metrics()
+
+    def _publish_metrics(self):
+        """
+        Sends a snapshot of the metrics to the configured topic and
+        schedules itself to run again.
+        """
+        metrics_config = self._config['metrics']
+        try:
+            self.send(
+                metrics_config.get('topic', 'sqlworker.stats'),
+                'stats',
+                self._metrics.snapshot(),
+                exchange=metrics_config.get('exchange', 're'))
+        except Exception, ex:
+            self.app_logger.error('Unable to publish metrics: %s' % ex)
+        self._connection.add_timeout(
+            metrics_config['interval'], self._publish_metrics)
+
+    def _pause_consuming(self):
+        """
+        Stops taking messages from the queue once max_in_flight messages
+        are being processed. Messages already sent by the broker are
+        still processed.
+        """
+        self.app_logger.info(
+            'Pausing consumption with %s messages in flight' % (
+                self._pool.pending))
+        self._paused = True
+        for consumer_tag in list(self._channel.consumer_tags):
+            self._channel.basic_cancel(consumer_tag=consumer_tag)
+
+    def _resume_consuming(self):
+        """
+        Starts taking messages from the queue again.
+        """
+        self.app_logger.info(
+            'Resuming consumption with %s messages in flight' % (
+                self._pool.pending))
+        self._paused = False
+        super(SQLWorker, self)._on_channel_open(self._channel)
+
+    def _relay_channel_calls(self):
+        """
+        Runs the channel calls queued by pool threads on the connection's
+        thread and schedules itself to run again. Consumption paused by
+        max_in_flight resumes once half the messages in flight are done.
+        """
+        while True:
+            try:
+                func, args, kwargs = self._channel_calls.get_nowait()
+            except Queue.Empty:
+                break
+            try:
+                func(*args, **kwargs)
+            except Exception, ex:
+                self.app_logger.error(
+                    'Unable to relay a call to the channel: %s' % ex)
+        if self._paused and self._pool.pending <= self._max_in_flight / 2:
+            self._resume_consuming()
+        self._connection.add_timeout(
+            self._config.get('concurrency', {}).get('poll_interval', 0.05),
+            self._relay_channel_calls)
+
+    def _on_channel(self, func, *args, **kwargs):
+        """
+        Calls func directly when on the connection's thread, otherwise
+        queues it for _relay_channel_calls since pika channels are not
+        thread safe. Pool threads block here while
+        concurrency.relay_queue_size calls are already queued.
+        """
+        if (self._pool is None or
+                threading.current_thread() is self._channel_thread):
+            return func(*args, **kwargs)
+        self._channel_calls.put((func, args, kwargs))
+
+    def ack(self, *args, **kwargs):
+        """
+        Acks a message. See reworker.worker.Worker.ack.
+        """
+        return self._on_channel(
+            super(SQLWorker, self).ack, *args, **kwargs)
+
+    def send(self, *args, **kwargs):
+        """
+        Sends a message. See reworker.worker.Worker.send.
+        """
+        return self._on_channel(self._timed_send, *args, **kwargs)
+
+    def _timed_send(self, topic, corr_id, message_struct, **kwargs):
+        """
+        Sends a message recording how long publishing took.
+        """
+        with self._metrics.timer('publish'):
+            super(SQLWorker, self).send(
+                topic, corr_id, message_struct, **kwargs)
+        self._metrics.incr(
+            'sqlworker_published_bytes_total',
+            len(json.dumps(message_struct)))
+
+    def notify(self, *args, **kwargs):
+        """
+        Sends a notification. See reworker.worker.Worker.notify.
+        """
+        return self._on_channel(
+            super(SQLWorker, self).notify, *args, **kwargs)
+
     # Subcommand methods
+    @subcommand('CreateTable', cost='expensive')
     def create_table(self, body, corr_id, output):
         """
         Creates a database table.
@@ -68,40 +387,45 @@ class SQLWorker(Worker):
             table_name = params['name']
             columns = params['columns']
 
-            metadata, engine, conn = self._db_connect(db_name)
-            self.app_logger.info('Attempting create the table ...')
-
             # This dynamically makes the database structure
             # It expects data like:
             #   {"colname": {"type": "Integer", "primary_key": True}}}
-            new_table = Table(table_name, metadata)
-            for k, v in columns.items():
-                col_type = getattr(sqlalchemy.types, v['type'])
-                del v['type']
-                # Check for length of column
-                length = v.get('length', None)
-                if length:
-                    del v['length']
-                new_column = Column(k, col_type(length), **v)
-                new_table.append_column(new_column)
+            new_table = Table(
+                table_name, MetaData(), *_compile_columns(columns))
+
+            metadata, engine, conn = self._db_connect(db_name)
+            self.app_logger.info('Attempting create the table ...')
             try:
-                new_table.create()
+                new_table.create(bind=conn)
                 output.info('Created new table %s' % table_name)
                 return 'Table created'
             except (OperationalError, ProgrammingError), oe:
                 raise SQLWorkerError(
                     'Could not create the table %s: %s' % (
                         params.get('name', 'NAME_NOT_GIVEN'), oe.message))
+            finally:
+                self._schema.invalidate(db_name, table_name)
 
         except KeyError, ke:
             output.error('Unable to create table %s because of missing input %s' % (
                 params.get('name', 'NAME_NOT_GIVEN'), ke))
             raise SQLWorkerError('Missing input %s' % ke)
 
+    @subcommand('ExecuteSQL', read_only=_is_read_only_sql)
     def execute_sql(self, body, corr_id, output):
         """
         Executes raw SQL.
 
+        Statements which only read run on a replica of the database when
+        one is configured and healthy, "primary": true keeps them on the
+        primary.
+
+        Values can be bound rather than written into the SQL with
+        "params", a dict for :name placeholders or a list of dicts to run
+        the statement once per dict. "sql" may also be a list of
+        statements, each a string or {"sql": ..., "params": ...}, which
+        are run in order in one transaction.
+
         Parameters:
 
         * body: The message body structure
@@ -115,24 +439,31 @@ class SQLWorker(Worker):
             db_name = params['database']
             sql = params['sql']
 
-            metadata, engine, conn = self._db_connect(db_name)
+            bind = params.get('params', None)
+            stream = params.get('stream', False)
+
+            # Reads go to a replica when there is one unless told otherwise
+            metadata, engine, conn = self._db_connect(
+                db_name, read_only=_is_read_only_sql(params) and not (
+                    params.get('primary', False)))
             self.app_logger.info('Attempting to execute sql ...')
 
             try:
-                r = engine.execute(sql)
-                if (r.context.isdelete or
-                        r.context.isupdate or
-                        r.context.isinsert):
-                    msg = 'SQL executed. %s rows effected' % r.rowcount
+                if isinstance(sql, list):
+                    return self._execute_script(conn, db_name, sql, output)
+                if stream:
+                    # Ask for a server side cursor where the driver has one
+                    r = self._execute_statement(
+                        conn.execution_options(stream_results=True),
+                        db_name, sql, bind)
+                else:
+                    r = self._execute_statement(conn, db_name, sql, bind)
+                if stream and r.returns_rows:
+                    msg = self._stream_rows(r, corr_id, params)
                     output.info(msg)
                     return msg
-                elif r.context.isddl:
-                    output.info('DDL successfully executed.')
-                    return "DDL executed"
-                else:
-                    output.info('SQL successfully executed.')
-                    return "SQL executed"
-            except (OperationalError, ProgrammingError), oe:
+                return self._describe_result(db_name, sql, r, output)
+            except StatementError, oe:
                 raise SQLWorkerError(
                     'Could not execute the given sql: %s' % oe.message)
         except KeyError, ke:
@@ -140,6 +471,128 @@ class SQLWorker(Worker):
                ke))
             raise SQLWorkerError('Missing input %s' % ke)
 
+    def _execute_statement(self, conn, db_name, sql, bind=None):
+        """
+        Executes one statement and returns its ResultProxy. Statements
+        with bound values are compiled once and kept in the statement
+        cache.
+
+        Parameters:
+            * conn: The connection to execute on
+            * db_name: The name of the database key in the configuration file
+            * sql: The SQL to execute
+            * bind: Optional dict, or list of dicts, of values for sql
+        """
+        if bind is None:
+            return conn.execute(sql)
+        compiled = self._statements.get(
+            (db_name, None, 'text', sql),
+            lambda: text(sql).compile(dialect=conn.dialect))
+        return conn.execute(compiled, bind)
+
+    def _execute_script(self, conn, db_name, statements, output):
+        """
+        Executes a list of statements in order in one transaction and
+        returns the result of each.
+
+        Parameters:
+            * conn: The connection to execute on
+            * db_name: The name of the database key in the configuration file
+            * statements: The list of SQL strings or {"sql", "params"} dicts
+            * output: The output object back to the user
+        """
+        results = []
+        trans = conn.begin()
+        try:
+            for index, statement in enumerate(statements):
+                if isinstance(statement, dict):
+                    sql = statement['sql']
+                    bind = statement.get('params', None)
+                else:
+                    sql, bind = statement, None
+                try:
+                    r = self._execute_statement(conn, db_name, sql, bind)
+                except StatementError, oe:
+                    raise SQLWorkerError(
+                        'Statement %s failed: %s' % (index + 1, oe.message))
+                results.append(self._describe_result(db_name, sql, r, output))
+            trans.commit()
+        except:
+            trans.rollback()
+            raise
+        return results
+
+    def _describe_result(self, db_name, sql, r, output):
+        """
+        Closes a result and returns what the statement did.
+
+        Parameters:
+            * db_name: The name of the database key in the configuration file
+            * sql: The SQL which was executed
+            * r: The ResultProxy of the statement
+            * output: The output object back to the user
+        """
+        # Plain strings are not compiled so look at the first word too
+        verb = sql.lstrip().split(None, 1)[0].upper() if sql.strip() else ''
+        if (r.context.isdelete or
+                r.context.isupdate or
+                r.context.isinsert or
+                verb in DML_VERBS):
+            msg = 'SQL executed. %s rows effected' % r.rowcount
+            r.close()
+            output.info(msg)
+            return msg
+        r.close()
+        if r.context.isddl or verb in DDL_VERBS:
+            # We can not tell which tables the DDL touched
+            self._schema.invalidate(db_name)
+            output.info('DDL successfully executed.')
+            return "DDL executed"
+        else:
+            output.info('SQL successfully executed.')
+            return "SQL executed"
+
+    def _stream_rows(self, result, corr_id, params):
+        """
+        Sends the rows of a result back to the requester in pages.
+
+        Each page is sent as {"status": "results", "page": N, "rows": [...]}
+        with rows as lists of values. The first page also carries the
+        column names.
+
+        With a worker pool pages go through the bounded relay queue so
+        reading waits while pages are being published. Without a pool
+        pika holds every page until the message is done, so max_bytes,
+        by default stream_max_bytes or DEFAULT_MAX_BYTES, is then the
+        only bound on memory.
+
+        Parameters:
+            * result: The ResultProxy holding the rows
+            * corr_id: The correlation id of the message
+            * params: The message parameters holding the optional limits
+        """
+        pager = ResultPager(
+            result,
+            page_rows=int(params.get('page_rows', 500)),
+            page_bytes=int(params.get('page_bytes', 262144)),
+            max_rows=params.get('max_rows', None),
+            max_bytes=params.get('max_bytes', self._config.get(
+                'stream_max_bytes', DEFAULT_MAX_BYTES)))
+        reply_to = self._local.properties.reply_to
+        count = 0
+        for page in pager.pages():
+            message = {'status': 'results', 'page': count, 'rows': page}
+            if count == 0:
+                message['columns'] = pager.columns
+            self.send(reply_to, corr_id, message, exchange='')
+            count += 1
+        msg = 'SQL executed. %s rows returned in %s page(s)' % (
+            pager.rows, count)
+        if pager.truncated:
+            msg += ', truncated at the requested limit'
+        return msg
+
+    @subcommand('DropTable', cost='expensive')
     def drop_table(self, body, corr_id, output):
         """
         Drops a table.
@@ -169,6 +622,8 @@ class SQLWorker(Worker):
             except OperationalError, oe:
                 raise SQLWorkerError(
                     'Could not execute the given drop table %s' % oe.message)
+            finally:
+                self._schema.invalidate(db_name, table_name)
             session.flush()
             return 'Table dropped'
         except KeyError, ke:
@@ -176,6 +631,7 @@ class SQLWorker(Worker):
                ke))
             raise SQLWorkerError('Missing input %s' % ke)
 
+    @subcommand('DropTableColumns', cost='expensive')
     def drop_table_columns(self, body, corr_id, output):
         """
         Drops a tables columns.
@@ -195,27 +651,24 @@ class SQLWorker(Worker):
             columns = params['columns']
 
             metadata, engine, conn = self._db_connect(db_name)
-            session = sessionmaker()(bind=engine)
-            ops = Operations(MigrationContext(conn.dialect, conn, {}))
 
             try:
                 self.app_logger.info('Attempting to drop columns ...')
-                count = 0
-                for column in columns:
-                    count = count + 1
-                    ops.drop_column(table_name, column)
-                    output.info('Dropped column %s on table %s.' % (
-                        column, table_name))
-                return '%s column(s) dropped' % count
-            except OperationalError, oe:
+                self._check_columns(db_name, table_name, conn, columns)
+                changes = [('drop', column) for column in columns]
+                self._apply_column_changes(
+                    conn, db_name, table_name, changes, output,
+                    params.get('online', None))
+                return '%s column(s) dropped' % len(changes)
+            except (OperationalError, NoSuchTableError), oe:
                 raise SQLWorkerError(
                     'Could not execute the given alter %s' % oe.message)
-            session.flush()
         except KeyError, ke:
             output.error('Unable to execute alter of missing input %s' % (
                ke))
             raise SQLWorkerError('Missing input %s' % ke)
 
+    @subcommand('AlterTableColumns', cost='expensive')
     def alter_table_columns(self, body, corr_id, output):
         """
         Alters a tables columns.
@@ -235,41 +688,35 @@ class SQLWorker(Worker):
             columns = params['columns']
 
             metadata, engine, conn = self._db_connect(db_name)
-            session = sessionmaker()(bind=engine)
-            mctx = MigrationContext.configure(conn)
 
             try:
                 self.app_logger.info('Attempting to alter a table ...')
-                add_cols = []
-                count = 0
-                for k, v in columns.items():
-                    count = count + 1
-                    col_type = getattr(sqlalchemy.types, v['type'])
-                    del v['type']
-                    # Check for length of column
-                    length = v.get('length', None)
-                    if length:
-                        del v['length']
-                    mc = Column(k, col_type(length), **v)
+                compiled = _compile_columns(columns)
+                self._check_columns(
+                    db_name, table_name, conn, columns.keys())
+                changes = []
+                for mc in compiled:
                     new_kwargs = {
                         'type_': mc.type,
                         'nullable': mc.nullable,
-                        'autoincrement': mc.autoincrement,
                     }
-                    mctx.impl.alter_column(table_name, k, **new_kwargs)
-                    output.info('Altered column %s on table %s.' % (
-                        k, table_name))
-                return '%s column(s) altered' % count
-            except OperationalError, oe:
+                    # Only ask for AUTO_INCREMENT when the spec does
+                    if 'autoincrement' in columns[mc.name]:
+                        new_kwargs['autoincrement'] = mc.autoincrement
+                    changes.append(('alter', mc.name, new_kwargs))
+                self._apply_column_changes(
+                    conn, db_name, table_name, changes, output,
+                    params.get('online', None))
+                return '%s column(s) altered' % len(changes)
+            except (OperationalError, NoSuchTableError), oe:
                 raise SQLWorkerError(
                     'Could not execute the given alter %s' % oe.message)
-            except Exception, ex:
-                raise ex
         except KeyError, ke:
             output.error('Unable to execute alter of missing input %s' % (
                ke))
             raise SQLWorkerError('Missing input %s' % ke)
 
+    @subcommand('AddTableColumns', cost='expensive')
     def add_table_columns(self, body, corr_id, output):
         """
         Adds columns to a table.
@@ -289,25 +736,18 @@ class SQLWorker(Worker):
             columns = params['columns']
 
             metadata, engine, conn = self._db_connect(db_name)
-            session = sessionmaker()(bind=engine)
-            mctx = MigrationContext.configure(conn)
 
             try:
                 self.app_logger.info('Attempting to alter a table ...')
-                add_cols = []
-                count = 0
-                for k, v in columns.items():
-                    count = count + 1
-                    col_type = getattr(sqlalchemy.types, v['type'])
-                    del v['type']
-                    # Check for length of column
-                    length = v.get('length', None)
-                    if length:
-                        del v['length']
-                    mc = Column(k, col_type(length), autoincrement=False, **v)
-                    mctx.impl.add_column(table_name, mc)
-
-                msg = '%s column(s) created' % count
+                compiled = _compile_columns(columns, autoincrement=False)
+                self._check_columns(
+                    db_name, table_name, conn, columns.keys(), exist=False)
+                changes = [('add', column) for column in compiled]
+                self._apply_column_changes(
+                    conn, db_name, table_name, changes, output,
+                    params.get('online', None))
+
+                msg = '%s column(s) created' % len(changes)
                 output.info(msg)
                 return msg
             except (OperationalError, NoSuchTableError), oe:
@@ -318,6 +758,205 @@ class SQLWorker(Worker):
                ke))
             raise SQLWorkerError('Missing input %s' % ke)
 
+    @subcommand('EnsureTable', cost='expensive')
+    def ensure_table(self, body, corr_id, output):
+        """
+        Makes a table match a column spec, creating it when it is missing
+        and otherwise changing only the columns which differ.
+
+        It expects data like:
+            {"database": "testdb", "name": "hosts",
+             "columns": {"id": {"type": "Integer", "primary_key": true},
+                         "hostname": {"type": "String", "length": 255}}}
+        Columns of the table missing from the spec are kept unless
+        "drop_columns" is true.
+
+        Parameters:
+
+        * body: The message body structure
+        * corr_id: The correlation id of the message
+        * output: The output object back to the user
+        """
+        # Get needed variables
+        params = body.get('parameters', {})
+
+        try:
+            db_name = params['database']
+            table_name = params['name']
+            columns = params['columns']
+            drop_columns = params.get('drop_columns', False)
+
+            metadata, engine, conn = self._db_connect(db_name)
+
+            try:
+                self.app_logger.info('Attempting to ensure a table ...')
+                wanted = Table(
+                    table_name, MetaData(), *_compile_columns(columns))
+                # Compare against the table as it is now, not as cached
+                self._schema.invalidate(db_name, table_name)
+                try:
+                    table = self._schema.get_table(db_name, table_name, conn)
+                except NoSuchTableError:
+                    try:
+                        wanted.create(bind=conn)
+                    finally:
+                        self._schema.invalidate(db_name, table_name)
+                    output.info('Created new table %s' % table_name)
+                    return 'Table created'
+
+                changes = self._diff_table(
+                    conn, table, wanted, columns, drop_columns)
+                if not changes:
+                    output.info('Table %s already matches' % table_name)
+                    return 'Table already matches'
+                self._apply_column_changes(
+                    conn, db_name, table_name, changes, output,
+                    params.get('online', None))
+                return '%s column change(s) applied' % len(changes)
+            except (OperationalError, ProgrammingError), oe:
+                raise SQLWorkerError(
+                    'Could not ensure the table %s: %s' % (
+                        table_name, oe.message))
+        except KeyError, ke:
+            output.error(
+                'Unable to ensure table because of missing input %s' % ke)
+            raise SQLWorkerError('Missing input %s' % ke)
+
+    def _diff_table(self, conn, table, wanted, columns, drop_columns):
+        """
+        Returns the column changes, in the form replugin.sqlworker.ddl
+        takes, turning the reflected table into the wanted one. Types are
+        compared the way alembic's autogenerate compares them.
+
+        Parameters:
+            * conn: The connection of the database
+            * table: The reflected Table
+            * wanted: The Table built from the column spec
+            * columns: The column spec
+            * drop_columns: Whether to drop columns missing from wanted
+        """
+        impl = MigrationContext.configure(
+            conn, opts={'compare_type': True}).impl
+        changes = []
+        for column in wanted.c:
+            if column.name not in table.c:
+                changes.append(('add', build_column(
+                    column.name, columns[column.name], autoincrement=False)))
+                continue
+            existing = table.c[column.name]
+            alter = {}
+            if impl.compare_type(existing, column):
+                alter['type_'] = column.type
+            # Reflected primary keys do not report nullable reliably
+            if not column.primary_key and existing.nullable != column.nullable:
+                alter['nullable'] = column.nullable
+            if alter:
+                alter.setdefault('nullable', column.nullable)
+                alter['existing_type'] = existing.type
+                changes.append(('alter', column.name, alter))
+        if drop_columns:
+            changes.extend(
+                ('drop', column.name) for column in table.c
+                if column.name not in wanted.c)
+        return changes
+
+    def _check_columns(self, db_name, table_name, conn, names, exist=True):
+        """
+        Raises SQLWorkerError unless every column in names exists (or,
+        when exist is False, none of them exist) so bad requests fail
+        before any DDL is sent.
+
+        Parameters:
+            * db_name: The name of the database key in the configuration file
+            * table_name: The name of the table
+            * conn: The connection to reflect with
+            * names: The column names to check
+            * exist: Whether the columns should exist
+        """
+        # Check the table as it is now on the primary, not as cached
+        self._schema.invalidate(db_name, table_name)
+        table = self._schema.get_table(
+            db_name, table_name, conn, primary=True)
+        for name in names:
+            if (name in table.c) != exist:
+                raise SQLWorkerError('Column %s %s on table %s' % (
+                    name, 'does not exist' if exist else 'already exists',
+                    table_name))
+
+    def _apply_column_changes(self, conn, db_name, table_name, changes,
+                              output, online=None):
+        """
+        Applies column changes to a table in one pass where the database
+        allows it. See replugin.sqlworker.ddl.
+
+        When online is true, or a dict of options, MySQL and PostgreSQL
+        tables are changed through a shadow table instead so writes are
+        not blocked while rows are copied. See replugin.sqlworker.online
+        for how and _throttle for the options. SQLite always copies the
+        table in batch mode.
+
+        Parameters:
+            * conn: The connection to run the DDL on
+            * db_name: The name of the database key in the configuration file
+            * table_name: The name of the table
+            * changes: The list of column changes
+            * output: The output object back to the user
+            * online: Optional true or dict of options for an online change
+        """
+        try:
+            if online and conn.dialect.name in ONLINE_DIALECTS:
+                options = online if isinstance(online, dict) else {}
+                table = self._schema.get_table(db_name, table_name, conn)
+                try:
+                    change = OnlineChange(
+                        conn, table, changes,
+                        self._throttle(db_name, options), output,
+                        self.app_logger, options.get('keep_old', False))
+                except ValueError, ve:
+                    raise SQLWorkerError(str(ve))
+                how = 'an online copy of %s rows' % change.run()
+            else:
+                if online:
+                    output.info(
+                        'No online mode for %s, copying %s in batch mode.' % (
+                            conn.dialect.name, table_name))
+                how = '%s statement(s)' % apply_changes(
+                    conn, table_name, changes)
+        finally:
+            self._schema.invalidate(db_name, table_name)
+        for change in changes:
+            name = change[1] if change[0] != 'add' else change[1].name
+            output.info('%s column %s on table %s.' % (
+                {'add': 'Added', 'alter': 'Altered', 'drop': 'Dropped'}[
+                    change[0]], name, table_name))
+        self.app_logger.info(
+            'Changed %s column(s) on %s in %s' % (
+                len(changes), table_name, how))
+
+    def _throttle(self, db_name, options):
+        """
+        Returns the online.Throttle for an online change. options may set
+        chunk_size, chunk_time (seconds a chunk should take), chunk_sleep
+        and max_lag, which defaults to the replica_max_lag of the
+        database. The lag is measured with its replica_lag_sql.
+
+        Parameters:
+            * db_name: The name of the database key in the configuration file
+            * options: The online options of the message
+        """
+        try:
+            replicas = self._engines.replicas(db_name)
+        except ValueError, ve:
+            self.app_logger.error('Not measuring replica lag: %s' % ve)
+            replicas = None
+        return Throttle(
+            int(options.get('chunk_size', 1000)),
+            float(options.get('chunk_time', 0.5)),
+            float(options.get('chunk_sleep', 0)),
+            options.get('max_lag', replicas.max_lag if replicas else None),
+            replicas.lag if replicas else None)
+
+    @subcommand('Insert')
     def insert(self, body, corr_id, output):
         """
         Adds insert a row or rows into a table.
@@ -335,25 +974,26 @@ class SQLWorker(Worker):
             db_name = params['database']
             table_name = params['name']
             rows = params['rows']
+            chunk_size = int(params.get(
+                'chunk_size', self._config.get(
+                    'insert_chunk_size', DEFAULT_CHUNK_SIZE)))
 
             metadata, engine, conn = self._db_connect(db_name)
-            mctx = MigrationContext.configure(conn)
 
             try:
                 self.app_logger.info('Attempting to insert into a table ...')
-                table = Table(table_name, metadata, autoload=True)
-                count = 0
-                for row in rows:
-                    count = count + 1
-                    row_data = {}
-                    for k, v in row.items():
-                        row_data[k] = v
-                    i = table.insert().values(**row_data)
-                    result_proxy = engine.execute(i)
-                    output.info('Insert number %s into table %s finished.' % (
-                        count, table_name))
+                table = self._checked_table(
+                    conn, db_name, table_name, _row_keys(rows))
+                trans = conn.begin()
+                try:
+                    count = self._insert_rows(
+                        conn, db_name, table, rows, chunk_size, output)
+                    trans.commit()
+                except:
+                    trans.rollback()
+                    raise
                 return '%s Insert statements done' % count
-            except (OperationalError, NoSuchTableError), oe:
+            except (OperationalError, IntegrityError, NoSuchTableError), oe:
                 raise SQLWorkerError(
                     'Could not execute the given insert %s' % oe.message)
         except KeyError, ke:
@@ -361,10 +1001,236 @@ class SQLWorker(Worker):
                ke))
             raise SQLWorkerError('Missing input %s' % ke)
 
+    @subcommand('Upsert')
+    def upsert(self, body, corr_id, output):
+        """
+        Inserts rows into a table, updating the existing row instead when
+        the values of the key columns are already there.
+
+        It expects data like:
+            {"database": "testdb", "name": "hosts", "keys": ["hostname"],
+             "rows": [{"hostname": "a", "state": "up"}]}
+        By default every column of a row other than the keys is updated on
+        conflict, "update" limits this to the columns listed. The keys must
+        be covered by a primary key or unique index.
+
+        Parameters:
+
+        * body: The message body structure
+        * corr_id: The correlation id of the message
+        * output: The output object back to the user
+        """
+        # Get needed variables
+        params = body.get('parameters', {})
+
+        try:
+            db_name = params['database']
+            table_name = params['name']
+            rows = params['rows']
+            conflict_keys = params['keys']
+            update = params.get('update', None)
+            chunk_size = int(params.get(
+                'chunk_size', self._config.get(
+                    'insert_chunk_size', DEFAULT_CHUNK_SIZE)))
+            if not conflict_keys:
+                raise SQLWorkerError('At least one key column is needed')
+
+            metadata, engine, conn = self._db_connect(db_name)
+            if conn.dialect.name not in UPSERT_DIALECTS:
+                raise SQLWorkerError(
+                    'Upsert is not supported on %s' % conn.dialect.name)
+
+            try:
+                self.app_logger.info('Attempting to upsert into a table ...')
+                table = self._checked_table(
+                    conn, db_name, table_name, _row_keys(rows).union(
+                        conflict_keys, update or []))
+                trans = conn.begin()
+                try:
+                    count = self._insert_rows(
+                        conn, db_name, table, rows, chunk_size, output,
+                        conflict_keys, update)
+                    trans.commit()
+                except:
+                    trans.rollback()
+                    raise
+                return '%s Upsert statements done' % count
+            except (OperationalError, ProgrammingError, IntegrityError,
+                    NoSuchTableError), oe:
+                raise SQLWorkerError(
+                    'Could not execute the given upsert %s' % oe.message)
+        except KeyError, ke:
+            output.error('Unable to execute upsert of missing input %s' % (
+               ke))
+            raise SQLWorkerError('Missing input %s' % ke)
+
+    @subcommand('Update')
+    def update(self, body, corr_id, output):
+        """
+        Updates rows in a table from a list of values and where pairs.
+
+        It expects data like:
+            {"database": "testdb", "name": "hosts", "updates": [
+                {"values": {"state": "up"}, "where": {"hostname": "a"}},
+                {"values": {"state": "down"}, "where": {"hostname": "b"}}]}
+        The where of each pair is described in
+        replugin.sqlworker.predicates. Consecutive pairs setting the same
+        columns with wheres of the same shape are sent as one executemany
+        of up to chunk_size parameter sets. Everything runs in one
+        transaction which is rolled back if more than max_rows rows change.
+        Every pair needs a where, and an empty where is only taken when
+        "all_rows" is true.
+
+        Parameters:
+
+        * body: The message body structure
+        * corr_id: The correlation id of the message
+        * output: The output object back to the user
+        """
+        # Get needed variables
+        params = body.get('parameters', {})
+
+        try:
+            db_name = params['database']
+            table_name = params['name']
+            updates = params['updates']
+            max_rows = params.get('max_rows', None)
+            all_rows = params.get('all_rows', False)
+            chunk_size = int(params.get(
+                'chunk_size', self._config.get(
+                    'insert_chunk_size', DEFAULT_CHUNK_SIZE)))
+
+            metadata, engine, conn = self._db_connect(db_name)
+
+            try:
+                self.app_logger.info('Attempting to update a table ...')
+                names = set()
+                for update in updates:
+                    if isinstance(update, dict):
+                        names.update(update.get('values', None) or {})
+                        names.update(where_columns(update.get('where', {})))
+                # Refreshed before the transaction as reflecting commits
+                # an open SQLite one
+                table = self._refresh_table(
+                    conn, db_name,
+                    self._schema.get_table(db_name, table_name, conn), names)
+                # Drivers without a sane executemany rowcount get one
+                # statement per pair when a limit has to be enforced
+                if (max_rows is not None and
+                        not conn.dialect.supports_sane_multi_rowcount):
+                    chunk_size = 1
+                count = 0
+                trans = conn.begin()
+                try:
+                    for compiled, param_sets in self._update_chunks(
+                            conn, db_name, table, updates, chunk_size,
+                            all_rows):
+                        count += conn.execute(compiled, param_sets).rowcount
+                        if max_rows is not None and count > int(max_rows):
+                            raise SQLWorkerError(
+                                'Update would change more than %s rows, '
+                                'rolled back' % max_rows)
+                        output.info('Updated %s rows in table %s.' % (
+                            count, table_name))
+                    trans.commit()
+                except:
+                    trans.rollback()
+                    raise
+                msg = 'Updated %s rows in %s.' % (count, table_name)
+                output.info(msg)
+                return msg
+            except (OperationalError, IntegrityError, NoSuchTableError), oe:
+                raise SQLWorkerError(
+                    'Could not execute the given update %s' % oe.message)
+        except KeyError, ke:
+            output.error('Unable to execute update of missing input %s' % (
+               ke))
+            raise SQLWorkerError('Missing input %s' % ke)
+
+    def _update_chunks(self, conn, db_name, table, updates, chunk_size,
+                       all_rows=False):
+        """
+        Yields (compiled update, list of parameter sets) tuples for
+        consecutive update pairs which share a statement. Raises KeyError
+        for a pair without a where.
+
+        Parameters:
+            * conn: The connection the statements will run on
+            * db_name: The name of the database key in the configuration file
+            * table: The Table being updated
+            * updates: The list of values and where pairs
+            * chunk_size: The most parameter sets to yield at once
+            * all_rows: Whether an empty where may update every row
+        """
+        chunk = []
+        chunk_key = None
+        compiled = None
+        for update in updates:
+            values = update.get('values', None)
+            if not values:
+                raise SQLWorkerError('Every update needs values to set')
+            names = tuple(sorted(values.keys()))
+            table = self._refresh_table(
+                conn, db_name, table,
+                names + tuple(where_columns(update.get('where', {}))))
+            for name in names:
+                if name not in table.c:
+                    raise SQLWorkerError(
+                        'Column %s does not exist on table %s' % (
+                            name, table.name))
+            try:
+                clause, param_set, shape = build_where(
+                    table, update['where'])
+            except ValueError, ve:
+                raise SQLWorkerError(
+                    'Could not build the given update: %s' % ve)
+            if clause is None and not all_rows:
+                raise SQLWorkerError(
+                    'An update with an empty where changes every row, '
+                    'set all_rows to do so')
+            key = (db_name, table.name, 'update', names, shape)
+            if chunk and (key != chunk_key or len(chunk) >= chunk_size):
+                yield compiled, chunk
+                chunk = []
+            if key != chunk_key:
+                compiled = self._statements.get(
+                    key, lambda: self._build_update(
+                        conn, table, names, clause))
+                chunk_key = key
+            for index, name in enumerate(names):
+                param_set['u_%s' % index] = values[name]
+            chunk.append(param_set)
+        if chunk:
+            yield compiled, chunk
+
+    def _build_update(self, conn, table, names, clause):
+        """
+        Returns a compiled update of the columns in names for the rows
+        matching clause. The new values are bound as u_0, u_1 and so on.
+
+        Parameters:
+            * conn: The connection the statement will run on
+            * table: The Table being updated
+            * names: The sorted names of the columns to set
+            * clause: The where clause or None for every row
+        """
+        statement = table.update().values(dict(
+            (table.c[name],
+             bindparam('u_%s' % index, type_=table.c[name].type))
+            for index, name in enumerate(names)))
+        if clause is not None:
+            statement = statement.where(clause)
+        return statement.compile(dialect=conn.dialect)
+
+    @subcommand('Delete')
     def delete(self, body, corr_id, output):
         """
         Adds delete a row or rows into a table.
 
+        The where parameter is described in replugin.sqlworker.predicates.
+        When chunk_size is given rows are deleted at most chunk_size at a
+        time, each chunk in its own transaction, until none match.
+
         Parameters:
 
         * body: The message body structure
@@ -378,23 +1244,38 @@ class SQLWorker(Worker):
             db_name = params['database']
             table_name = params['name']
             wheres = params['where']
+            chunk_size = params.get('chunk_size', None)
 
             metadata, engine, conn = self._db_connect(db_name)
-            mctx = MigrationContext.configure(conn)
 
             try:
                 self.app_logger.info('Attempting to delete from a table ...')
-                table = Table(table_name, metadata, autoload=True)
-                delete = table.delete()
-                for colname, valdata in wheres.items():
-                    col = getattr(table.c, colname)
-                    delete = delete.where(col == valdata)
-                result_proxy = engine.execute(delete)
-                msg = 'Deleted %s rows in %s.' % (
-                    result_proxy.rowcount, table_name)
+                table = self._refresh_table(
+                    conn, db_name,
+                    self._schema.get_table(db_name, table_name, conn),
+                    where_columns(wheres))
+                try:
+                    clause, where_params, shape = build_where(table, wheres)
+                except ValueError, ve:
+                    raise SQLWorkerError(
+                        'Could not build the given delete: %s' % ve)
+                if chunk_size:
+                    count = self._chunked_delete(
+                        conn, table, clause, int(chunk_size),
+                        float(params.get('chunk_sleep', 0)), output)
+                else:
+                    delete = table.delete()
+                    if clause is not None:
+                        delete = delete.where(clause)
+                    compiled = self._statements.get(
+                        (db_name, table_name, 'delete', shape),
+                        lambda: delete.compile(dialect=conn.dialect))
+                    result_proxy = conn.execute(compiled, where_params)
+                    count = result_proxy.rowcount
+                msg = 'Deleted %s rows in %s.' % (count, table_name)
                 output.info(msg)
                 return msg
-            except OperationalError, oe:
+            except (OperationalError, NoSuchTableError), oe:
                 raise SQLWorkerError(
                     'Could not execute the given delete %s' % oe.message)
         except KeyError, ke:
@@ -402,39 +1283,837 @@ class SQLWorker(Worker):
                ke))
             raise SQLWorkerError('Missing input %s' % ke)
 
-    def _db_connect(self, db_name):
+    @subcommand('BulkLoad', cost='expensive')
+    def bulk_load(self, body, corr_id, output):
+        """
+        Loads a CSV or newline delimited JSON file into a table.
+
+        The file is either a path relative to the configured
+        bulk_load.directory or is sent in chunks:
+            {"load_id": "abc", "sequence": 0, "data": "..."}
+            {"load_id": "abc", "sequence": 1, "data": "...", "final": true}
+        Chunks are spooled to bulk_load.spool_dir and loaded once the
+        final chunk arrives.
+
+        PostgreSQL loads with COPY FROM STDIN and MySQL loads local CSV
+        files with LOAD DATA LOCAL INFILE. Everything else is inserted
+        with executemany. Either way the load is one transaction.
+
+        Parameters:
+
+        * body: The message body structure
+        * corr_id: The correlation id of the message
+        * output: The output object back to the user
+        """
+        # Get needed variables
+        params = body.get('parameters', {})
+
+        try:
+            db_name = params['database']
+            table_name = params['name']
+            file_format = params.get('format', 'csv')
+            if file_format not in bulkload.FORMATS:
+                raise SQLWorkerError(
+                    'Unknown bulk load format %s' % file_format)
+
+            chunks = None
+            if 'load_id' in params:
+                chunks = self._spool_chunk(params)
+                if not params.get('final', False):
+                    msg = 'Received chunk %s of load %s' % (
+                        params['sequence'], params['load_id'])
+                    output.info(msg)
+                    return msg
+                path = None
+                fileobj = bulkload.ChunkFile(chunks)
+            else:
+                path = self._bulk_load_path(params['path'])
+                try:
+                    fileobj = open(path, 'rb')
+                except IOError, ioe:
+                    raise SQLWorkerError(
+                        'Could not open %s: %s' % (params['path'], ioe))
+
+            try:
+                metadata, engine, conn = self._db_connect(db_name)
+                self.app_logger.info('Attempting to bulk load a table ...')
+                table = self._schema.get_table(db_name, table_name, conn)
+                trans = conn.begin()
+                try:
+                    count = self._load_file(
+                        conn, db_name, table, fileobj, path, file_format,
+                        params, output)
+                    trans.commit()
+                except:
+                    trans.rollback()
+                    raise
+            except (OperationalError, ProgrammingError, IntegrityError,
+                    NoSuchTableError, ValueError), oe:
+                raise SQLWorkerError(
+                    'Could not execute the given bulk load %s' % (
+                        getattr(oe, 'message', oe)))
+            finally:
+                fileobj.close()
+                for chunk in chunks or []:
+                    os.remove(chunk)
+
+            msg = 'Loaded %s rows into %s.' % (count, table_name)
+            output.info(msg)
+            return msg
+        except KeyError, ke:
+            output.error('Unable to execute bulk load of missing input %s' % (
+               ke))
+            raise SQLWorkerError('Missing input %s' % ke)
+
+    def _load_file(self, conn, db_name, table, fileobj, path, file_format,
+                   params, output):
+        """
+        Loads an open file into a table with the fastest path the
+        database offers and returns the number of rows loaded.
+
+        Parameters:
+            * conn: The connection to load with
+            * db_name: The name of the database key in the configuration file
+            * table: The Table to load into
+            * fileobj: The open file
+            * path: The path of the file when it is a single local file
+            * file_format: One of replugin.sqlworker.bulkload.FORMATS
+            * params: The message parameters
+            * output: The output object back to the user
+        """
+        dialect = conn.dialect.name
+        columns = params.get('columns', None)
+        if file_format == 'csv':
+            header = params.get('header', True)
+            if header:
+                # The header is skipped even when columns are given
+                header_columns = bulkload.read_header(fileobj)
+                columns = columns or header_columns
+            if not columns:
+                raise SQLWorkerError(
+                    'columns must be given for a CSV file without a header')
+            rows = bulkload.iter_csv(fileobj, columns)
+        else:
+            rows = bulkload.iter_ndjson(fileobj)
+            if dialect == 'postgresql' and not columns:
+                # COPY needs the column list up front so use the first row's
+                first = next(rows, None)
+                if first is None:
+                    return 0
+                columns = sorted(first.keys())
+                rows = itertools.chain([first], rows)
+        table = self._refresh_table(conn, db_name, table, columns or [])
+        for column in columns or []:
+            if column not in table.c:
+                raise SQLWorkerError('Column %s does not exist on table %s' % (
+                    column, table.name))
+
+        if dialect == 'postgresql':
+            if file_format == 'ndjson':
+                fileobj = bulkload.CSVStream(rows, columns)
+            count = bulkload.copy_postgresql(conn, table, columns, fileobj)
+        elif (dialect == 'mysql' and file_format == 'csv' and
+                path is not None):
+            count = bulkload.load_data_mysql(
+                conn, table, columns, path, header)
+        else:
+            return self._insert_rows(
+                conn, db_name, table, rows,
+                int(params.get('chunk_size', self._config.get(
+                    'insert_chunk_size', DEFAULT_CHUNK_SIZE))),
+                output)
+        # Statements run on the DBAPI cursor are not seen by the engine
+        self._metrics.incr('sqlworker_rows_total', count)
+        return count
+
+    def _bulk_load_path(self, path):
+        """
+        Returns the full path of a file to bulk load, which must be inside
+        the configured bulk_load.directory.
+
+        Parameters:
+            * path: The path relative to bulk_load.directory
+        """
+        directory = self._config.get('bulk_load', {}).get('directory', None)
+        if not directory:
+            raise SQLWorkerError('Loading local files is not enabled')
+        directory = os.path.realpath(directory)
+        full_path = os.path.realpath(os.path.join(directory, path))
+        if not full_path.startswith(directory + os.sep):
+            raise SQLWorkerError(
+                'Bulk load files must be inside %s' % directory)
+        return full_path
+
+    def _spool_chunk(self, params):
+        """
+        Writes the data of a chunked load message to the spool directory.
+        For the final chunk returns every chunk of the load in order.
+
+        Parameters:
+            * params: The message parameters
+        """
+        load_id = str(params['load_id'])
+        if not bulkload.LOAD_ID.match(load_id):
+            raise SQLWorkerError(
+                'load_id may only hold letters, digits, - and _')
+        sequence = int(params['sequence'])
+        spool_dir = self._config.get('bulk_load', {}).get(
+            'spool_dir', tempfile.gettempdir())
+        data = params.get('data', '')
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        # Write then rename so a partial chunk is never loaded
+        fd, part = tempfile.mkstemp(
+            dir=spool_dir, prefix='.sqlworker-part-')
+        with os.fdopen(fd, 'wb') as part_file:
+            part_file.write(data)
+        os.rename(part, bulkload.spool_path(spool_dir, load_id, sequence))
+        if not params.get('final', False):
+            return None
+        try:
+            chunks = bulkload.spooled_chunks(spool_dir, load_id)
+            if len(chunks) != sequence + 1:
+                raise ValueError(
+                    'Load %s has %s chunks but the final chunk is %s' % (
+                        load_id, len(chunks), sequence))
+        except ValueError, ve:
+            # The load can not be finished so do not leave its chunks behind
+            bulkload.remove_chunks(spool_dir, load_id)
+            raise SQLWorkerError(str(ve))
+        return chunks
+
+    def _checked_table(self, conn, db_name, table_name, names):
+        """
+        Returns the cached table after checking every one of names is a
+        column, reflecting it again first if one is not.
+
+        Parameters:
+            * conn: The connection to reflect with
+            * db_name: The name of the database key in the configuration file
+            * table_name: The name of the table
+            * names: The column names which must exist
+        """
+        table = self._refresh_table(
+            conn, db_name, self._schema.get_table(db_name, table_name, conn),
+            names)
+        for name in sorted(names):
+            if name not in table.c:
+                raise SQLWorkerError(
+                    'Column %s does not exist on table %s' % (
+                        name, table_name))
+        return table
+
+    def _refresh_table(self, conn, db_name, table, names):
+        """
+        Returns table, reflected again from the primary when any of names
+        is not one of its columns since another worker may have added it.
+
+        Parameters:
+            * conn: The connection to reflect with
+            * db_name: The name of the database key in the configuration file
+            * table: The cached Table
+            * names: The column names which should exist
+        """
+        if all(name in table.c for name in names):
+            return table
+        self._schema.invalidate(db_name, table.name)
+        return self._schema.get_table(db_name, table.name, conn, primary=True)
+
+    def _insert_rows(self, conn, db_name, table, rows, chunk_size, output,
+                     conflict_keys=None, update=None):
+        """
+        Inserts rows chunk_size at a time with executemany and returns
+        how many were inserted. rows may be any iterable, only one chunk
+        is held at a time.
+
+        Parameters:
+            * conn: The connection to insert with
+            * db_name: The name of the database key in the configuration file
+            * table: The Table to insert into
+            * rows: An iterable of row dictionaries
+            * chunk_size: The largest number of rows to send at once
+            * output: The output object back to the user
+            * conflict_keys: Columns to upsert on instead of plain inserts
+            * update: Columns to overwrite on conflict, default all others
+        """
+        count = 0
+        for chunk in _chunk_rows(rows, chunk_size):
+            # Compiled inserts leave out keys which are not columns
+            table = self._refresh_table(conn, db_name, table, chunk[0])
+            for key in chunk[0]:
+                if key not in table.c:
+                    raise SQLWorkerError(
+                        'Column %s does not exist on table %s' % (
+                            key, table.name))
+            conn.execute(
+                self._compiled_insert(
+                    conn, db_name, table, chunk, conflict_keys, update),
+                chunk)
+            count += len(chunk)
+            output.info('%s %s rows into table %s.' % (
+                'Upserted' if conflict_keys else 'Inserted',
+                count, table.name))
+        return count
+
+    def _compiled_insert(self, conn, db_name, table, rows,
+                         conflict_keys=None, update=None):
+        """
+        Returns the compiled insert for rows, which must all use the same
+        columns, from the statement cache. When conflict_keys are given
+        the statement is an Upsert.
+
+        Parameters:
+            * conn: The connection the statement will run on
+            * db_name: The name of the database key in the configuration file
+            * table: The Table being inserted into
+            * rows: The list of row dictionaries to insert
+            * conflict_keys: Columns to upsert on instead of plain inserts
+            * update: Columns to overwrite on conflict, default all others
+        """
+        keys = tuple(sorted(rows[0].keys()))
+        multi = len(rows) > 1
+        if not conflict_keys:
+            return self._statements.get(
+                (db_name, table.name, 'insert', keys, multi),
+                lambda: table.insert().compile(
+                    dialect=conn.dialect, column_keys=list(keys),
+                    inline=multi))
+        conflict_keys = tuple(conflict_keys)
+        missing = [key for key in conflict_keys if key not in keys]
+        if missing:
+            raise SQLWorkerError(
+                'Every row must have a value for %s' % ', '.join(missing))
+        update = tuple(
+            key for key in keys
+            if key not in conflict_keys and (update is None or key in update))
+        # Inline so nothing (like RETURNING) follows the conflict clause
+        return self._statements.get(
+            (db_name, table.name, 'upsert', keys, conflict_keys, update),
+            lambda: Upsert(table, conflict_keys, update).compile(
+                dialect=conn.dialect, column_keys=list(keys), inline=True))
+
+    def _chunked_delete(self, conn, table, clause, chunk_size, chunk_sleep,
+                        output):
+        """
+        Deletes the rows matching clause chunk_size rows at a time,
+        committing after every chunk. Returns the number of rows deleted.
+
+        Parameters:
+            * conn: The connection to delete with
+            * table: The Table to delete from
+            * clause: The where clause or None for every row
+            * chunk_size: The most rows to delete in one transaction
+            * chunk_sleep: Seconds to wait between chunks
+            * output: The output object back to the user
+        """
+        pk = list(table.primary_key.columns)
+        if not pk:
+            raise SQLWorkerError(
+                'Chunked deletes need a primary key on %s' % table.name)
+        count = 0
+        while True:
+            trans = conn.begin()
+            try:
+                keys = select(pk)
+                if clause is not None:
+                    keys = keys.where(clause)
+                keys = conn.execute(keys.limit(chunk_size)).fetchall()
+                if not keys:
+                    trans.commit()
+                    return count
+                if len(pk) == 1:
+                    chunk = pk[0].in_([key[0] for key in keys])
+                else:
+                    chunk = or_(*[
+                        and_(*[col == value for col, value in zip(pk, key)])
+                        for key in keys])
+                result_proxy = conn.execute(table.delete().where(chunk))
+                trans.commit()
+            except:
+                trans.rollback()
+                raise
+            count += result_proxy.rowcount
+            output.info('Deleted %s rows from %s so far.' % (
+                count, table.name))
+            if chunk_sleep:
+                time.sleep(chunk_sleep)
+
+    @subcommand('Batch', cost='expensive')
+    def batch(self, body, corr_id, output):
+        """
+        Runs a list of subcommands in order on one connection inside one
+        transaction. Where the database can not roll back DDL the steps
+        which already ran are not undone on failure.
+
+        It expects data like:
+            {"database": "testdb", "steps": [
+                {"subcommand": "CreateTable", "name": ..., "columns": ...},
+                {"subcommand": "Insert", "name": ..., "rows": ...}]}
+
+        Parameters:
+
+        * body: The message body structure
+        * corr_id: The correlation id of the message
+        * output: The output object back to the user
+        """
+        # Get needed variables
+        params = body.get('parameters', {})
+
+        try:
+            db_name = params['database']
+            steps = params['steps']
+
+            # Check every step before doing any work
+            step_methods = []
+            for step in steps:
+                subcommand = str(step['subcommand'])
+                if subcommand not in self._registry or (
+                        subcommand == 'Batch'):
+                    raise SQLWorkerError(
+                        'Subcommand %s can not be used in a batch' % (
+                            subcommand))
+                if step.get('database', db_name) != db_name:
+                    raise SQLWorkerError(
+                        'All batch steps must use database %s' % db_name)
+                step_methods.append(
+                    (subcommand, self._find_subcommand(subcommand)))
+
+            metadata, engine, conn = self._db_connect(db_name)
+            self.app_logger.info('Attempting to run a batch ...')
+
+            self._local.pinned = {db_name: conn}
+            trans = conn.begin()
+            try:
+                results = []
+                for index, (subcommand, cmd_method) in enumerate(
+                        step_methods):
+                    step_params = dict(steps[index])
+                    step_params['database'] = db_name
+                    try:
+                        result = cmd_method(
+                            {'parameters': step_params}, corr_id, output)
+                    except SQLWorkerError, swe:
+                        raise SQLWorkerError(
+                            'Batch step %s (%s) failed: %s' % (
+                                index + 1, subcommand, swe))
+                    results.append(
+                        {'subcommand': subcommand, 'result': result})
+                trans.commit()
+            except:
+                trans.rollback()
+                # Steps may have cached DDL which was just rolled back
+                self._schema.invalidate(db_name)
+                raise
+            finally:
+                self._local.pinned = {}
+            output.info('Batch of %s step(s) committed.' % len(results))
+            return results
+        except KeyError, ke:
+            output.error('Unable to execute batch of missing input %s' % (
+               ke))
+            raise SQLWorkerError('Missing input %s' % ke)
+
+    def _db_connect(self, db_name, read_only=False):
         """
         Create connection to the database.
 
+        The engine comes from the worker's registry so its connection pool
+        is shared between messages. The connection is returned to the pool
+        by _release_connections once the message has been processed.
+
+        The returned MetaData is the schema cache's collection for the
+        database and only holds tables reflected through
+        self._schema.get_table.
+
+        While a Batch runs, its connection is returned instead of a new
+        one so every step shares the batch's transaction.
+
+        When read_only is True a connection to a replica is returned if
+        _replica_connection finds one.
+
         Parameters:
             * db_name: The name of the databaes key in the configuration file
+            * read_only: Whether the connection will only be read from
         """
         try:
-            connection_info = self._config['databases'][db_name]
-            connection_str = connection_info['uri']
-            conn_kwargs = connection_info.get('kwargs', {})
-            engine = create_engine(connection_str, **conn_kwargs)
+            engine = self._engines.get(db_name)
+            pinned = getattr(self._local, 'pinned', {})
+            if db_name in pinned:
+                return (self._schema.metadata(db_name), engine,
+                        pinned[db_name])
+            if read_only:
+                conn = self._replica_connection(db_name)
+                if conn is not None:
+                    return (self._schema.metadata(db_name), conn.engine, conn)
             # This will fail with OperationalError if we can not conenct.
-            conn = engine.connect()
-            metadata = MetaData(bind=engine, reflect=True)
+            with self._metrics.timer('connect'):
+                conn = engine.connect()
+            self._checked_out().append(conn)
+            metadata = self._schema.metadata(db_name)
             return (metadata, engine, conn)
         except KeyError:
             raise SQLWorkerError(
                 'No database configured with the given name. '
                 'Check your database parameter.')
+        except TypeError, te:
+            raise SQLWorkerError(
+                'Invalid pool configuration for the database requested: '
+                '%s' % te)
         except OperationalError:
             raise SQLWorkerError(
                 'Could not connect to the database requested.')
 
+    def _replica_connection(self, db_name):
+        """
+        Returns a connection to a healthy replica of db_name, or None
+        when the primary should be used. The primary is used during a
+        Batch and, since replicas may not have caught up yet, for
+        replica_max_lag seconds after the schema is known to change.
+
+        Parameters:
+            * db_name: The name of the database key in the configuration file
+        """
+        if db_name in getattr(self._local, 'pinned', {}):
+            return None
+        try:
+            replicas = self._engines.replicas(db_name)
+        except ValueError, ve:
+            self.app_logger.error(
+                'Invalid replica configuration for %s: %s' % (db_name, ve))
+            return None
+        if replicas is None or (
+                time.time() - self._schema.invalidated_at(db_name) <
+                replicas.max_lag):
+            return None
+        with self._metrics.timer('connect'):
+            conn = replicas.connect()
+        if conn is not None:
+            self._checked_out().append(conn)
+        return conn
+
+    def _checked_out(self):
+        """
+        Returns the connections checked out by the current thread.
+        """
+        if not hasattr(self._local, 'connections'):
+            self._local.connections = []
+        return self._local.connections
+
+    def _release_connections(self, mark=0):
+        """
+        Returns the connections checked out by the current thread
+        back to their pool.
+
+        Parameters:
+            * mark: How many of the oldest connections to leave alone
+        """
+        connections = self._checked_out()
+        while len(connections) > mark:
+            conn = connections.pop()
+            try:
+                conn.close()
+            except Exception, ex:
+                self.app_logger.warn(
+                    'Unable to return a connection to the pool: %s' % ex)
+
+    def _find_subcommand(self, subcommand):
+        """
+        Returns the method implementing a subcommand.
+
+        Parameters:
+            * subcommand: The name of the subcommand
+        """
+        try:
+            return self._registry.handler(subcommand)
+        except KeyError:
+            self.app_logger.warn(
+                'Could not find the implementation of subcommand %s' % (
+                    subcommand))
+            raise SQLWorkerError('No subcommand implementation')
+
     def process(self, channel, basic_deliver, properties, body, output):
         """
         Processes SQLWorker requests from the bus.
 
         *Keys Requires*:
             * subcommand: the subcommand to execute.
+
+        When a worker pool is configured the request is handed to the
+        pool and this returns right away. The pool shares its threads
+        fairly between databases by concurrency.weights and runs read
+        only subcommands which are not expensive in a fast lane. If
+        concurrency.max_in_flight messages are then waiting or running,
+        no more are taken from the queue until half of them are done.
+        BulkLoad chunks other than the final one are spooled right here,
+        in the order they arrive, so a load's chunks are all spooled
+        before the pool loads them.
+
+        When coalesce is configured small Insert messages are held and
+        inserted together, see replugin.sqlworker.coalesce. They are only
+        acked once their rows are committed. Other messages for the same
+        table flush the held inserts first so the order is kept.
+
+        With late_ack every message is acked only once it has been
+        processed, so messages are redelivered if the worker dies first.
+        With idempotency configured a message which already completed,
+        the same correlation id and body, gets the stored result back
+        instead of running again, see replugin.sqlworker.idempotency.
+        """
+        params = body.get('parameters', {})
+        if self._coalescer is not None:
+            key = self._coalescer.key(params)
+            if key is not None and self._stored_result(
+                    properties, body) is None:
+                self._coalesce(key, basic_deliver, properties, body, output)
+                return
+            # Held inserts go first so messages keep the order they came in
+            name = params.get('name', None)
+            if params.get('subcommand') == 'Batch':
+                name = None
+            for batch in self._coalescer.pending(
+                    params.get('database', None), name):
+                self._flush_batch(batch)
+        if not self._late_ack:
+            # Ack the original message
+            self.ack(basic_deliver)
+            basic_deliver = None
+        if self._pool is not None and not (
+                params.get('subcommand') == 'BulkLoad' and
+                'load_id' in params and not params.get('final', False)):
+            subcommand = str(params.get('subcommand', ''))
+            db_name, cost, fast = None, 'normal', False
+            if subcommand in self._registry:
+                info = self._registry.info(subcommand)
+                db_name = info.database(params)
+                cost = info.cost
+                # Quick reads skip ahead of writes and bulk work
+                fast = cost != 'expensive' and info.is_read_only(params)
+            self._pool.schedule(
+                db_name, cost, fast, self._handle, properties, body, output,
+                basic_deliver)
+            if (self._max_in_flight and not self._paused and
+                    self._pool.pending >= self._max_in_flight):
+                self._pause_consuming()
+            return
+        self._handle(properties, body, output, basic_deliver)
+
+    def _stored_result(self, properties, body):
+        """
+        Returns the (status, data) stored for the message or None when
+        there is none or no idempotency store.
+
+        Parameters:
+            * properties: The properties of the message
+            * body: The message body structure
+        """
+        if self._results is None:
+            return None
+        try:
+            return self._results.get(
+                message_key(str(properties.correlation_id), body))
+        except Exception, ex:
+            self.app_logger.error('Unable to look up a stored result: %s' % ex)
+            return None
+
+    def _store_result(self, corr_id, body, data):
+        """
+        Stores the result of a completed message when there is an
+        idempotency store.
+
+        Parameters:
+            * corr_id: The correlation id of the message
+            * body: The message body structure
+            * data: The data sent back
+        """
+        if self._results is None:
+            return
+        try:
+            self._results.put(message_key(corr_id, body), 'completed', data)
+        except Exception, ex:
+            self.app_logger.error(
+                'Unable to store the result of %s: %s' % (corr_id, ex))
+
+    def _coalesce(self, key, basic_deliver, properties, body, output):
+        """
+        Adds an Insert message to the batch for its table, flushing the
+        batch when it is full or else once coalesce.max_ms has passed
+        since it was started.
+
+        Parameters:
+            * key: The (database, table) the message inserts into
+            * basic_deliver: The delivery of the message, acked on commit
+            * properties: The properties of the message
+            * body: The message body structure
+            * output: The output object back to the user
+        """
+        batch, first, full = self._coalescer.add(
+            key, (basic_deliver, properties, body, output),
+            len(body['parameters']['rows']))
+        if full:
+            self._flush_batch(batch)
+        elif first:
+            self._connection.add_timeout(
+                self._coalescer.max_ms / 1000.0,
+                lambda: self._flush_batch(batch))
+
+    def _flush_batch(self, batch):
+        """
+        Inserts a batch of coalesced messages, on the pool when there is
+        one. Does nothing if the batch was already flushed.
+
+        Parameters:
+            * batch: The coalesce.Batch to flush
+        """
+        entries = self._coalescer.take(batch)
+        if not entries:
+            return
+        if self._pool is not None:
+            self._pool.schedule(
+                batch.key[0], 'normal', False, self._insert_batch,
+                batch.key, entries)
+            return
+        self._insert_batch(batch.key, entries)
+
+    def _insert_batch(self, key, entries):
+        """
+        Inserts the rows of coalesced messages in one transaction then
+        acks and replies to each. If the transaction fails every message
+        is processed on its own instead so each gets its own result.
+
+        Parameters:
+            * key: The (database, table) the messages insert into
+            * entries: (basic_deliver, properties, body, output) tuples
+        """
+        mark = len(self._checked_out())
+        start = time.time()
+        db_name, table_name = key
+        error = None
+        try:
+            metadata, engine, conn = self._db_connect(db_name)
+            table = self._checked_table(
+                conn, db_name, table_name, _row_keys(
+                    itertools.chain.from_iterable(
+                        entry[2]['parameters']['rows'] for entry in entries)))
+            trans = conn.begin()
+            try:
+                count = self._insert_rows(
+                    conn, db_name, table,
+                    itertools.chain.from_iterable(
+                        entry[2]['parameters']['rows'] for entry in entries),
+                    int(self._config.get(
+                        'insert_chunk_size', DEFAULT_CHUNK_SIZE)),
+                    self.app_logger)
+                trans.commit()
+            except:
+                trans.rollback()
+                raise
+        except Exception, error:
+            pass
+        finally:
+            self._release_connections(mark)
+        if error is not None:
+            self.app_logger.warn(
+                'Coalesced insert of %s messages into %s failed, '
+                'inserting them one by one: %s' % (
+                    len(entries), table_name, error))
+            for basic_deliver, properties, body, output in entries:
+                self._handle(properties, body, output, basic_deliver)
+            return
+        self._metrics.bind(subcommand='Insert', database=str(db_name))
+        self.app_logger.info(
+            'Coalesced %s Insert messages into %s rows for %s' % (
+                len(entries), count, table_name))
+        try:
+            for basic_deliver, properties, body, output in entries:
+                corr_id = str(properties.correlation_id)
+                rows = len(body['parameters']['rows'])
+                output.info('Inserted %s rows into table %s.' % (
+                    rows, table_name))
+                result = '%s Insert statements done' % rows
+                self._store_result(corr_id, body, result)
+                self.send(properties.reply_to, corr_id,
+                          {'status': 'started'}, exchange='')
+                self.send(
+                    properties.reply_to, corr_id,
+                    {'status': 'completed', 'data': result},
+                    exchange='')
+                self.notify(
+                    'SQLWorker Executed Successfully',
+                    'SQLWorker successfully executed Insert. See logs.',
+                    'completed',
+                    corr_id)
+                self.ack(basic_deliver)
+            self._metrics.observe('process', time.time() - start)
+            self._metrics.incr(
+                'sqlworker_messages_total', len(entries), status='completed')
+        finally:
+            self._metrics.clear()
+
+    def _handle(self, properties, body, output, basic_deliver=None):
+        """
+        Handles a message, under the profiler when the message asks for
+        it with "profile": true or is picked by profiling.sample_every.
+        See replugin.sqlworker.profiling. A message which already
+        completed gets its stored result back instead.
+
+        Parameters:
+            * properties: The properties of the message
+            * body: The message body structure
+            * output: The output object back to the user
+            * basic_deliver: Optional delivery to ack once handled
+        """
+        try:
+            stored = self._stored_result(properties, body)
+            if stored is not None:
+                return self._replay(properties, stored)
+            if self._profiler.wanted(body.get('parameters', {})):
+                return self._profiler.run(
+                    str(properties.correlation_id), self._handle_message,
+                    properties, body, output)
+            return self._handle_message(properties, body, output)
+        finally:
+            if basic_deliver is not None:
+                self.ack(basic_deliver)
+
+    def _replay(self, properties, stored):
         """
-        # Ack the original message
-        self.ack(basic_deliver)
+        Sends the stored result of a message which already completed.
+
+        Parameters:
+            * properties: The properties of the message
+            * stored: The (status, data) from the idempotency store
+        """
+        corr_id = str(properties.correlation_id)
+        self.app_logger.info(
+            'Replaying the stored result for correlation_id %s' % corr_id)
+        self._metrics.incr('sqlworker_replayed_total')
+        status, data = stored
+        self.send(properties.reply_to, corr_id, {'status': 'started'},
+                  exchange='')
+        self.send(properties.reply_to, corr_id,
+                  {'status': status, 'data': data}, exchange='')
+
+    def _handle_message(self, properties, body, output):
+        """
+        Runs the requested subcommand and replies with the result.
+
+        Parameters:
+            * properties: The properties of the message
+            * body: The message body structure
+            * output: The output object back to the user
+        """
+        # Connections checked out past this point are ours to release
+        mark = len(self._checked_out())
+        self._local.properties = properties
+        start = time.time()
+        params = body.get('parameters', {})
+        subcommand_label = str(params.get('subcommand', ''))
+        if subcommand_label not in self._registry:
+            subcommand_label = 'unknown'
+        self._metrics.bind(
+            subcommand=subcommand_label,
+            database=str(params.get('database', '')))
+        status = 'failed'
         corr_id = str(properties.correlation_id)
         # Notify we are starting
         self.send(
@@ -443,36 +2122,15 @@ class SQLWorker(Worker):
         try:
             try:
                 subcommand = str(body['parameters']['subcommand'])
-                if subcommand not in self.subcommands:
+                if subcommand not in self._registry:
                     raise KeyError()
             except KeyError:
                 raise SQLWorkerError(
                     'No valid subcommand given. Nothing to do!')
 
-            cmd_method = None
-            if subcommand == 'CreateTable':
-                cmd_method = self.create_table
-            elif subcommand == 'DropTable':
-                cmd_method = self.drop_table
-            elif subcommand == 'AlterTableColumns':
-                cmd_method = self.alter_table_columns
-            elif subcommand == 'AddTableColumns':
-                cmd_method = self.add_table_columns
-            elif subcommand == 'DropTableColumns':
-                cmd_method = self.drop_table_columns
-            elif subcommand == 'ExecuteSQL':
-                cmd_method = self.execute_sql
-            elif subcommand == 'Insert':
-                cmd_method = self.insert
-            elif subcommand == 'Delete':
-                cmd_method = self.delete
-            else:
-                self.app_logger.warn(
-                    'Could not find the implementation of subcommand %s' % (
-                        subcommand))
-                raise SQLWorkerError('No subcommand implementation')
-
+            cmd_method = self._find_subcommand(subcommand)
             result = cmd_method(body, corr_id, output)
+            self._store_result(corr_id, body, result)
             # Send results back
             self.send(
                 properties.reply_to,
@@ -493,6 +2151,7 @@ class SQLWorker(Worker):
                 'SQLWorker successfully executed %s for '
                 'correlation_id %s. See logs.' % (
                     subcommand, corr_id))
+            status = 'completed'
 
         except SQLWorkerError, fwe:
             # If a SQLWorkerError happens send a failure log it.
@@ -509,6 +2168,13 @@ class SQLWorker(Worker):
                 'failed',
                 corr_id)
             output.error(str(fwe))
+        finally:
+            self._release_connections(mark)
+            self._metrics.observe('process', time.time() - start)
+            self._metrics.incr('sqlworker_messages_total', status=status)
+            if status == 'failed':
+                self._metrics.incr('sqlworker_errors_total')
+            self._metrics.clear()
 
 
 def main():  # pragma: no cover
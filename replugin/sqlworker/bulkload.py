@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Helpers for loading CSV and newline delimited JSON files into tables.
+
+Files are always read a line at a time so memory use does not depend on
+the size of the file.
+"""
+
+import csv
+import glob
+import json
+import os
+import re
+
+from sqlalchemy import text
+
+
+#: Supported file formats
+FORMATS = ('csv', 'ndjson')
+
+#: What a load_id may look like, so it is safe to use in a file name
+LOAD_ID = re.compile(r'^[A-Za-z0-9_-]+$')
+
+
+def _decode(value):
+    """
+    Returns a CSV field as unicode, or None for an empty field.
+    """
+    if value == '':
+        return None
+    return value.decode('utf-8')
+
+
+def read_header(fileobj):
+    """
+    Reads the header line of a CSV file and returns its column names.
+
+    Parameters:
+        * fileobj: The file, positioned at its start
+    """
+    line = fileobj.readline()
+    return [_decode(name) for name in next(csv.reader([line]))]
+
+
+def iter_csv(fileobj, columns):
+    """
+    Yields one dict per CSV record.
+
+    Parameters:
+        * fileobj: The file, positioned after any header
+        * columns: The column name of each field
+    """
+    for record in csv.reader(fileobj):
+        if len(record) != len(columns):
+            raise ValueError('Expected %s fields but found %s: %s' % (
+                len(columns), len(record), record))
+        yield dict(zip(columns, [_decode(value) for value in record]))
+
+
+def iter_ndjson(fileobj):
+    """
+    Yields one dict per non blank line of newline delimited JSON.
+
+    Parameters:
+        * fileobj: The file to read
+    """
+    for line in fileobj:
+        line = line.strip()
+        if not line:
+            continue
+        row = json.loads(line)
+        if not isinstance(row, dict):
+            raise ValueError('Each line must hold a JSON object: %s' % line)
+        yield row
+
+
+class CSVStream(object):
+    """
+    File like object producing CSV text from an iterator of dicts, so
+    rows can be fed to COPY without writing them anywhere first.
+    """
+
+    def __init__(self, rows, columns):
+        """
+        Creates the stream.
+
+        Parameters:
+            * rows: An iterator of dicts
+            * columns: The column order to write values in
+        """
+        self._rows = rows
+        self._columns = columns
+        self._buffer = ''
+
+    def _line(self):
+        """
+        Returns the next row as a CSV line or '' once the rows run out.
+        """
+        for row in self._rows:
+            values = []
+            for column in self._columns:
+                value = row.get(column, None)
+                if value is None:
+                    values.append('')
+                    continue
+                if isinstance(value, unicode):
+                    value = value.encode('utf-8')
+                elif not isinstance(value, str):
+                    value = json.dumps(value)
+                values.append('"%s"' % value.replace('"', '""'))
+            return ','.join(values) + '\n'
+        return ''
+
+    def read(self, size=-1):
+        """
+        Returns up to size bytes of CSV, or everything left when size
+        is negative.
+        """
+        while size < 0 or len(self._buffer) < size:
+            line = self._line()
+            if not line:
+                break
+            self._buffer += line
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def readline(self, size=-1):
+        """
+        Returns the next line of CSV.
+        """
+        if self._buffer:
+            line, sep, rest = self._buffer.partition('\n')
+            self._buffer = rest
+            return line + sep
+        return self._line()
+
+
+class ChunkFile(object):
+    """
+    Read only file made of the spooled chunks of a load, in order.
+    """
+
+    def __init__(self, paths):
+        """
+        Creates the file.
+
+        Parameters:
+            * paths: The chunk files in the order they should be read
+        """
+        self._paths = list(paths)
+        self._current = None
+
+    def _next_file(self):
+        """
+        Opens the next chunk, returning False when none are left.
+        """
+        if self._current is not None:
+            self._current.close()
+            self._current = None
+        if not self._paths:
+            return False
+        self._current = open(self._paths.pop(0), 'rb')
+        return True
+
+    def readline(self, size=-1):
+        """
+        Returns the next line, which may span chunks.
+        """
+        line = ''
+        while not line.endswith('\n'):
+            if self._current is None and not self._next_file():
+                break
+            part = self._current.readline()
+            if not part:
+                if not self._next_file():
+                    break
+                continue
+            line += part
+        return line
+
+    def read(self, size=-1):
+        """
+        Returns up to size bytes, or everything left when size is
+        negative.
+        """
+        data = ''
+        while size < 0 or len(data) < size:
+            if self._current is None and not self._next_file():
+                break
+            part = self._current.read(-1 if size < 0 else size - len(data))
+            if not part:
+                if not self._next_file():
+                    break
+                continue
+            data += part
+        return data
+
+    def __iter__(self):
+        """
+        Iterates over the lines of the file.
+        """
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+    def close(self):
+        """
+        Closes the file.
+        """
+        if self._current is not None:
+            self._current.close()
+            self._current = None
+        self._paths = []
+
+
+def spool_path(spool_dir, load_id, sequence):
+    """
+    Returns the path a chunk of a load is spooled to.
+
+    Parameters:
+        * spool_dir: The directory chunks are kept in
+        * load_id: The id shared by the chunks of one load
+        * sequence: The position of the chunk in the load, from 0
+    """
+    return os.path.join(
+        spool_dir, 'sqlworker-load-%s.%08d' % (load_id, int(sequence)))
+
+
+def spooled_chunks(spool_dir, load_id):
+    """
+    Returns the spooled chunk paths of a load in order, raising
+    ValueError if any chunk is missing.
+
+    Parameters:
+        * spool_dir: The directory chunks are kept in
+        * load_id: The id shared by the chunks of one load
+    """
+    paths = sorted(glob.glob(_spool_pattern(spool_dir, load_id)))
+    for index, path in enumerate(paths):
+        if path != spool_path(spool_dir, load_id, index):
+            raise ValueError('Chunk %s of load %s is missing' % (
+                index, load_id))
+    return paths
+
+
+def remove_chunks(spool_dir, load_id):
+    """
+    Removes every spooled chunk of a load.
+
+    Parameters:
+        * spool_dir: The directory chunks are kept in
+        * load_id: The id shared by the chunks of one load
+    """
+    for path in glob.glob(_spool_pattern(spool_dir, load_id)):
+        os.remove(path)
+
+
+def _spool_pattern(spool_dir, load_id):
+    """
+    Returns the glob pattern matching every spooled chunk of a load.
+    """
+    return os.path.join(spool_dir, 'sqlworker-load-%s.*' % load_id)
+
+
+def copy_postgresql(conn, table, columns, fileobj):
+    """
+    Loads CSV into a PostgreSQL table with COPY FROM STDIN and returns
+    the number of rows copied.
+
+    Parameters:
+        * conn: The connection to load with
+        * table: The Table to load into
+        * columns: The column order of the CSV
+        * fileobj: The CSV, positioned after any header
+    """
+    preparer = conn.dialect.identifier_preparer
+    sql = 'COPY %s (%s) FROM STDIN WITH CSV' % (
+        preparer.format_table(table),
+        ', '.join(preparer.quote_identifier(c) for c in columns))
+    cursor = conn.connection.cursor()
+    try:
+        cursor.copy_expert(sql, fileobj)
+        return cursor.rowcount
+    finally:
+        cursor.close()
+
+
+def load_data_mysql(conn, table, columns, path, header):
+    """
+    Loads a CSV file into a MySQL table with LOAD DATA LOCAL INFILE and
+    returns the number of rows loaded. The client must be allowed to use
+    LOCAL INFILE (local_infile=1 in the connect arguments).
+
+    Parameters:
+        * conn: The connection to load with
+        * table: The Table to load into
+        * columns: The column order of the CSV
+        * path: The path of the CSV file
+        * header: Whether the first line of the file is a header
+    """
+    preparer = conn.dialect.identifier_preparer
+    sql = (
+        "LOAD DATA LOCAL INFILE :path INTO TABLE %s "
+        "FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED BY '\"' "
+        "LINES TERMINATED BY '\\n' %s(%s)" % (
+            preparer.format_table(table),
+            'IGNORE 1 LINES ' if header else '',
+            ', '.join(preparer.quote_identifier(c) for c in columns)))
+    return conn.execute(text(sql), path=path).rowcount
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Coalescing of small Insert messages into one transaction.
+
+When configured with
+
+    "coalesce": {"max_rows": 500, "max_ms": 50, "max_messages": 100}
+
+Insert messages for the same database and table are held until max_rows
+rows or max_messages messages are waiting, or max_ms milliseconds have
+passed since the first arrived. They are then inserted together. A
+message is left out with "coalesce": false in its parameters. Any other
+message for the database and table, or for the database when it names
+no table, first flushes the waiting batch so messages keep their order.
+"""
+
+import threading
+
+
+class Batch(object):
+    """
+    The messages waiting to be inserted into one table.
+    """
+
+    def __init__(self, key):
+        """
+        Creates an empty batch.
+
+        Parameters:
+            * key: The (database, table) the messages insert into
+        """
+        self.key = key
+        self.entries = []
+        self.rows = 0
+
+
+class Coalescer(object):
+    """
+    Groups Insert messages into batches per database and table.
+    """
+
+    def __init__(self, max_rows=500, max_ms=50, max_messages=100):
+        """
+        Creates the coalescer.
+
+        Parameters:
+            * max_rows: Rows after which a batch is flushed
+            * max_ms: Milliseconds after which a batch is flushed
+            * max_messages: Messages after which a batch is flushed
+        """
+        self.max_rows = max_rows
+        self.max_ms = max_ms
+        self.max_messages = max_messages
+        self._batches = {}
+        self._lock = threading.Lock()
+
+    def key(self, params):
+        """
+        Returns the (database, table) key of a message which can be
+        coalesced or None if it must be processed alone.
+
+        Parameters:
+            * params: The message parameters
+        """
+        if params.get('subcommand') != 'Insert':
+            return None
+        if not params.get('coalesce', True) or params.get('profile', False):
+            return None
+        # Messages choosing their own chunk size are left as they are
+        if 'chunk_size' in params:
+            return None
+        rows = params.get('rows', None)
+        if not isinstance(rows, list) or not rows or len(rows) >= (
+                self.max_rows):
+            return None
+        if 'database' not in params or 'name' not in params:
+            return None
+        return (params['database'], params['name'])
+
+    def add(self, key, entry, rows):
+        """
+        Adds a message to the batch for key. Returns (batch, first, full)
+        where first tells whether it started a new batch and full whether
+        the batch should be flushed now.
+
+        Parameters:
+            * key: The key returned by key
+            * entry: What to keep for the message
+            * rows: The number of rows in the message
+        """
+        with self._lock:
+            batch = self._batches.get(key, None)
+            first = batch is None
+            if first:
+                batch = self._batches[key] = Batch(key)
+            batch.entries.append(entry)
+            batch.rows += rows
+            full = (batch.rows >= self.max_rows or
+                    len(batch.entries) >= self.max_messages)
+            return (batch, first, full)
+
+    def pending(self, database, name=None):
+        """
+        Returns the batches waiting for a database, only the one for
+        table name when it is given.
+
+        Parameters:
+            * database: The database of the batches
+            * name: Optional table of the batch
+        """
+        with self._lock:
+            return [
+                batch for key, batch in self._batches.items()
+                if key[0] == database and name in (None, key[1])]
+
+    def take(self, batch):
+        """
+        Removes a batch and returns its entries, or an empty list if it
+        has already been taken.
+
+        Parameters:
+            * batch: The batch returned by add
+        """
+        with self._lock:
+            if self._batches.get(batch.key, None) is not batch:
+                return []
+            del self._batches[batch.key]
+            return batch.entries
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Compiles column specs into Columns.
+
+A column spec looks like:
+
+    {"type": "String", "length": 255, "nullable": false}
+
+"type" names a type in sqlalchemy.types or, written like
+"postgresql.INET", a type of one of the sqlalchemy.dialects. The type
+takes "length", "precision", "scale", "timezone" or "asdecimal" where
+it accepts them, and Enum takes its "values" and an optional
+"enum_name". Every other key is passed on to Column. Specs are never
+changed.
+"""
+
+import importlib
+import threading
+
+import sqlalchemy.dialects
+import sqlalchemy.types
+
+from sqlalchemy import Column
+from sqlalchemy.util import get_cls_kwargs
+
+
+#: Spec keys passed to the type
+TYPE_KEYS = ('length', 'precision', 'scale', 'timezone', 'asdecimal')
+
+#: Spec keys passed to Column
+COLUMN_KEYS = (
+    'autoincrement', 'default', 'doc', 'index', 'info', 'key', 'nullable',
+    'onupdate', 'primary_key', 'quote', 'server_default', 'server_onupdate',
+    'unique')
+
+_types = {}
+_types_lock = threading.Lock()
+
+
+def resolve_type(name):
+    """
+    Returns the type class a spec's "type" names, looking it up only
+    once. Raises ValueError if there is no such type.
+
+    Parameters:
+        * name: The type name, like "Integer" or "postgresql.INET"
+    """
+    with _types_lock:
+        type_class = _types.get(name, None)
+    if type_class is not None:
+        return type_class
+    module = sqlalchemy.types
+    attr = name
+    if isinstance(name, basestring) and '.' in name:
+        dialect, attr = name.split('.', 1)
+        if dialect not in sqlalchemy.dialects.__all__:
+            raise ValueError('Unknown dialect %s' % dialect)
+        module = importlib.import_module('sqlalchemy.dialects.' + dialect)
+    type_class = getattr(module, str(attr), None)
+    if not (isinstance(type_class, type) and
+            issubclass(type_class, sqlalchemy.types.TypeEngine)):
+        raise ValueError('Unknown type %s' % name)
+    with _types_lock:
+        _types[name] = type_class
+    return type_class
+
+
+def build_type(spec):
+    """
+    Returns the type instance for a column spec. Raises ValueError if
+    the spec is not valid.
+
+    Parameters:
+        * spec: The column spec
+    """
+    if 'type' not in spec:
+        raise ValueError('No type given')
+    type_class = resolve_type(spec['type'])
+    kwargs = dict((key, spec[key]) for key in TYPE_KEYS if key in spec)
+    # Types ignore arguments they do not take so check them here
+    unknown = set(kwargs) - get_cls_kwargs(type_class)
+    if unknown:
+        raise ValueError('%s does not take %s' % (
+            spec['type'], ', '.join(sorted(unknown))))
+    try:
+        if issubclass(type_class, sqlalchemy.types.Enum):
+            values = spec.get('values', None)
+            if not isinstance(values, list) or not values:
+                raise ValueError('Enum needs a list of values')
+            return type_class(
+                *values, name=spec.get('enum_name', None), **kwargs)
+        return type_class(**kwargs)
+    except TypeError, te:
+        raise ValueError('Invalid arguments for %s: %s' % (spec['type'], te))
+
+
+def build_column(name, spec, **kwargs):
+    """
+    Returns a Column built from a column spec. Raises ValueError if the
+    spec is not valid.
+
+    Parameters:
+        * name: The name of the column
+        * spec: The column spec
+        * kwargs: Extra keyword arguments for Column, these win over spec
+    """
+    if not isinstance(spec, dict):
+        raise ValueError('Column spec must be an object')
+    unknown = [
+        key for key in spec
+        if key not in COLUMN_KEYS and key not in TYPE_KEYS and
+        key not in ('type', 'values', 'enum_name')]
+    if unknown:
+        raise ValueError('Unknown keys %s' % ', '.join(sorted(unknown)))
+    column_kwargs = dict(
+        (key, spec[key]) for key in COLUMN_KEYS if key in spec)
+    column_kwargs.update(kwargs)
+    return Column(name, build_type(spec), **column_kwargs)
+
+
+def compile_columns(columns, **kwargs):
+    """
+    Returns a Column for every spec in a dict of column name to spec,
+    ordered by name. Every spec is checked before any is returned and a
+    ValueError names each column which is not valid.
+
+    Parameters:
+        * columns: Dict of column name to column spec
+        * kwargs: Extra keyword arguments for every Column
+    """
+    if not isinstance(columns, dict) or not columns:
+        raise ValueError('Columns must be an object of column specs')
+    compiled = []
+    errors = []
+    for name in sorted(columns):
+        try:
+            compiled.append(build_column(name, columns[name], **kwargs))
+        except ValueError, ve:
+            errors.append('%s: %s' % (name, ve))
+    if errors:
+        raise ValueError('Invalid column spec. %s' % '; '.join(errors))
+    return compiled
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Applies a set of column changes to a table in as few passes as the
+database allows.
+
+Changes are tuples of:
+
+* ('add', Column)
+* ('alter', column_name, dict of alembic alter_column keyword arguments)
+* ('drop', column_name)
+"""
+
+from sqlalchemy import Table, MetaData
+
+from alembic.migration import MigrationContext
+from alembic.operations import Operations
+
+
+#: Dialects which accept several comma separated clauses in one ALTER TABLE
+MULTI_CLAUSE_DIALECTS = ('postgresql', 'mysql')
+
+
+class _Recorder(object):
+    """
+    Stands in for a connection and keeps the DDL alembic would execute.
+    """
+
+    def __init__(self, dialect):
+        """
+        Creates an empty recorder.
+
+        Parameters:
+            * dialect: The dialect the DDL will be compiled for
+        """
+        self.dialect = dialect
+        self.constructs = []
+
+    def execute(self, construct, *multiparams, **params):
+        """
+        Records a construct instead of executing it.
+        """
+        self.constructs.append(construct)
+
+
+def _apply(ops, changes, table_name=None):
+    """
+    Calls the alembic operation for every change. When table_name is
+    None ops is expected to be batch operations which already know the
+    table.
+    """
+    table_args = () if table_name is None else (table_name, )
+    for change in changes:
+        if change[0] == 'add':
+            ops.add_column(*(table_args + (change[1], )))
+        elif change[0] == 'alter':
+            ops.alter_column(*(table_args + (change[1], )), **change[2])
+        elif change[0] == 'drop':
+            ops.drop_column(*(table_args + (change[1], )))
+        else:
+            raise ValueError('Unknown column change %s' % change[0])
+
+
+def render_statements(dialect, table_name, changes):
+    """
+    Returns the DDL statements for changes as strings. On dialects in
+    MULTI_CLAUSE_DIALECTS every ALTER TABLE for the table is combined into
+    one statement so the table is only rewritten once.
+
+    Parameters:
+        * dialect: The dialect to render for
+        * table_name: The table being changed
+        * changes: The list of changes
+    """
+    recorder = _Recorder(dialect)
+    _apply(
+        Operations(MigrationContext(dialect, recorder, {})),
+        changes, table_name)
+    statements = [
+        unicode(construct.compile(dialect=dialect)).strip()
+        for construct in recorder.constructs]
+    if dialect.name not in MULTI_CLAUSE_DIALECTS:
+        return statements
+
+    prefix = 'ALTER TABLE %s ' % dialect.identifier_preparer.format_table(
+        Table(table_name, MetaData()))
+    clauses = []
+    others = []
+    for statement in statements:
+        if statement.startswith(prefix):
+            clauses.append(statement[len(prefix):])
+        else:
+            others.append(statement)
+    if clauses:
+        return [prefix + ', '.join(clauses)] + others
+    return others
+
+
+def apply_changes(conn, table_name, changes):
+    """
+    Applies changes to a table and returns the number of statements sent.
+
+    SQLite can only add columns with ALTER TABLE, so there alembic's batch
+    mode is used which copies the table once for all the changes. Other
+    databases get the statements from render_statements.
+
+    Parameters:
+        * conn: The connection to run the DDL on
+        * table_name: The table being changed
+        * changes: The list of changes
+    """
+    if conn.dialect.name == 'sqlite':
+        ops = Operations(MigrationContext.configure(conn))
+        with ops.batch_alter_table(table_name) as batch_ops:
+            _apply(batch_ops, changes)
+        return 1
+    statements = render_statements(conn.dialect, table_name, changes)
+    trans = conn.begin()
+    try:
+        for statement in statements:
+            conn.execute(statement)
+        trans.commit()
+    except:
+        trans.rollback()
+        raise
+    return len(statements)
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Long lived engines and connection pools for the SQL worker.
+"""
+
+import threading
+import time
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import DisconnectionError
+
+from replugin.sqlworker.replicas import ReplicaSet
+
+
+#: Maps keys in a database's "pool" configuration to create_engine kwargs
+POOL_OPTIONS = {
+    'size': 'pool_size',
+    'max_overflow': 'max_overflow',
+    'recycle': 'pool_recycle',
+    'timeout': 'pool_timeout',
+}
+
+
+def _ping_connection(dbapi_connection, connection_record, connection_proxy):
+    """
+    Pool checkout listener which verifies a connection is still alive.
+
+    Raising DisconnectionError makes the pool throw the connection away
+    and retry the checkout with a fresh one.
+    """
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute('SELECT 1')
+    except Exception:
+        raise DisconnectionError()
+    finally:
+        cursor.close()
+
+
+class EngineRegistry(object):
+    """
+    Holds one engine (and so one connection pool) per configured database.
+
+    Engines are created the first time a database is requested and are
+    then reused for the life of the worker.
+    """
+
+    def __init__(self, databases, metrics=None, logger=None, profiler=None):
+        """
+        Creates the registry.
+
+        Parameters:
+            * databases: The databases section of the worker configuration
+            * metrics: Optional Metrics instance to time statements with
+            * logger: Optional logger to report unhealthy replicas to
+            * profiler: Optional Profiler to report statement timings to
+        """
+        self._databases = databases
+        self._metrics = metrics
+        self._profiler = profiler
+        self._logger = logger
+        self._engines = {}
+        self._replicas = {}
+        self._lock = threading.Lock()
+
+    def get(self, db_name):
+        """
+        Returns the engine for db_name, creating it if needed.
+
+        Raises KeyError if db_name is not configured.
+
+        Parameters:
+            * db_name: The name of the database key in the configuration file
+        """
+        engine = self._engines.get(db_name, None)
+        if engine is not None:
+            return engine
+        with self._lock:
+            if db_name not in self._engines:
+                self._engines[db_name] = self._create_engine(
+                    self._databases[db_name])
+            return self._engines[db_name]
+
+    def replicas(self, db_name):
+        """
+        Returns the ReplicaSet of db_name, or None when it has no
+        replicas configured.
+
+        Raises KeyError if db_name is not configured.
+
+        Parameters:
+            * db_name: The name of the database key in the configuration file
+        """
+        connection_info = self._databases[db_name]
+        if not connection_info.get('replicas', None):
+            return None
+        with self._lock:
+            if db_name not in self._replicas:
+                self._replicas[db_name] = ReplicaSet(
+                    connection_info, self._create_engine, self._logger)
+            return self._replicas[db_name]
+
+    def _create_engine(self, connection_info):
+        """
+        Creates an engine from a single database configuration entry.
+
+        Parameters:
+            * connection_info: The configuration entry for the database
+        """
+        conn_kwargs = dict(connection_info.get('kwargs', {}))
+        pool_info = connection_info.get('pool', {})
+        for key, kwarg in POOL_OPTIONS.items():
+            if key in pool_info:
+                conn_kwargs[kwarg] = pool_info[key]
+        engine = create_engine(connection_info['uri'], **conn_kwargs)
+        if pool_info.get('pre_ping', False):
+            event.listen(engine.pool, 'checkout', _ping_connection)
+        if self._metrics is not None or self._profiler is not None:
+            event.listen(
+                engine, 'before_cursor_execute', self._before_execute)
+            event.listen(
+                engine, 'after_cursor_execute', self._after_execute)
+            event.listen(engine, 'dbapi_error', self._execute_failed)
+        return engine
+
+    def _before_execute(self, conn, cursor, statement, parameters, context,
+                        executemany):
+        """
+        Notes when a statement was sent to the database.
+        """
+        conn.info.setdefault('sqlworker_start', []).append(time.time())
+
+    def _after_execute(self, conn, cursor, statement, parameters, context,
+                       executemany):
+        """
+        Records how long a statement took and how many rows it changed.
+        """
+        elapsed = time.time() - conn.info['sqlworker_start'].pop()
+        if self._profiler is not None:
+            self._profiler.statement(
+                statement, elapsed, executemany, cursor.rowcount)
+        if self._metrics is None:
+            return
+        self._metrics.observe('execute', elapsed)
+        if context is not None and (
+                context.isinsert or context.isupdate or context.isdelete):
+            if cursor.rowcount > 0:
+                self._metrics.incr('sqlworker_rows_total', cursor.rowcount)
+
+    def _execute_failed(self, conn, cursor, statement, parameters, context,
+                        exception):
+        """
+        Forgets the start time of a statement which failed.
+        """
+        starts = conn.info.get('sqlworker_start', None)
+        if starts:
+            starts.pop()
+
+    def dispose(self):
+        """
+        Closes every pooled connection held by the registry.
+        """
+        with self._lock:
+            for engine in self._engines.values():
+                engine.dispose()
+            for replicas in self._replicas.values():
+                replicas.dispose()
+            self._engines = {}
+            self._replicas = {}
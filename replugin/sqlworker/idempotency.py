@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Results of completed messages kept by correlation id and body.
+
+With late acks a message is redelivered when the worker dies before
+acking it. Looking the message up here first lets the worker reply with
+the result it already has instead of running the message again. As
+correlation ids may be reused, a result is kept under the correlation id
+together with a digest of the message body, see message_key, so only a
+redelivery of the very same message is replayed. Configured with either
+
+    "idempotency": {"path": "/var/lib/sqlworker/results.db", "ttl": 86400}
+
+for a local SQLite file or
+
+    "idempotency": {"database": "testdb", "ttl": 86400}
+
+for a table in one of the configured databases.
+"""
+
+import hashlib
+import json
+import threading
+import time
+
+from sqlalchemy import (
+    Column, Float, MetaData, String, Table, Text, create_engine)
+from sqlalchemy.exc import IntegrityError
+
+
+#: Default name of the table holding the results
+TABLE_NAME = 'sqlworker_results'
+
+#: Results stored between each purge of expired ones
+PURGE_EVERY = 1000
+
+
+def message_key(corr_id, body):
+    """
+    Returns the key a message's result is stored under.
+
+    Parameters:
+        * corr_id: The correlation id of the message
+        * body: The message body structure
+    """
+    digest = hashlib.sha1(json.dumps(body, sort_keys=True)).hexdigest()
+    return '%s:%s' % (corr_id, digest)
+
+
+class ResultStore(object):
+    """
+    Stores the result of each completed message by its message_key.
+    """
+
+    def __init__(self, engine, ttl=None, table_name=TABLE_NAME):
+        """
+        Creates the store, creating its table if needed.
+
+        Parameters:
+            * engine: The engine holding the table, or a SQLite file path
+            * ttl: Optional seconds a result is kept for
+            * table_name: The name of the table holding the results
+        """
+        if isinstance(engine, basestring):
+            engine = create_engine('sqlite:///%s' % engine)
+        self._engine = engine
+        self._ttl = ttl
+        self._table = Table(
+            table_name, MetaData(),
+            Column('message_key', String(300), primary_key=True),
+            Column('status', String(16), nullable=False),
+            Column('data', Text),
+            Column('created', Float, nullable=False, index=True))
+        self._table.create(engine, checkfirst=True)
+        self._stored = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Returns (status, data) stored for key or None if there is
+        nothing, or nothing recent enough.
+
+        Parameters:
+            * key: The message_key of the message
+        """
+        row = self._engine.execute(
+            self._table.select().where(
+                self._table.c.message_key == key)).first()
+        if row is None:
+            return None
+        if self._ttl is not None and row.created < time.time() - self._ttl:
+            return None
+        return (row.status, json.loads(row.data))
+
+    def put(self, key, status, data):
+        """
+        Stores the result of a message, replacing any older one.
+
+        Parameters:
+            * key: The message_key of the message
+            * status: The status sent back
+            * data: The JSON serializable data sent back
+        """
+        values = {
+            'status': status,
+            'data': json.dumps(data),
+            'created': time.time()}
+        try:
+            self._engine.execute(
+                self._table.insert(), message_key=key, **values)
+        except IntegrityError:
+            self._engine.execute(
+                self._table.update().where(
+                    self._table.c.message_key == key), **values)
+        with self._lock:
+            self._stored += 1
+            purge = self._stored % PURGE_EVERY == 0
+        if purge:
+            self.purge()
+
+    def purge(self):
+        """
+        Deletes the results older than the ttl.
+        """
+        if self._ttl is not None:
+            self._engine.execute(self._table.delete().where(
+                self._table.c.created < time.time() - self._ttl))
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Timing and counter metrics for the SQL worker.
+"""
+
+import threading
+import time
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from contextlib import contextmanager
+
+
+#: Upper bounds, in seconds, of the timing histogram buckets
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+           10.0, 30.0, 60.0)
+
+#: Help text for each metric family
+FAMILIES = {
+    'sqlworker_phase_seconds': (
+        'histogram', 'Time spent in each phase of processing a message.'),
+    'sqlworker_messages_total': (
+        'counter', 'Messages processed by final status.'),
+    'sqlworker_errors_total': (
+        'counter', 'Messages which failed.'),
+    'sqlworker_rows_total': (
+        'counter', 'Rows affected by statements.'),
+    'sqlworker_published_bytes_total': (
+        'counter', 'Bytes of message bodies published to the bus.'),
+}
+
+
+def _labels_text(labels):
+    """
+    Renders a sorted tuple of label pairs in the exposition format.
+    """
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+        for k, v in labels)
+
+
+class Metrics(object):
+    """
+    Thread safe store of histograms and counters.
+
+    Labels set with bind are added to everything recorded by the same
+    thread until clear is called, so code deep in a subcommand does not
+    need to know which message it is working for.
+    """
+
+    def __init__(self):
+        """
+        Creates an empty store.
+        """
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._histograms = {}
+        self._counters = {}
+
+    def bind(self, **labels):
+        """
+        Adds labels to everything this thread records.
+        """
+        context = dict(getattr(self._local, 'labels', {}))
+        context.update(labels)
+        self._local.labels = context
+
+    def clear(self):
+        """
+        Removes the labels bound by this thread.
+        """
+        self._local.labels = {}
+
+    def _key(self, name, labels):
+        """
+        Returns the storage key for a metric name and its labels.
+        """
+        merged = dict(getattr(self._local, 'labels', {}))
+        merged.update(labels)
+        return (name, tuple(sorted(merged.items())))
+
+    def observe(self, phase, seconds, **labels):
+        """
+        Records how long a phase took.
+
+        Parameters:
+            * phase: The name of the phase
+            * seconds: The time the phase took
+            * labels: Extra labels for the observation
+        """
+        labels['phase'] = phase
+        key = self._key('sqlworker_phase_seconds', labels)
+        with self._lock:
+            histogram = self._histograms.get(key, None)
+            if histogram is None:
+                histogram = self._histograms[key] = {
+                    'buckets': [0] * len(BUCKETS), 'count': 0, 'sum': 0.0}
+            for index, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    histogram['buckets'][index] += 1
+            histogram['count'] += 1
+            histogram['sum'] += seconds
+
+    @contextmanager
+    def timer(self, phase, **labels):
+        """
+        Context manager which observes the time spent inside it.
+
+        Parameters:
+            * phase: The name of the phase
+            * labels: Extra labels for the observation
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(phase, time.time() - start, **labels)
+
+    def incr(self, name, amount=1, **labels):
+        """
+        Adds amount to a counter.
+
+        Parameters:
+            * name: The metric name
+            * amount: How much to add
+            * labels: Extra labels for the counter
+        """
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def snapshot(self):
+        """
+        Returns a JSON serializable copy of every metric.
+        """
+        with self._lock:
+            histograms = [
+                {'name': name, 'labels': dict(labels),
+                 'count': h['count'], 'sum': h['sum'],
+                 'buckets': dict(zip(
+                     [str(b) for b in BUCKETS], h['buckets']))}
+                for (name, labels), h in sorted(self._histograms.items())]
+            counters = [
+                {'name': name, 'labels': dict(labels), 'value': value}
+                for (name, labels), value in sorted(self._counters.items())]
+        return {'histograms': histograms, 'counters': counters}
+
+    def render(self):
+        """
+        Returns every metric in the Prometheus text exposition format.
+        """
+        lines = []
+        with self._lock:
+            series = {}
+            for (name, labels), h in self._histograms.items():
+                series.setdefault(name, []).append((labels, h))
+            for (name, labels), value in self._counters.items():
+                series.setdefault(name, []).append((labels, value))
+            for name in sorted(series):
+                kind, help_text = FAMILIES.get(name, ('untyped', name))
+                lines.append('# HELP %s %s' % (name, help_text))
+                lines.append('# TYPE %s %s' % (name, kind))
+                for labels, value in sorted(series[name]):
+                    if kind != 'histogram':
+                        lines.append('%s%s %s' % (
+                            name, _labels_text(labels), value))
+                        continue
+                    for bound, count in zip(BUCKETS, value['buckets']):
+                        lines.append('%s_bucket%s %s' % (
+                            name, _labels_text(labels + (('le', bound),)),
+                            count))
+                    lines.append('%s_bucket%s %s' % (
+                        name, _labels_text(labels + (('le', '+Inf'),)),
+                        value['count']))
+                    lines.append('%s_sum%s %s' % (
+                        name, _labels_text(labels), value['sum']))
+                    lines.append('%s_count%s %s' % (
+                        name, _labels_text(labels), value['count']))
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, host, port):
+        """
+        Serves render() over HTTP from a daemon thread and returns the
+        server.
+
+        Parameters:
+            * host: The address to listen on
+            * port: The port to listen on
+        """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                body = metrics.render()
+                self.send_response(200)
+                self.send_header(
+                    'Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer((host, port), Handler)
+        thread = threading.Thread(
+            target=server.serve_forever, name='sqlworker-metrics')
+        thread.daemon = True
+        thread.start()
+        return server
@@ -0,0 +1,428 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Column changes made without holding a long lock on the table.
+
+Instead of altering the table in place:
+
+1. An empty shadow table is created like the table and altered.
+2. Triggers copy every write to the table into the shadow table.
+3. The existing rows are copied over in chunks by primary key, the
+   chunk size adapting to how long chunks take and how far behind the
+   replicas are.
+4. The tables are swapped by renaming them at once, the old table and
+   the triggers are dropped.
+
+This works on MySQL and PostgreSQL 9.5 or later for tables with a
+single column primary key. Neither database copies foreign keys to the
+shadow table, and foreign keys or PostgreSQL views of other tables
+would follow the old table, so tables with either are refused.
+"""
+
+import time
+
+from sqlalchemy import func, inspect, select
+
+from replugin.sqlworker.ddl import apply_changes
+
+
+#: Dialects with an online mode
+ONLINE_DIALECTS = ('mysql', 'postgresql')
+
+#: Longest wait in seconds between checks of a lagging replica
+MAX_LAG_WAIT = 30
+
+
+class Throttle(object):
+    """
+    Sizes the chunks of a copy and paces them.
+    """
+
+    def __init__(self, chunk_size=1000, chunk_time=0.5, chunk_sleep=0,
+                 max_lag=None, lag=None, min_chunk=10, max_chunk=100000,
+                 sleep=time.sleep):
+        """
+        Creates the throttle.
+
+        Parameters:
+            * chunk_size: The number of rows in the first chunk
+            * chunk_time: Seconds a chunk should take
+            * chunk_sleep: Seconds to wait between chunks
+            * max_lag: Optional replica lag in seconds to wait out
+            * lag: Optional callable returning the replica lag or None
+            * min_chunk: The fewest rows in a chunk
+            * max_chunk: The most rows in a chunk
+            * sleep: The function used to wait
+        """
+        self.chunk_size = chunk_size
+        self._chunk_time = chunk_time
+        self._chunk_sleep = chunk_sleep
+        self._max_lag = max_lag
+        self._lag = lag
+        self._min_chunk = min_chunk
+        self._max_chunk = max_chunk
+        self._sleep = sleep
+
+    def _clamp(self, size):
+        """
+        Returns size kept between min_chunk and max_chunk.
+        """
+        return int(max(self._min_chunk, min(self._max_chunk, size)))
+
+    def after_chunk(self, rows, seconds):
+        """
+        Resizes the next chunk from how long this one took and waits
+        before it may start.
+
+        Parameters:
+            * rows: The number of rows the chunk copied
+            * seconds: How long the chunk took
+        """
+        if self._chunk_time and rows and seconds > 0:
+            # Move half way to the size which would take chunk_time
+            wanted = rows / seconds * self._chunk_time
+            self.chunk_size = self._clamp((self.chunk_size + wanted) / 2.0)
+        wait = 1
+        while self._max_lag is not None and self._lag is not None:
+            lag = self._lag()
+            if lag is None or lag <= self._max_lag:
+                break
+            self.chunk_size = self._clamp(self.chunk_size / 2)
+            self._sleep(wait)
+            wait = min(wait * 2, MAX_LAG_WAIT)
+        if self._chunk_sleep:
+            self._sleep(self._chunk_sleep)
+
+
+def _quoter(dialect):
+    """
+    Returns a function quoting identifiers for dialect where needed.
+    """
+    preparer = dialect.identifier_preparer
+    return lambda name: preparer.quote(name, None)
+
+
+def trigger_statements(dialect, table_name, shadow_name, columns, pk):
+    """
+    Returns the statements creating the triggers which copy writes on a
+    table to its shadow table.
+
+    Parameters:
+        * dialect: The dialect of the database
+        * table_name: The table being changed
+        * shadow_name: The shadow table
+        * columns: The names of the columns both tables have
+        * pk: The name of the primary key column
+    """
+    quote = _quoter(dialect)
+    table, shadow = quote(table_name), quote(shadow_name)
+    names = ', '.join(quote(name) for name in columns)
+    new_values = ', '.join('NEW.%s' % quote(name) for name in columns)
+    key = quote(pk)
+    if dialect.name == 'mysql':
+        return [
+            'CREATE TRIGGER %s AFTER INSERT ON %s FOR EACH ROW '
+            'REPLACE INTO %s (%s) VALUES (%s)' % (
+                quote('%s_osc_ins' % table_name), table, shadow, names,
+                new_values),
+            'CREATE TRIGGER %s AFTER UPDATE ON %s FOR EACH ROW BEGIN '
+            'DELETE IGNORE FROM %s WHERE %s <=> OLD.%s; '
+            'REPLACE INTO %s (%s) VALUES (%s); END' % (
+                quote('%s_osc_upd' % table_name), table, shadow, key, key,
+                shadow, names, new_values),
+            'CREATE TRIGGER %s AFTER DELETE ON %s FOR EACH ROW '
+            'DELETE IGNORE FROM %s WHERE %s <=> OLD.%s' % (
+                quote('%s_osc_del' % table_name), table, shadow, key, key),
+        ]
+    function = quote('%s_osc' % table_name)
+    # Like REPLACE, as a row being copied is not seen by the DELETE
+    updates = ', '.join(
+        '%s = EXCLUDED.%s' % (quote(name), quote(name))
+        for name in columns if name != pk)
+    on_conflict = 'ON CONFLICT (%s) DO %s' % (
+        key, 'UPDATE SET %s' % updates if updates else 'NOTHING')
+    return [
+        'CREATE FUNCTION %s() RETURNS trigger AS $$ BEGIN '
+        'IF TG_OP IN (\'UPDATE\', \'DELETE\') THEN '
+        'DELETE FROM %s WHERE %s = OLD.%s; END IF; '
+        'IF TG_OP IN (\'INSERT\', \'UPDATE\') THEN '
+        'INSERT INTO %s (%s) VALUES (%s) %s; END IF; '
+        'RETURN NULL; END $$ LANGUAGE plpgsql' % (
+            function, shadow, key, key, shadow, names, new_values,
+            on_conflict),
+        'CREATE TRIGGER %s AFTER INSERT OR UPDATE OR DELETE ON %s '
+        'FOR EACH ROW EXECUTE PROCEDURE %s()' % (
+            function, table, function),
+    ]
+
+
+def drop_trigger_statements(dialect, table_name, on_table):
+    """
+    Returns the statements dropping the triggers of trigger_statements.
+
+    Parameters:
+        * dialect: The dialect of the database
+        * table_name: The table the triggers were made for
+        * on_table: The name the table has now
+    """
+    quote = _quoter(dialect)
+    if dialect.name == 'mysql':
+        return [
+            'DROP TRIGGER IF EXISTS %s' % quote(
+                '%s_osc_%s' % (table_name, kind))
+            for kind in ('ins', 'upd', 'del')]
+    function = quote('%s_osc' % table_name)
+    return [
+        'DROP TRIGGER IF EXISTS %s ON %s' % (function, quote(on_table)),
+        'DROP FUNCTION IF EXISTS %s()' % function,
+    ]
+
+
+def dependents(conn, table):
+    """
+    Returns the names of the tables with foreign keys to table and, on
+    PostgreSQL, of the views using it.
+
+    Parameters:
+        * conn: The connection to inspect with
+        * table: The reflected Table
+    """
+    inspector = inspect(conn)
+    names = []
+    for name in inspector.get_table_names(schema=table.schema):
+        if name != table.name and any(
+                fk['referred_table'] == table.name
+                for fk in inspector.get_foreign_keys(
+                    name, schema=table.schema)):
+            names.append(name)
+    if conn.dialect.name == 'postgresql':
+        names.extend(row[0] for row in conn.execute(
+            'SELECT DISTINCT r.ev_class::regclass::text FROM pg_depend d '
+            'JOIN pg_rewrite r ON d.objid = r.oid '
+            'WHERE d.refobjid = %s::regclass AND r.ev_class <> d.refobjid',
+            (_quoter(conn.dialect)(table.name), )))
+    return names
+
+
+class OnlineChange(object):
+    """
+    Applies column changes to a table through a shadow table.
+    """
+
+    def __init__(self, conn, table, changes, throttle, output, logger=None,
+                 keep_old=False):
+        """
+        Prepares the change.
+
+        Parameters:
+            * conn: The connection to use
+            * table: The reflected Table to change
+            * changes: The column changes, see replugin.sqlworker.ddl
+            * throttle: The Throttle pacing the copy
+            * output: The output object back to the user
+            * logger: Optional logger
+            * keep_old: Whether to keep the old table as _<name>_old
+        """
+        pk = list(table.primary_key.columns)
+        if len(pk) != 1:
+            raise ValueError(
+                'Online changes need a single column primary key on %s' % (
+                    table.name))
+        if table.foreign_keys:
+            raise ValueError(
+                'Online changes would lose the foreign keys of %s' % (
+                    table.name))
+        referenced_by = dependents(conn, table)
+        if referenced_by:
+            raise ValueError(
+                'Online changes would leave %s pointing at the old %s' % (
+                    ', '.join(sorted(referenced_by)), table.name))
+        self._conn = conn
+        self._dialect = conn.dialect
+        self._quote = _quoter(conn.dialect)
+        self._table = table
+        self._pk = pk[0]
+        self._changes = changes
+        self._throttle = throttle
+        self._output = output
+        self._logger = logger
+        self._keep_old = keep_old
+        self.shadow_name = '_%s_new' % table.name
+        self.old_name = '_%s_old' % table.name
+        dropped = set(c[1] for c in changes if c[0] == 'drop')
+        self.columns = [c.name for c in table.c if c.name not in dropped]
+        if self._pk.name in dropped:
+            raise ValueError('The primary key of %s can not be dropped' % (
+                table.name))
+
+    def _execute(self, statements):
+        """
+        Executes statements in one transaction.
+        """
+        trans = self._conn.begin()
+        try:
+            for statement in statements:
+                self._conn.execute(statement)
+            trans.commit()
+        except:
+            trans.rollback()
+            raise
+
+    def run(self):
+        """
+        Makes the change and returns the number of rows copied.
+        """
+        table = self._quote(self._table.name)
+        shadow = self._quote(self.shadow_name)
+        if self._dialect.name == 'mysql':
+            create = 'CREATE TABLE %s LIKE %s' % (shadow, table)
+        else:
+            create = 'CREATE TABLE %s (LIKE %s INCLUDING ALL)' % (
+                shadow, table)
+        self._execute([create])
+        try:
+            apply_changes(self._conn, self.shadow_name, self._changes)
+            self._execute(trigger_statements(
+                self._dialect, self._table.name, self.shadow_name,
+                self.columns, self._pk.name))
+            copied = self._copy()
+            self._swap()
+        except:
+            self._cleanup()
+            raise
+        if not self._keep_old:
+            try:
+                self._execute(['DROP TABLE %s' % self._quote(self.old_name)])
+            except Exception, ex:
+                # The change itself is done, only the old copy is left
+                self._output.info('Kept %s as it could not be dropped: %s' % (
+                    self.old_name, ex))
+        return copied
+
+    def _copy(self):
+        """
+        Copies the rows into the shadow table a chunk at a time.
+        """
+        pk = self._pk
+        low, high = self._conn.execute(
+            select([func.min(pk), func.max(pk)])).first()
+        names = ', '.join(self._quote(name) for name in self.columns)
+        copy = 'INSERT %sINTO %s (%s) SELECT %s FROM %s WHERE %s %%s ' \
+            'AND %s <= %%s%s' % (
+                'IGNORE ' if self._dialect.name == 'mysql' else '',
+                self._quote(self.shadow_name), names, names,
+                self._quote(self._table.name), self._quote(pk.name),
+                self._quote(pk.name),
+                ' LOCK IN SHARE MODE' if self._dialect.name == 'mysql'
+                else ' ON CONFLICT DO NOTHING')
+        paramstyle = self._dialect.paramstyle
+        marker = '%s' if paramstyle in ('format', 'pyformat') else '?'
+        copied = 0
+        last = None
+        while True:
+            keys = select([pk]).order_by(pk).limit(
+                self._throttle.chunk_size)
+            if last is not None:
+                keys = keys.where(pk > last)
+            upper = self._conn.execute(
+                select([func.max(keys.alias('chunk').c[pk.name])])).scalar()
+            if upper is None:
+                return copied
+            start = time.time()
+            if last is None:
+                statement = copy % ('>= ' + marker, marker)
+                bounds = (low, upper)
+            else:
+                statement = copy % ('> ' + marker, marker)
+                bounds = (last, upper)
+            trans = self._conn.begin()
+            try:
+                rows = self._conn.execute(statement, bounds).rowcount
+                trans.commit()
+            except:
+                trans.rollback()
+                raise
+            copied += max(rows, 0)
+            last = upper
+            self._progress(copied, low, high, upper)
+            self._throttle.after_chunk(rows, time.time() - start)
+
+    def _progress(self, copied, low, high, upper):
+        """
+        Reports how far the copy has got.
+        """
+        try:
+            done = ' (%d%%)' % (
+                100 * (float(upper) - low) / max(float(high) - low, 1))
+        except (TypeError, ValueError):
+            done = ''
+        self._output.info('Copied %s rows of %s into %s%s.' % (
+            copied, self._table.name, self.shadow_name, done))
+
+    def _swap(self):
+        """
+        Puts the shadow table in place of the table.
+        """
+        table = self._quote(self._table.name)
+        shadow = self._quote(self.shadow_name)
+        old = self._quote(self.old_name)
+        drop_triggers = drop_trigger_statements(
+            self._dialect, self._table.name, self.old_name)
+        if self._dialect.name == 'mysql':
+            # One RENAME TABLE swaps both names at once
+            self._execute(['RENAME TABLE %s TO %s, %s TO %s' % (
+                table, old, shadow, table)])
+            self._execute(drop_triggers)
+        else:
+            statements = [
+                'LOCK TABLE %s IN ACCESS EXCLUSIVE MODE' % table,
+                'ALTER TABLE %s RENAME TO %s' % (table, old),
+                'ALTER TABLE %s RENAME TO %s' % (shadow, table),
+            ] + drop_triggers
+            trans = self._conn.begin()
+            try:
+                for statement in statements:
+                    self._conn.execute(statement)
+                # Serial sequences must outlive the old table
+                for name in self.columns:
+                    sequence = self._conn.execute(
+                        'SELECT pg_get_serial_sequence(%s, %s)',
+                        (old, name)).scalar()
+                    if sequence:
+                        self._conn.execute(
+                            'ALTER SEQUENCE %s OWNED BY %s.%s' % (
+                                sequence, table, self._quote(name)))
+                trans.commit()
+            except:
+                trans.rollback()
+                raise
+        self._output.info('Swapped %s into place of %s.' % (
+            self.shadow_name, self._table.name))
+
+    def _cleanup(self):
+        """
+        Drops the triggers and the shadow table after a failure.
+        """
+        try:
+            self._execute(drop_trigger_statements(
+                self._dialect, self._table.name, self._table.name))
+            self._execute(
+                ['DROP TABLE IF EXISTS %s' % self._quote(self.shadow_name)])
+        except Exception, ex:
+            if self._logger is not None:
+                self._logger.error(
+                    'Unable to clean up the online change of %s: %s' % (
+                        self._table.name, ex))
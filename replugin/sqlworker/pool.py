@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Bounded thread pool used to process messages concurrently.
+"""
+
+import threading
+
+from replugin.sqlworker.scheduler import FairScheduler
+
+
+class WorkerPool(object):
+    """
+    Runs jobs on a fixed number of threads while keeping the number of
+    jobs running against any one database under its cap. Which job runs
+    next is decided by a FairScheduler.
+    """
+
+    def __init__(self, size, per_database=None, default_per_database=None,
+                 logger=None, weights=None, default_weight=1,
+                 fast_lane_burst=8):
+        """
+        Creates the pool. Threads are not started until start is called.
+
+        Parameters:
+            * size: The number of worker threads
+            * per_database: Optional dict of database name to concurrency cap
+            * default_per_database: Optional cap for databases not listed
+            * logger: Optional logger to report job failures to
+            * weights: Optional dict of database name to share weight
+            * default_weight: Weight of databases not in weights
+            * fast_lane_burst: Most fast lane jobs run in a row while
+              other jobs wait
+        """
+        self.size = size
+        self._logger = logger
+        self._scheduler = FairScheduler(
+            weights, default_weight, per_database, default_per_database,
+            fast_lane_burst)
+        self._threads = []
+
+    @property
+    def pending(self):
+        """
+        The number of submitted jobs which have not finished yet.
+        """
+        return self._scheduler.unfinished
+
+    def start(self):
+        """
+        Starts the worker threads.
+        """
+        for i in range(self.size):
+            thread = threading.Thread(
+                target=self._run, name='sqlworker-%s' % i)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """
+        Lets the queued jobs finish then stops the worker threads.
+        """
+        self._scheduler.join()
+        self._scheduler.stop(len(self._threads))
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def submit(self, db_name, func, *args, **kwargs):
+        """
+        Queues func to be called with args and kwargs on a worker thread.
+
+        Parameters:
+            * db_name: The database the job targets, used for the caps
+            * func: The callable to run
+            * args: Positional arguments for func
+            * kwargs: Keyword arguments for func
+        """
+        self.schedule(db_name, 'normal', False, func, *args, **kwargs)
+
+    def schedule(self, db_name, cost, fast, func, *args, **kwargs):
+        """
+        Queues func like submit with an explicit cost class and lane.
+
+        Parameters:
+            * db_name: The database the job targets, used for the caps
+            * cost: The cost class of the job, see scheduler.COST_UNITS
+            * fast: Whether the job goes in the fast lane
+            * func: The callable to run
+            * args: Positional arguments for func
+            * kwargs: Keyword arguments for func
+        """
+        self._scheduler.put(
+            db_name, (db_name, func, args, kwargs), cost, fast)
+
+    def join(self):
+        """
+        Blocks until every submitted job has finished.
+        """
+        self._scheduler.join()
+
+    def _run(self):
+        """
+        Worker thread loop.
+        """
+        while True:
+            entry = self._scheduler.get()
+            if entry is None:
+                return
+            try:
+                self._call(entry[1])
+            finally:
+                self._scheduler.done(entry[0])
+
+    def _call(self, job):
+        """
+        Runs one job, logging rather than raising any error.
+        """
+        db_name, func, args, kwargs = job
+        try:
+            func(*args, **kwargs)
+        except Exception, ex:
+            if self._logger is not None:
+                self._logger.error(
+                    'Unhandled error processing a message for %s: %s' % (
+                        db_name, ex))
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Builds where clauses from the "where" structure of a message.
+
+A where is either a dict, whose entries are all required (AND), or a
+non-empty list of such dicts of which any may match (OR). An empty dict
+matches every row. Each dict maps a column name to one of:
+
+* a scalar: the column must equal it
+* a list: the column must be one of its values
+* a dict of operators to values, all of which must hold. The operators
+  are eq, ne, lt, lte, gt, gte, in, not_in, like, between (a two item
+  list) and is_null (true or false).
+"""
+
+from sqlalchemy import and_, or_, bindparam
+
+
+#: Operators and how they build their clause from a column, the given
+#: value and a function making bind parameters
+OPERATORS = {
+    'eq': lambda col, val, bind: col == bind(col, val),
+    'ne': lambda col, val, bind: col != bind(col, val),
+    'lt': lambda col, val, bind: col < bind(col, val),
+    'lte': lambda col, val, bind: col <= bind(col, val),
+    'gt': lambda col, val, bind: col > bind(col, val),
+    'gte': lambda col, val, bind: col >= bind(col, val),
+    'in': lambda col, val, bind: col.in_([bind(col, v) for v in val]),
+    'not_in': lambda col, val, bind: ~col.in_([bind(col, v) for v in val]),
+    'like': lambda col, val, bind: col.like(bind(col, val)),
+    'between': lambda col, val, bind: col.between(
+        bind(col, val[0]), bind(col, val[1])),
+    'is_null': lambda col, val, bind: (
+        col.is_(None) if val else col.isnot(None)),
+}
+
+
+class _Params(object):
+    """
+    Hands out bind parameters named in the order they are asked for, so
+    two wheres of the same shape get the same names.
+    """
+
+    def __init__(self, prefix):
+        """
+        Creates an empty set of parameters.
+
+        Parameters:
+            * prefix: The prefix for every parameter name
+        """
+        self.prefix = prefix
+        self.values = {}
+
+    def bind(self, col, value):
+        """
+        Returns a new bind parameter for col holding value.
+        """
+        name = '%s%s' % (self.prefix, len(self.values))
+        self.values[name] = value
+        return bindparam(name, value, type_=col.type)
+
+
+def _column_clause(col, value, params):
+    """
+    Returns the clause and shape for a single column entry of a where
+    dict.
+    """
+    if isinstance(value, list):
+        return OPERATORS['in'](col, value, params.bind), ('in', len(value))
+    if isinstance(value, dict):
+        clauses = []
+        shape = []
+        for op, op_value in sorted(value.items()):
+            if op not in OPERATORS:
+                raise ValueError('Unknown operator %s for column %s' % (
+                    op, col.name))
+            if op == 'between' and (
+                    not isinstance(op_value, list) or len(op_value) != 2):
+                raise ValueError(
+                    'between for column %s needs two values' % col.name)
+            if op in ('in', 'not_in') and not isinstance(op_value, list):
+                raise ValueError(
+                    '%s for column %s needs a list' % (op, col.name))
+            clauses.append(OPERATORS[op](col, op_value, params.bind))
+            if op == 'is_null':
+                shape.append((op, bool(op_value)))
+            elif isinstance(op_value, list):
+                shape.append((op, len(op_value)))
+            else:
+                shape.append((op, None))
+        if not clauses:
+            raise ValueError('No operators given for column %s' % col.name)
+        return and_(*clauses), tuple(shape)
+    return OPERATORS['eq'](col, value, params.bind), 'eq'
+
+
+def _group_clause(table, group, params):
+    """
+    Returns the AND of every column entry in a where dict and its shape.
+    """
+    if not isinstance(group, dict) or not group:
+        raise ValueError('Where groups must be non empty objects')
+    clauses = []
+    shape = []
+    for colname, value in sorted(group.items()):
+        if colname not in table.c:
+            raise ValueError('Table %s has no column %s' % (
+                table.name, colname))
+        clause, col_shape = _column_clause(table.c[colname], value, params)
+        clauses.append(clause)
+        shape.append((colname, col_shape))
+    return and_(*clauses), tuple(shape)
+
+
+def build_where(table, where, prefix='w_'):
+    """
+    Returns a tuple of the where clause for table described by where,
+    the values for its bind parameters and the shape of the where.
+
+    Wheres with the same shape produce the same SQL and only differ in
+    their parameter values, so the shape can be used as a cache key. The
+    clause and shape are None when where is an empty dict, which matches
+    every row. An empty list is refused.
+
+    Raises ValueError when where is malformed.
+
+    Parameters:
+        * table: The Table the clause is for
+        * where: The where structure from the message
+        * prefix: The prefix for the bind parameter names
+    """
+    params = _Params(prefix)
+    if isinstance(where, dict):
+        if not where:
+            return None, {}, None
+        clause, shape = _group_clause(table, where, params)
+        return clause, params.values, ('and', shape)
+    if isinstance(where, list):
+        # No groups to match is far more likely a mistake than "every row"
+        if not where:
+            raise ValueError('Where must list at least one object')
+        clauses = []
+        shapes = []
+        for group in where:
+            clause, shape = _group_clause(table, group, params)
+            clauses.append(clause)
+            shapes.append(shape)
+        return or_(*clauses), params.values, ('or', tuple(shapes))
+    raise ValueError('Where must be an object or a list of objects')
+
+
+def where_columns(where):
+    """
+    Returns the names of the columns a where refers to, ignoring any
+    part of it build_where would refuse.
+
+    Parameters:
+        * where: The where structure from the message
+    """
+    groups = where if isinstance(where, list) else [where]
+    names = set()
+    for group in groups:
+        if isinstance(group, dict):
+            names.update(group)
+    return sorted(names)
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Opt in profiling of single messages.
+
+A message is profiled when its parameters hold "profile": true or, when
+sample_every is set, for one message in every sample_every. Each profile
+writes two files named after the correlation id to the directory:
+
+* <corr_id>-<time>.prof: the cProfile data, for pstats or snakeviz
+* <corr_id>-<time>.txt: every SQL statement with its timing, the top
+  functions by cumulative time and, when tracemalloc can be imported,
+  the top allocations
+"""
+
+import cProfile
+import os
+import pstats
+import re
+import tempfile
+import threading
+import time
+
+from StringIO import StringIO
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+class _Report(object):
+    """
+    What is collected while one message is profiled.
+    """
+
+    def __init__(self):
+        self.statements = []
+
+
+class Profiler(object):
+    """
+    Decides which messages to profile and writes their reports.
+    """
+
+    def __init__(self, directory=None, sample_every=0, use_tracemalloc=False,
+                 top=25, logger=None):
+        """
+        Creates the profiler.
+
+        Parameters:
+            * directory: Where reports are written, default a
+              sqlworker-profiles directory in the temp directory
+            * sample_every: Profile one message in this many, 0 for none
+            * use_tracemalloc: Whether to record allocations as well
+            * top: How many functions, statements and allocations to list
+            * logger: Optional logger to report problems to
+        """
+        self.directory = directory or os.path.join(
+            tempfile.gettempdir(), 'sqlworker-profiles')
+        self._sample_every = sample_every
+        self._use_tracemalloc = use_tracemalloc
+        self._top = top
+        self._logger = logger
+        self._count = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        if use_tracemalloc and tracemalloc is None and logger is not None:
+            logger.warn('tracemalloc is not available, allocations will '
+                        'not be profiled')
+
+    def wanted(self, params):
+        """
+        Returns whether a message with the given parameters should be
+        profiled.
+
+        Parameters:
+            * params: The message parameters
+        """
+        if params.get('profile', False):
+            return True
+        if not self._sample_every:
+            return False
+        with self._lock:
+            self._count += 1
+            return self._count % self._sample_every == 0
+
+    def statement(self, statement, seconds, executemany, rowcount):
+        """
+        Records a statement run while a message is being profiled on this
+        thread.
+
+        Parameters:
+            * statement: The SQL sent to the database
+            * seconds: How long it took
+            * executemany: Whether it was sent as an executemany
+            * rowcount: The rowcount the driver reported
+        """
+        report = getattr(self._local, 'report', None)
+        if report is not None:
+            report.statements.append(
+                (seconds, statement, executemany, rowcount))
+
+    def run(self, corr_id, func, *args, **kwargs):
+        """
+        Calls func under the profiler, writes the report and returns what
+        func returned.
+
+        Parameters:
+            * corr_id: The correlation id to name the report after
+            * func: The callable to profile
+            * args: Positional arguments for func
+            * kwargs: Keyword arguments for func
+        """
+        report = _Report()
+        self._local.report = report
+        tracing = (self._use_tracemalloc and tracemalloc is not None and
+                   not tracemalloc.is_tracing())
+        if tracing:
+            tracemalloc.start()
+        profile = cProfile.Profile()
+        start = time.time()
+        try:
+            return profile.runcall(func, *args, **kwargs)
+        finally:
+            elapsed = time.time() - start
+            snapshot = None
+            if tracing:
+                snapshot = tracemalloc.take_snapshot()
+                tracemalloc.stop()
+            self._local.report = None
+            try:
+                self._write(corr_id, elapsed, profile, report, snapshot)
+            except (IOError, OSError), ex:
+                if self._logger is not None:
+                    self._logger.error(
+                        'Unable to write the profile of %s: %s' % (
+                            corr_id, ex))
+
+    def _write(self, corr_id, elapsed, profile, report, snapshot):
+        """
+        Writes the .prof and .txt files of a profiled message.
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        base = os.path.join(self.directory, '%s-%s' % (
+            re.sub(r'[^A-Za-z0-9_.-]', '_', corr_id),
+            time.strftime('%Y%m%dT%H%M%S')))
+        profile.dump_stats(base + '.prof')
+
+        text = StringIO()
+        text.write('Message %s took %.6fs\n\n' % (corr_id, elapsed))
+        text.write('%s SQL statement(s), %.6fs in total, slowest first:\n' % (
+            len(report.statements),
+            sum(entry[0] for entry in report.statements)))
+        for seconds, statement, executemany, rowcount in sorted(
+                report.statements, reverse=True)[:self._top]:
+            text.write('  %.6fs rows=%s%s %s\n' % (
+                seconds, rowcount, ' executemany' if executemany else '',
+                ' '.join(statement.split())[:200]))
+        text.write('\n')
+        stats = pstats.Stats(profile, stream=text)
+        stats.sort_stats('cumulative').print_stats(self._top)
+        if snapshot is not None:
+            text.write('Top allocations:\n')
+            for stat in snapshot.statistics('lineno')[:self._top]:
+                text.write('  %s\n' % stat)
+        with open(base + '.txt', 'w') as report_file:
+            report_file.write(text.getvalue())
+        if self._logger is not None:
+            self._logger.info('Wrote the profile of %s to %s.txt' % (
+                corr_id, base))
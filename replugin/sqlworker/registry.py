@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Registry of the subcommands a worker can run.
+
+Worker methods are registered with the subcommand decorator. Other
+packages can add subcommands through the entry point group in
+ENTRY_POINT_GROUP, each entry point being a function decorated with
+subcommand which is called as func(worker, body, corr_id, output).
+"""
+
+import functools
+
+
+#: setuptools entry point group searched for extra subcommands
+ENTRY_POINT_GROUP = 'replugin.sqlworker.subcommands'
+
+#: Cost classes a subcommand can declare, cheapest first
+COST_CLASSES = ('cheap', 'normal', 'expensive')
+
+
+class SubcommandInfo(object):
+    """
+    What a subcommand declares about itself.
+    """
+
+    def __init__(self, name, read_only=False, cost='normal',
+                 database_key='database'):
+        """
+        Creates the description.
+
+        Parameters:
+            * name: The subcommand name used in messages
+            * read_only: True if it never writes, or a callable taking the
+              message parameters and returning whether that call writes
+            * cost: One of COST_CLASSES
+            * database_key: The message parameter naming the database
+        """
+        if cost not in COST_CLASSES:
+            raise ValueError('Unknown cost class %s for %s' % (cost, name))
+        self.name = name
+        self.read_only = read_only
+        self.cost = cost
+        self.database_key = database_key
+
+    def is_read_only(self, params):
+        """
+        Returns whether a call with the given message parameters only
+        reads.
+
+        Parameters:
+            * params: The message parameters
+        """
+        if callable(self.read_only):
+            return bool(self.read_only(params))
+        return bool(self.read_only)
+
+    def database(self, params):
+        """
+        Returns the database a call with the given message parameters
+        targets.
+
+        Parameters:
+            * params: The message parameters
+        """
+        return params.get(self.database_key, None)
+
+
+def subcommand(name, read_only=False, cost='normal', database_key='database'):
+    """
+    Decorator marking a function as the implementation of a subcommand.
+    See SubcommandInfo for the parameters.
+    """
+    info = SubcommandInfo(name, read_only, cost, database_key)
+
+    def decorator(func):
+        func.subcommand_info = info
+        return func
+    return decorator
+
+
+class SubcommandRegistry(object):
+    """
+    Maps subcommand names to their handler and SubcommandInfo.
+    """
+
+    def __init__(self):
+        """
+        Creates an empty registry.
+        """
+        self._handlers = {}
+
+    def register(self, info, handler):
+        """
+        Adds a subcommand. Raises ValueError if the name is taken.
+
+        Parameters:
+            * info: The SubcommandInfo of the subcommand
+            * handler: Callable taking (body, corr_id, output)
+        """
+        if info.name in self._handlers:
+            raise ValueError('Subcommand %s is already registered' % (
+                info.name))
+        self._handlers[info.name] = (info, handler)
+
+    def add_methods(self, worker):
+        """
+        Registers every method of worker marked with the subcommand
+        decorator.
+
+        Parameters:
+            * worker: The worker instance
+        """
+        for attr in dir(type(worker)):
+            info = getattr(
+                getattr(type(worker), attr, None), 'subcommand_info', None)
+            if isinstance(info, SubcommandInfo):
+                self.register(info, getattr(worker, attr))
+
+    def load_entry_points(self, worker, group=ENTRY_POINT_GROUP,
+                          logger=None):
+        """
+        Registers the subcommands installed under an entry point group.
+        Entry points which fail to load are logged and skipped. Nothing
+        is loaded when setuptools is not installed.
+
+        Parameters:
+            * worker: The worker instance passed to each handler
+            * group: The entry point group to search
+            * logger: Optional logger for entry points which fail
+        """
+        try:
+            import pkg_resources
+        except ImportError:
+            return
+        for entry_point in pkg_resources.iter_entry_points(group):
+            try:
+                func = entry_point.load()
+                info = getattr(func, 'subcommand_info', None)
+                if not isinstance(info, SubcommandInfo):
+                    info = SubcommandInfo(entry_point.name)
+                self.register(info, functools.partial(func, worker))
+            except Exception, ex:
+                if logger is not None:
+                    logger.error('Unable to load subcommand %s: %s' % (
+                        entry_point.name, ex))
+
+    def handler(self, name):
+        """
+        Returns the handler of a subcommand. Raises KeyError if there is
+        none.
+
+        Parameters:
+            * name: The subcommand name
+        """
+        return self._handlers[name][1]
+
+    def info(self, name):
+        """
+        Returns the SubcommandInfo of a subcommand. Raises KeyError if
+        there is none.
+
+        Parameters:
+            * name: The subcommand name
+        """
+        return self._handlers[name][0]
+
+    def names(self):
+        """
+        Returns the registered subcommand names, sorted.
+        """
+        return tuple(sorted(self._handlers))
+
+    def __contains__(self, name):
+        """
+        Returns whether a subcommand is registered.
+        """
+        return name in self._handlers
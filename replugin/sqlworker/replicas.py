@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Read replicas of a configured database.
+
+A database entry may list replicas next to its uri:
+
+    "replicas": ["postgresql://replica1/db", {"uri": "...", "kwargs": {}}],
+    "replica_balance": "round_robin" or "least_connections",
+    "replica_lag_sql": "SELECT ... seconds behind the primary ...",
+    "replica_max_lag": 30,
+    "replica_retry_after": 30
+
+Replicas which can not be reached, or are further behind than
+replica_max_lag, are left alone for replica_retry_after seconds.
+"""
+
+import threading
+import time
+
+from sqlalchemy import event
+
+
+#: Ways of picking the replica to use
+BALANCE_METHODS = ('round_robin', 'least_connections')
+
+#: Seconds a replica's lag measurement is trusted
+LAG_CHECK_INTERVAL = 5
+
+
+class _Replica(object):
+    """
+    One replica and what is known about its health.
+    """
+
+    def __init__(self, connection_info):
+        """
+        Creates the replica. Its engine is made on first use.
+
+        Parameters:
+            * connection_info: The configuration entry for the replica
+        """
+        self.connection_info = connection_info
+        self.engine = None
+        self.active = 0
+        self.down_until = 0
+        self.lag_checked = 0
+
+
+class ReplicaSet(object):
+    """
+    Hands out connections to the healthy replicas of one database.
+    """
+
+    def __init__(self, connection_info, engine_factory, logger=None):
+        """
+        Creates the set from the primary's configuration entry.
+
+        Parameters:
+            * connection_info: The configuration entry of the database
+            * engine_factory: Callable making an engine from an entry
+            * logger: Optional logger to report unhealthy replicas to
+        """
+        self._engine_factory = engine_factory
+        self._logger = logger
+        self._balance = connection_info.get('replica_balance', 'round_robin')
+        if self._balance not in BALANCE_METHODS:
+            raise ValueError('Unknown replica_balance %s' % self._balance)
+        self._lag_sql = connection_info.get('replica_lag_sql', None)
+        self.max_lag = connection_info.get('replica_max_lag', 30)
+        self._retry_after = connection_info.get('replica_retry_after', 30)
+        self._replicas = []
+        for replica in connection_info.get('replicas', []):
+            if not isinstance(replica, dict):
+                replica = {'uri': replica}
+            # Replicas share the primary's settings unless they set their own
+            info = {
+                'kwargs': connection_info.get('kwargs', {}),
+                'pool': connection_info.get('pool', {})}
+            info.update(replica)
+            self._replicas.append(_Replica(info))
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        """
+        Returns the number of replicas.
+        """
+        return len(self._replicas)
+
+    def _candidates(self):
+        """
+        Returns the replicas which are not resting, in the order they
+        should be tried.
+        """
+        now = time.time()
+        with self._lock:
+            replicas = [r for r in self._replicas if r.down_until <= now]
+            if self._balance == 'least_connections':
+                return sorted(replicas, key=lambda r: r.active)
+            start = self._next % max(len(replicas), 1)
+            self._next += 1
+            return replicas[start:] + replicas[:start]
+
+    def _engine(self, replica):
+        """
+        Returns the engine of a replica, making it if needed.
+        """
+        with self._lock:
+            if replica.engine is None:
+                replica.engine = self._engine_factory(replica.connection_info)
+
+                def checkout(*args):
+                    replica.active += 1
+
+                def checkin(*args):
+                    replica.active -= 1
+
+                event.listen(replica.engine, 'checkout', checkout)
+                event.listen(replica.engine, 'checkin', checkin)
+            return replica.engine
+
+    def _rest(self, replica, reason):
+        """
+        Stops using a replica for a while.
+        """
+        replica.down_until = time.time() + self._retry_after
+        if self._logger is not None:
+            self._logger.warn('Not using replica %s for %ss: %s' % (
+                replica.connection_info['uri'], self._retry_after, reason))
+
+    def _lag_ok(self, replica, conn):
+        """
+        Returns whether the replica is close enough to the primary.
+        """
+        if not self._lag_sql:
+            return True
+        if time.time() - replica.lag_checked < LAG_CHECK_INTERVAL:
+            return True
+        lag = conn.execute(self._lag_sql).scalar()
+        if lag is None or float(lag) > self.max_lag:
+            self._rest(replica, 'lagging by %s seconds' % lag)
+            return False
+        replica.lag_checked = time.time()
+        return True
+
+    def connect(self):
+        """
+        Returns a connection to a healthy replica or None if there is
+        none.
+        """
+        for replica in self._candidates():
+            try:
+                conn = self._engine(replica).connect()
+            except Exception, ex:
+                self._rest(replica, ex)
+                continue
+            try:
+                if self._lag_ok(replica, conn):
+                    return conn
+            except Exception, ex:
+                self._rest(replica, ex)
+            conn.close()
+        return None
+
+    def lag(self):
+        """
+        Returns the largest lag in seconds of the replicas which are not
+        resting, or None without replica_lag_sql or a replica to ask.
+        """
+        if not self._lag_sql:
+            return None
+        lags = []
+        for replica in self._candidates():
+            try:
+                conn = self._engine(replica).connect()
+                try:
+                    lag = conn.execute(self._lag_sql).scalar()
+                finally:
+                    conn.close()
+            except Exception, ex:
+                self._rest(replica, ex)
+                continue
+            if lag is not None:
+                lags.append(float(lag))
+        return max(lags) if lags else None
+
+    def dispose(self):
+        """
+        Closes every pooled connection to the replicas.
+        """
+        for replica in self._replicas:
+            if replica.engine is not None:
+                replica.engine.dispose()
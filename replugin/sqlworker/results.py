@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Paging of query results back to the requester.
+"""
+
+import base64
+import datetime
+import decimal
+import json
+
+
+def encode_value(value):
+    """
+    Returns a JSON serializable version of a single column value.
+
+    Parameters:
+        * value: The value as returned by the database driver
+    """
+    if value is None or isinstance(value, (bool, int, long, float)):
+        return value
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, decimal.Decimal):
+        return str(value)
+    if isinstance(value, unicode):
+        return value
+    if isinstance(value, (str, buffer, bytearray)):
+        value = str(value)
+        try:
+            return value.decode('utf-8')
+        except UnicodeDecodeError:
+            return base64.b64encode(value)
+    return unicode(value)
+
+
+class ResultPager(object):
+    """
+    Fetches rows from a result a page at a time so only one page is held
+    in memory. Pages are bounded by a row count and an encoded size and
+    the whole result may be capped by total rows and total bytes.
+    """
+
+    def __init__(self, result, page_rows=500, page_bytes=262144,
+                 max_rows=None, max_bytes=None):
+        """
+        Creates the pager.
+
+        Parameters:
+            * result: The ResultProxy to read rows from
+            * page_rows: The most rows to put in one page
+            * page_bytes: The most encoded bytes to put in one page
+            * max_rows: Optional cap on the total rows returned
+            * max_bytes: Optional cap on the total encoded bytes returned
+        """
+        self.result = result
+        self.page_rows = page_rows
+        self.page_bytes = page_bytes
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.columns = list(result.keys())
+        self.rows = 0
+        self.bytes = 0
+        self.truncated = False
+
+    def pages(self):
+        """
+        Yields lists of encoded rows, each row being a list of values in
+        the order of self.columns. The result is closed once done.
+        """
+        page = []
+        page_size = 0
+        try:
+            while not self.truncated:
+                fetched = self.result.fetchmany(self.page_rows)
+                if not fetched:
+                    break
+                for row in fetched:
+                    encoded = [encode_value(value) for value in row]
+                    # +1 for the separating comma in the page's list
+                    size = len(json.dumps(
+                        encoded, separators=(',', ':'))) + 1
+                    if ((self.max_rows is not None and
+                            self.rows >= self.max_rows) or
+                            (self.max_bytes is not None and
+                             self.bytes + size > self.max_bytes)):
+                        self.truncated = True
+                        break
+                    if page and (len(page) >= self.page_rows or
+                                 page_size + size > self.page_bytes):
+                        yield page
+                        page = []
+                        page_size = 0
+                    page.append(encoded)
+                    page_size += size
+                    self.rows += 1
+                    self.bytes += size
+            if page:
+                yield page
+        finally:
+            self.result.close()
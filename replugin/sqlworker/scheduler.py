@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Weighted fair scheduling of jobs across databases.
+
+Every database has its own FIFO queue. Each job is stamped with a
+virtual finish time of its cost divided by the database's weight, added
+to the later of the current virtual time and the database's previous
+finish time. The job with the earliest finish time runs next, so a
+database with weight 2 gets twice the share of one with weight 1, and a
+burst for one database can not starve the others.
+
+Jobs in the fast lane are taken before any other, up to fast_lane_burst
+in a row while other jobs wait.
+"""
+
+import threading
+
+from collections import deque
+
+
+#: Work units charged for each cost class
+COST_UNITS = {
+    'cheap': 1,
+    'normal': 2,
+    'expensive': 8,
+}
+
+
+class FairScheduler(object):
+    """
+    Thread safe queue handing out jobs by weighted fair share while
+    keeping each database under its concurrency cap.
+    """
+
+    def __init__(self, weights=None, default_weight=1, limits=None,
+                 default_limit=None, fast_lane_burst=8):
+        """
+        Creates an empty scheduler.
+
+        Parameters:
+            * weights: Optional dict of database name to share weight
+            * default_weight: Weight of databases not in weights
+            * limits: Optional dict of database name to concurrency cap
+            * default_limit: Optional cap for databases not in limits
+            * fast_lane_burst: Most fast lane jobs run in a row while
+              other jobs wait
+        """
+        self._weights = weights or {}
+        self._default_weight = default_weight
+        self._limits = limits or {}
+        self._default_limit = default_limit
+        self._fast_lane_burst = fast_lane_burst
+        self._cond = threading.Condition()
+        self._queues = {}
+        self._fast = deque()
+        self._finish = {}
+        self._vtime = 0.0
+        self._running = {}
+        self._fast_streak = 0
+        self._stops = 0
+        self.unfinished = 0
+
+    def _runnable(self, db_name):
+        """
+        Returns whether another job for db_name may start.
+        """
+        limit = self._limits.get(db_name, self._default_limit)
+        return limit is None or self._running.get(db_name, 0) < limit
+
+    def put(self, db_name, job, cost='normal', fast=False):
+        """
+        Queues a job.
+
+        Parameters:
+            * db_name: The database the job targets
+            * job: The job, returned as is by get
+            * cost: One of the COST_UNITS cost classes
+            * fast: Whether the job goes in the fast lane
+        """
+        with self._cond:
+            self.unfinished += 1
+            if fast:
+                self._fast.append((db_name, job))
+            else:
+                weight = float(
+                    self._weights.get(db_name, self._default_weight))
+                tag = max(self._vtime, self._finish.get(db_name, 0.0)) + (
+                    COST_UNITS.get(cost, COST_UNITS['normal']) / weight)
+                self._finish[db_name] = tag
+                self._queues.setdefault(db_name, deque()).append((tag, job))
+            self._cond.notify()
+
+    def _take_fast(self):
+        """
+        Returns the first runnable fast lane entry or None.
+        """
+        for entry in self._fast:
+            if self._runnable(entry[0]):
+                self._fast.remove(entry)
+                return entry
+        return None
+
+    def _take_fair(self):
+        """
+        Returns the runnable job with the earliest finish time or None.
+        """
+        best = None
+        for db_name, queue in self._queues.items():
+            if queue and self._runnable(db_name) and (
+                    best is None or queue[0][0] < best[1]):
+                best = (db_name, queue[0][0])
+        if best is None:
+            return None
+        db_name, tag = best
+        self._vtime = tag
+        job = self._queues[db_name].popleft()[1]
+        if not self._queues[db_name]:
+            del self._queues[db_name]
+        return (db_name, job)
+
+    def get(self):
+        """
+        Blocks until a job may run and returns (db_name, job), or None
+        when the caller should stop.
+        """
+        with self._cond:
+            while True:
+                if self._stops:
+                    self._stops -= 1
+                    return None
+                entry = None
+                if self._fast_streak < self._fast_lane_burst:
+                    entry = self._take_fast()
+                    if entry is not None:
+                        self._fast_streak += 1
+                if entry is None:
+                    entry = self._take_fair()
+                    if entry is not None:
+                        self._fast_streak = 0
+                    else:
+                        # Nothing else can run so the burst limit is moot
+                        entry = self._take_fast()
+                if entry is not None:
+                    self._running[entry[0]] = self._running.get(
+                        entry[0], 0) + 1
+                    return entry
+                self._cond.wait()
+
+    def done(self, db_name):
+        """
+        Marks a job returned by get as finished.
+
+        Parameters:
+            * db_name: The database the job targeted
+        """
+        with self._cond:
+            self._running[db_name] -= 1
+            self.unfinished -= 1
+            self._cond.notify_all()
+
+    def join(self):
+        """
+        Blocks until every queued job has finished.
+        """
+        with self._cond:
+            while self.unfinished:
+                self._cond.wait()
+
+    def stop(self, count):
+        """
+        Makes the next count calls to get return None.
+
+        Parameters:
+            * count: The number of callers to stop
+        """
+        with self._cond:
+            self._stops += count
+            self._cond.notify_all()
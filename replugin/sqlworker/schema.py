@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Reflected table cache for the SQL worker.
+"""
+
+import threading
+import time
+
+from sqlalchemy import Table, MetaData
+from sqlalchemy.exc import NoSuchTableError, OperationalError
+
+
+class SchemaCache(object):
+    """
+    Reflects tables one at a time and keeps them per database.
+
+    Entries live until they are invalidated or, when a ttl is given,
+    until they are older than ttl seconds. The cache lock is never held
+    while reflecting, a table is reflected by one thread at a time.
+    """
+
+    def __init__(self, ttl=None, metrics=None, reflector=None):
+        """
+        Creates the cache.
+
+        Parameters:
+            * ttl: Optional number of seconds a reflected table is trusted
+            * metrics: Optional Metrics instance to time reflection with
+            * reflector: Optional callable taking a database name and
+              returning a connection to reflect with instead, or None
+        """
+        self._ttl = ttl
+        self._metrics = metrics
+        self._reflector = reflector
+        self._metadata = {}
+        self._tables = {}
+        self._invalidated = {}
+        self._listeners = []
+        # Per table locks held while a table is being reflected
+        self._loading = {}
+        self._lock = threading.RLock()
+
+    def add_listener(self, listener):
+        """
+        Registers a callable to be called with (db_name, table_name)
+        whenever entries are invalidated.
+
+        Parameters:
+            * listener: The callable to register
+        """
+        self._listeners.append(listener)
+
+    def metadata(self, db_name):
+        """
+        Returns the MetaData holding the tables reflected for db_name.
+
+        Parameters:
+            * db_name: The name of the database key in the configuration file
+        """
+        with self._lock:
+            if db_name not in self._metadata:
+                self._metadata[db_name] = MetaData()
+            return self._metadata[db_name]
+
+    def get_table(self, db_name, table_name, conn, primary=False):
+        """
+        Returns the reflected table, reflecting it if it is not cached.
+
+        Raises NoSuchTableError if the table does not exist.
+
+        Parameters:
+            * db_name: The name of the database key in the configuration file
+            * table_name: The name of the table to reflect
+            * conn: The connection to reflect with
+            * primary: Whether to reflect with conn even with a reflector
+        """
+        key = (db_name, table_name)
+        with self._lock:
+            table = self._cached(key)
+            if table is not None:
+                return table
+            loading = self._loading.setdefault(key, threading.Lock())
+        # Reflection is I/O so only threads wanting this table wait on it
+        with loading:
+            try:
+                with self._lock:
+                    table = self._cached(key)
+                if table is not None:
+                    return table
+                start = time.time()
+                table = self._reflect(db_name, table_name, conn, primary)
+                if self._metrics is not None:
+                    self._metrics.observe('reflect', time.time() - start)
+                with self._lock:
+                    if self._invalidated.get(db_name, 0) >= start:
+                        # Invalidated while reflecting so may be stale
+                        return table
+                    metadata = self.metadata(db_name)
+                    if table.key in metadata.tables:
+                        metadata.remove(metadata.tables[table.key])
+                    table = table.tometadata(metadata)
+                    self._tables[key] = (table, time.time())
+                    return table
+            finally:
+                with self._lock:
+                    if self._loading.get(key, None) is loading:
+                        del self._loading[key]
+
+    def _cached(self, key):
+        """
+        Returns the cached table for key or None, invalidating it when it
+        is older than the ttl. Must be called holding the lock.
+
+        Parameters:
+            * key: The (db_name, table_name) of the table
+        """
+        entry = self._tables.get(key, None)
+        if entry is None:
+            return None
+        table, loaded_at = entry
+        if self._ttl is None or time.time() - loaded_at < self._ttl:
+            return table
+        self.invalidate(*key)
+        return None
+
+    def _reflect(self, db_name, table_name, conn, primary=False):
+        """
+        Reflects a table into a MetaData of its own, so no lock is needed
+        while the database is asked, preferring the reflector connection.
+
+        Parameters:
+            * db_name: The name of the database key in the configuration file
+            * table_name: The name of the table to reflect
+            * conn: The connection to reflect with
+            * primary: Whether to reflect with conn even with a reflector
+        """
+        reflect_conn = None
+        if self._reflector is not None and not primary:
+            reflect_conn = self._reflector(db_name)
+        if reflect_conn is not None:
+            try:
+                return Table(
+                    table_name, MetaData(),
+                    autoload=True, autoload_with=reflect_conn)
+            except (NoSuchTableError, OperationalError):
+                # The replica may be behind so ask conn instead
+                pass
+        return Table(
+            table_name, MetaData(), autoload=True, autoload_with=conn)
+
+    def invalidate(self, db_name, table_name=None):
+        """
+        Forgets a reflected table, or every table of a database when
+        table_name is not given.
+
+        Parameters:
+            * db_name: The name of the database key in the configuration file
+            * table_name: The name of the table to forget
+        """
+        with self._lock:
+            self._invalidated[db_name] = time.time()
+            for listener in self._listeners:
+                listener(db_name, table_name)
+            if table_name is None:
+                self._metadata.pop(db_name, None)
+                for key in self._tables.keys():
+                    if key[0] == db_name:
+                        del self._tables[key]
+                return
+            self._tables.pop((db_name, table_name), None)
+            metadata = self._metadata.get(db_name, None)
+            if metadata is not None and table_name in metadata.tables:
+                metadata.remove(metadata.tables[table_name])
+
+    def invalidated_at(self, db_name):
+        """
+        Returns when entries of db_name were last invalidated, or 0 if
+        they never were.
+
+        Parameters:
+            * db_name: The name of the database key in the configuration file
+        """
+        return self._invalidated.get(db_name, 0)
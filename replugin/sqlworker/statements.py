@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Cache of compiled statements for the SQL worker.
+"""
+
+import threading
+
+from collections import OrderedDict
+
+
+class StatementCache(object):
+    """
+    Least recently used cache of compiled statements.
+
+    Keys are tuples starting with the database and table names so the
+    entries of a table can be dropped when its schema changes.
+    """
+
+    def __init__(self, capacity=500):
+        """
+        Creates an empty cache.
+
+        Parameters:
+            * capacity: The most statements to keep
+        """
+        self.capacity = capacity
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, build):
+        """
+        Returns the statement cached under key, calling build to make
+        and cache it when missing.
+
+        Parameters:
+            * key: A tuple of (db_name, table_name, ...)
+            * build: A callable returning the compiled statement
+        """
+        with self._lock:
+            compiled = self._entries.pop(key, None)
+            if compiled is not None:
+                self._entries[key] = compiled
+                return compiled
+        compiled = build()
+        with self._lock:
+            self._entries[key] = compiled
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+        return compiled
+
+    def invalidate(self, db_name, table_name=None):
+        """
+        Drops the statements for a table, or for every table of a
+        database when table_name is not given.
+
+        Parameters:
+            * db_name: The name of the database key in the configuration file
+            * table_name: The name of the table
+        """
+        with self._lock:
+            for key in self._entries.keys():
+                if key[0] == db_name and (
+                        table_name is None or key[1] == table_name):
+                    del self._entries[key]
+
+    def __len__(self):
+        """
+        Returns the number of cached statements.
+        """
+        return len(self._entries)
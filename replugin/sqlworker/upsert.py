@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+INSERT statements which update the existing row when a key conflicts.
+"""
+
+from sqlalchemy.exc import CompileError
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import Insert
+
+
+#: Dialects an Upsert can be compiled for
+UPSERT_DIALECTS = ('postgresql', 'sqlite', 'mysql')
+
+
+class Upsert(Insert):
+    """
+    An INSERT which updates the conflicting row instead of failing.
+    """
+
+    def __init__(self, table, keys, update, **kwargs):
+        """
+        Creates the statement.
+
+        Parameters:
+            * table: The Table to insert into
+            * keys: The columns whose values identify a conflicting row
+            * update: The columns to overwrite on conflict, may be empty
+            * kwargs: Extra keyword arguments for Insert
+        """
+        super(Upsert, self).__init__(table, **kwargs)
+        self.conflict_keys = tuple(keys)
+        self.update_columns = tuple(update)
+
+
+@compiles(Upsert)
+def _compile_upsert(element, compiler, **kw):
+    """
+    Renders the INSERT followed by the dialect's conflict clause.
+    """
+    dialect = compiler.dialect.name
+    if dialect not in UPSERT_DIALECTS:
+        raise CompileError('Upsert is not supported on %s' % dialect)
+    sql = compiler.visit_insert(element, **kw)
+    quote = compiler.preparer.format_column
+    columns = element.table.c
+    if dialect == 'mysql':
+        # Assigning a key to itself leaves the row alone
+        update = element.update_columns or element.conflict_keys[:1]
+        return '%s ON DUPLICATE KEY UPDATE %s' % (sql, ', '.join(
+            '%s = VALUES(%s)' % (quote(columns[name]), quote(columns[name]))
+            for name in update))
+    sql += ' ON CONFLICT (%s)' % ', '.join(
+        quote(columns[name]) for name in element.conflict_keys)
+    if not element.update_columns:
+        return sql + ' DO NOTHING'
+    return '%s DO UPDATE SET %s' % (sql, ', '.join(
+        '%s = excluded.%s' % (quote(columns[name]), quote(columns[name]))
+        for name in element.update_columns))
@@ -16,7 +16,13 @@
 Unittests.
 """
 
+import json
 import os
+import shutil
+import tempfile
+import threading
+import time
+
 import pika
 import mock
 import sqlalchemy
@@ -190,6 +196,91 @@ class TestSQLWorker(TestCase):
                     sqlalchemy.exc.ProgrammingError):
                 pass
 
+    def test_create_table_spec(self):
+        """
+        Verify column specs are validated up front and left untouched.
+        """
+        from sqlalchemy.dialects import postgresql
+        from replugin.sqlworker import columns
+
+        compiled = columns.compile_columns({
+            "price": {"type": "Numeric", "precision": 10, "scale": 2},
+            "state": {"type": "Enum", "values": ["up", "down"],
+                      "enum_name": "host_state", "nullable": False},
+            "addr": {"type": "postgresql.INET"},
+        })
+        assert [c.name for c in compiled] == ['addr', 'price', 'state']
+        assert isinstance(compiled[0].type, postgresql.INET)
+        assert (compiled[1].type.precision, compiled[1].type.scale) == (
+            10, 2)
+        assert compiled[2].type.enums == ('up', 'down')
+        assert compiled[2].nullable is False
+        assert columns.resolve_type('Integer') is sqlalchemy.Integer
+
+        for spec in (
+                {"type": "NoSuchType"}, {"type": "nodialect.INET"},
+                {"type": "Enum"}, {"type": "Integer", "length": 1},
+                {"type": "Integer", "colour": "red"}, {"length": 1}):
+            self.assertRaises(
+                ValueError, columns.compile_columns, {"c": spec})
+
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.sqlworker.SQLWorker.notify'),
+                mock.patch('replugin.sqlworker.SQLWorker.send')):
+
+            worker = sqlworker.SQLWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file='conf/example.json')
+
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+
+            body = {
+                "parameters": {
+                    "command": "sql",
+                    "subcommand": "CreateTable",
+                    "database": "testdb",
+                    "name": "test_spec",
+                    "columns": {
+                        "a": {"type": "Integer", "primary_key": True},
+                        "b": {"type": "NoSuchType"}},
+                },
+            }
+            _, engine, conn = worker._db_connect('testdb')
+
+            # One bad column and nothing is created
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+            assert worker.send.call_args[0][2]['status'] == 'failed'
+            assert not engine.has_table('test_spec')
+
+            # The same spec can be sent again
+            body['parameters']['columns']['b'] = {
+                "type": "String", "length": 10}
+            spec = json.loads(json.dumps(body['parameters']['columns']))
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+            assert worker.send.call_args[0][2]['status'] == 'completed'
+            assert body['parameters']['columns'] == spec
+            body['parameters']['name'] = 'test_spec_again'
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+            assert worker.send.call_args[0][2]['status'] == 'completed'
+
     def test_drop_table(self):
         """
         Verify drop_table works when all proper information is passed.
@@ -631,6 +722,130 @@ class TestSQLWorker(TestCase):
             # We should have 2 rows inserted
             assert result == 2
 
+    def test_insert_unknown_column(self):
+        """
+        Verify inserting a key which is not a column fails the message.
+        """
+        table_name = 'test_insert_unknown'
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.sqlworker.SQLWorker.notify'),
+                mock.patch('replugin.sqlworker.SQLWorker.send')):
+
+            worker = sqlworker.SQLWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file='conf/example.json')
+
+            _, engine, conn = worker._db_connect('testdb')
+            self._create_dummy_db(conn, table_name)
+
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+
+            body = {
+                "parameters": {
+                    "command": "sql",
+                    "subcommand": "Insert",
+                    "database": "testdb",
+                    "name": table_name,
+                    "rows": [
+                        {"a": 1, "b": 1},
+                        {"a": 10, "b": 1, "zzz": 5},
+                    ],
+                },
+            }
+
+            # Execute the call
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+
+            assert worker.send.call_args[0][2]['status'] == 'failed'
+            self.logger.error.assert_called_with(
+                'Column zzz does not exist on table %s' % table_name)
+            # Nothing is kept from the failed message
+            assert engine.execute(
+                'SELECT COUNT(*) FROM ' + table_name).scalar() == 0
+
+    def test_stale_schema(self):
+        """
+        Verify columns added by another worker are found by reflecting
+        the table again.
+        """
+        table_name = 'test_stale_schema'
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.sqlworker.SQLWorker.notify'),
+                mock.patch('replugin.sqlworker.SQLWorker.send')):
+
+            workers = [
+                sqlworker.SQLWorker(
+                    MQ_CONF,
+                    logger=self.app_logger,
+                    config_file='conf/example.json')
+                for i in range(2)]
+
+            _, engine, conn = workers[0]._db_connect('testdb')
+            self._create_dummy_db(conn, table_name)
+
+            for worker in workers:
+                worker._on_open(self.connection)
+                worker._on_channel_open(self.channel)
+
+            def run(worker, **parameters):
+                parameters.update({
+                    "command": "sql",
+                    "database": "testdb",
+                    "name": table_name})
+                worker.process(
+                    self.channel,
+                    self.basic_deliver,
+                    self.properties,
+                    {"parameters": parameters},
+                    self.logger)
+                return worker.send.call_args[0][2]['status']
+
+            assert run(
+                workers[1], subcommand='Insert',
+                rows=[{"a": 1, "b": 2}]) == 'completed'
+            assert run(
+                workers[0], subcommand='AddTableColumns',
+                columns={"x": {"type": "Integer"}}) == 'completed'
+            # The second worker still has the table without x cached
+            assert run(
+                workers[1], subcommand='Insert',
+                rows=[{"a": 3, "b": 4, "x": 5}]) == 'completed'
+            assert run(
+                workers[1], subcommand='Update',
+                updates=[{"values": {"b": 6}, "where": {"x": 5}}]) == (
+                    'completed')
+            assert run(
+                workers[1], subcommand='Delete',
+                where={"x": {"is_null": True}}) == 'completed'
+            assert engine.execute(
+                'SELECT a, b, x FROM ' + table_name).fetchall() == [
+                    (3, 6, 5)]
+
+            # Columns which really do not exist still fail
+            assert run(
+                workers[1], subcommand='Insert',
+                rows=[{"a": 7, "zzz": 8}]) == 'failed'
+
+            # DDL is checked against the table as it is now
+            assert run(
+                workers[0], subcommand='Insert',
+                rows=[{"a": 9, "x": 9}]) == 'completed'
+            assert run(
+                workers[1], subcommand='DropTableColumns',
+                columns=['x']) == 'completed'
+            assert run(
+                workers[0], subcommand='AddTableColumns',
+                columns={"x": {"type": "Integer"}}) == 'completed'
+
     def test_insert_fail(self):
         """
         Verify inserting fails if there isn't a table.
@@ -730,3 +945,2035 @@ class TestSQLWorker(TestCase):
                 'SELECT COUNT(*) from ' + table_name + ';').fetchall()[0][0]
             # We should have 1 row left as we deleted the other row
             assert result == 1
+
+    def test__db_connect_reuses_engine(self):
+        """
+        Verify _db_connect reuses one engine per database.
+        """
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.sqlworker.SQLWorker.notify'),
+                mock.patch('replugin.sqlworker.SQLWorker.send')):
+
+            worker = sqlworker.SQLWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file='conf/example.json')
+
+            _, engine, _ = worker._db_connect('testdb')
+            _, engine2, _ = worker._db_connect('testdb')
+            assert engine is engine2
+
+    def test__db_connect_pool_options(self):
+        """
+        Verify pool configuration is passed through to create_engine.
+        """
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.sqlworker.SQLWorker.notify'),
+                mock.patch('replugin.sqlworker.SQLWorker.send'),
+                mock.patch('replugin.sqlworker.engines.create_engine')) as (
+                    _, _, _, create_engine):
+
+            worker = sqlworker.SQLWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file='conf/example.json')
+            worker._config['databases']['pooled'] = {
+                'uri': 'postgresql://localhost/test',
+                'pool': {
+                    'size': 3,
+                    'max_overflow': 2,
+                    'recycle': 60,
+                },
+            }
+
+            worker._engines = sqlworker.EngineRegistry(
+                worker._config['databases'])
+            worker._engines.get('pooled')
+            create_engine.assert_called_once_with(
+                'postgresql://localhost/test',
+                pool_size=3, max_overflow=2, pool_recycle=60)
+
+    def test_process_releases_connections(self):
+        """
+        Verify connections are returned to the pool after processing.
+        """
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.sqlworker.SQLWorker.notify'),
+                mock.patch('replugin.sqlworker.SQLWorker.send')):
+
+            worker = sqlworker.SQLWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file='conf/example.json')
+
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+
+            body = {
+                "parameters": {
+                    "command": "sql",
+                    "subcommand": "ExecuteSQL",
+                    "database": "testdb",
+                    "sql": "SELECT 1",
+                },
+            }
+
+            # Execute the call
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+
+            assert worker._checked_out() == []
+            assert worker.send.call_args[0][2]['status'] == 'completed'
+
+    def test_schema_cache(self):
+        """
+        Verify reflected tables are cached and invalidated by DDL.
+        """
+        table_name = 'test_schema_cache'
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.sqlworker.SQLWorker.notify'),
+                mock.patch('replugin.sqlworker.SQLWorker.send')):
+
+            worker = sqlworker.SQLWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file='conf/example.json')
+
+            _, engine, conn = worker._db_connect('testdb')
+            self._create_dummy_db(conn, table_name)
+            conn.execute('CREATE TABLE unrelated (a INTEGER);')
+
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+
+            body = {
+                "parameters": {
+                    "command": "sql",
+                    "subcommand": "Insert",
+                    "database": "testdb",
+                    "name": table_name,
+                    "rows": [{"a": 1, "b": 2}],
+                },
+            }
+
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+
+            table = worker._schema.get_table('testdb', table_name, conn)
+            # Only the touched table should have been reflected
+            assert worker._schema.metadata('testdb').tables.keys() == [
+                table_name]
+
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+            assert worker._schema.get_table(
+                'testdb', table_name, conn) is table
+
+            body['parameters'].update({
+                "subcommand": "AddTableColumns",
+                "columns": {"c": {"type": "Integer"}},
+            })
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+
+            table = worker._schema.get_table('testdb', table_name, conn)
+            assert 'c' in table.c
+            assert worker.send.call_args[0][2]['status'] == 'completed'
+
+    def test_schema_cache_reflects_unlocked(self):
+        """
+        Verify cached tables are returned while another is reflected.
+        """
+        from replugin.sqlworker.schema import SchemaCache
+
+        # A file so every thread sees the same database
+        directory = tempfile.mkdtemp()
+        engine = sqlalchemy.create_engine(
+            'sqlite:///' + os.path.join(directory, 'schema.db'))
+        engine.execute('CREATE TABLE fast (a INTEGER PRIMARY KEY)')
+        engine.execute('CREATE TABLE slow (a INTEGER PRIMARY KEY)')
+        reflecting = threading.Event()
+        release = threading.Event()
+
+        def reflector(db_name):
+            if reflector.wait:
+                reflecting.set()
+                release.wait(5)
+            return None
+        reflector.wait = False
+
+        cache = SchemaCache(reflector=reflector)
+        fast = cache.get_table('testdb', 'fast', engine)
+        reflector.wait = True
+        thread = threading.Thread(
+            target=cache.get_table, args=('testdb', 'slow', engine))
+        thread.start()
+        assert reflecting.wait(5)
+        # The slow reflection does not hold the cache lock
+        found = []
+        lookup = threading.Thread(target=lambda: found.append(
+            cache.get_table('testdb', 'fast', engine)))
+        lookup.start()
+        lookup.join(1)
+        release.set()
+        assert found == [fast]
+        thread.join(5)
+        assert sorted(cache.metadata('testdb').tables) == ['fast', 'slow']
+        shutil.rmtree(directory)
+
+    def test_insert_chunks(self):
+        """
+        Verify inserts are sent in chunks of rows sharing the same columns.
+        """
+        table_name = 'test_insert_chunks'
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.sqlworker.SQLWorker.notify'),
+                mock.patch('replugin.sqlworker.SQLWorker.send')):
+
+            worker = sqlworker.SQLWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file='conf/example.json')
+
+            _, engine, conn = worker._db_connect('testdb')
+            self._create_dummy_db(conn, table_name)
+
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+
+            body = {
+                "parameters": {
+                    "command": "sql",
+                    "subcommand": "Insert",
+                    "database": "testdb",
+                    "name": table_name,
+                    "chunk_size": 2,
+                    "rows": [
+                        {"a": 1, "b": 1},
+                        {"a": 2, "b": 2},
+                        {"a": 3, "b": 3},
+                        {"a": 4},
+                    ],
+                },
+            }
+
+            # Execute the call
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+
+            result = engine.execute(
+                'SELECT COUNT(*) from ' + table_name + ';').fetchall()[0][0]
+            assert result == 4
+            # One progress line per chunk
+            assert self.logger.info.call_count == 3
+            assert worker.send.call_args[0][2]['data'] == (
+                '4 Insert statements done')
+
+    def test_chunk_rows(self):
+        """
+        Verify rows are grouped by size and by column set.
+        """
+        rows = [{'a': 1}, {'a': 2}, {'a': 3}, {'b': 1}, {'a': 4}]
+        chunks = list(sqlworker._chunk_rows(rows, 2))
+        assert chunks == [
+            [{'a': 1}, {'a': 2}], [{'a': 3}], [{'b': 1}], [{'a': 4}]]
+
+    def test_process_with_pool(self):
+        """
+        Verify messages are processed by the worker pool when configured.
+        """
+        table_name = 'test_process_with_pool'
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.sqlworker.SQLWorker.notify'),
+                mock.patch('replugin.sqlworker.SQLWorker.send')):
+
+            worker = sqlworker.SQLWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file='conf/example.json')
+            worker._pool = sqlworker.WorkerPool(2, {'testdb': 1})
+            worker._pool.start()
+
+            _, engine, conn = worker._db_connect('testdb')
+            self._create_dummy_db(conn, table_name)
+
+            self.channel.basic_qos = mock.Mock('basic_qos')
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+            self.channel.basic_qos.assert_called_once_with(prefetch_count=2)
+
+            body = {
+                "parameters": {
+                    "command": "sql",
+                    "subcommand": "Insert",
+                    "database": "testdb",
+                    "name": table_name,
+                    "rows": [{"a": 1, "b": 2}],
+                },
+            }
+
+            for i in range(3):
+                worker.process(
+                    self.channel,
+                    self.basic_deliver,
+                    self.properties,
+                    body,
+                    self.logger)
+            worker._pool.stop()
+
+            result = engine.execute(
+                'SELECT COUNT(*) from ' + table_name + ';').fetchall()[0][0]
+            assert result == 3
+            assert worker.send.call_args[0][2]['status'] == 'completed'
+
+    def test_channel_calls_from_pool_are_relayed(self):
+        """
+        Verify channel calls made off the connection thread are queued.
+        """
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.sqlworker.SQLWorker.notify')):
+
+            worker = sqlworker.SQLWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file='conf/example.json')
+            worker._pool = mock.MagicMock(size=1)
+            self.channel.basic_qos = mock.Mock('basic_qos')
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+
+            thread = threading.Thread(
+                target=worker.send, args=('me', '1', {'status': 'started'}),
+                kwargs={'exchange': ''})
+            thread.start()
+            thread.join()
+            assert self.channel.basic_publish.call_count == 0
+
+            worker._relay_channel_calls()
+            assert self.channel.basic_publish.call_count == 1
+
+    def test_max_in_flight(self):
+        """
+        Verify consumption pauses at max_in_flight and resumes later.
+        """
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.sqlworker.SQLWorker.notify')):
+
+            worker = sqlworker.SQLWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file='conf/example.json')
+            worker._pool = sqlworker.WorkerPool(1)
+            worker._pool.start()
+            worker._max_in_flight = 2
+            release = threading.Event()
+            worker._handle = mock.Mock(side_effect=lambda *a: release.wait())
+
+            self.channel.basic_qos = mock.Mock('basic_qos')
+            self.channel.basic_cancel = mock.Mock('basic_cancel')
+            self.channel.consumer_tags = ['ctag']
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+            self.channel.basic_qos.assert_called_once_with(prefetch_count=2)
+
+            body = {"parameters": {"subcommand": "Insert"}}
+            worker.process(
+                self.channel, self.basic_deliver, self.properties, body,
+                self.logger)
+            assert self.channel.basic_cancel.call_count == 0
+            worker.process(
+                self.channel, self.basic_deliver, self.properties, body,
+                self.logger)
+            self.channel.basic_cancel.assert_called_once_with(
+                consumer_tag='ctag')
+
+            # Still busy so nothing changes
+            worker._relay_channel_calls()
+            assert self.channel.basic_consume.call_count == 1
+
+            release.set()
+            worker._pool.join()
+            worker._relay_channel_calls()
+            assert self.channel.basic_consume.call_count == 2
+            assert worker._paused is False
+            worker._pool.stop()
+
+    def test_coalesce_inserts(self):
+        """
+        Verify small inserts are coalesced and acked only once committed.
+        """
+        from replugin.sqlworker.coalesce import Coalescer
+
+        table_name = 'test_coalesce'
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.sqlworker.SQLWorker.notify'),
+                mock.patch('replugin.sqlworker.SQLWorker.send'),
+                mock.patch('replugin.sqlworker.SQLWorker.ack')):
+
+            worker = sqlworker.SQLWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file='conf/example.json')
+            worker._coalescer = Coalescer(max_rows=10, max_messages=3)
+
+            _, engine, conn = worker._db_connect('testdb')
+            conn.execute(
+                'CREATE TABLE ' + table_name + ' (a INTEGER PRIMARY KEY);')
+            worker._release_connections()
+
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+
+            def message(corr_id, *values):
+                properties = mock.MagicMock(
+                    'pika.spec.BasicProperties',
+                    correlation_id=corr_id, reply_to='me')
+                body = {"parameters": {
+                    "command": "sql",
+                    "subcommand": "Insert",
+                    "database": "testdb",
+                    "name": table_name,
+                    "rows": [{"a": value} for value in values]}}
+                worker.process(
+                    self.channel, corr_id, properties, body, self.logger)
+
+            def replies():
+                return [(c[0][1], c[0][2]['status']) for c in
+                        worker.send.call_args_list
+                        if c[0][2]['status'] != 'started']
+
+            message('c1', 1, 2)
+            message('c2', 3)
+            assert worker.ack.call_count == 0
+            assert worker._connection.add_timeout.call_count == 1
+
+            # The third message fills the batch
+            message('c3', 4)
+            assert [c[0][0] for c in worker.ack.call_args_list] == [
+                'c1', 'c2', 'c3']
+            assert replies() == [
+                ('c1', 'completed'), ('c2', 'completed'), ('c3', 'completed')]
+            assert worker.send.call_args_list[1][0][2]['data'] == (
+                '2 Insert statements done')
+            assert engine.execute(
+                'SELECT COUNT(*) FROM ' + table_name).scalar() == 4
+
+            # The old timer finds nothing to flush
+            worker._connection.add_timeout.call_args[0][1]()
+            assert worker.ack.call_count == 3
+
+            # A conflict fails only the message it came from
+            worker.ack.reset_mock()
+            worker.send.reset_mock()
+            message('c4', 5)
+            message('c5', 1)
+            worker._connection.add_timeout.call_args[0][1]()
+            assert sorted(c[0][0] for c in worker.ack.call_args_list) == [
+                'c4', 'c5']
+            assert replies() == [('c4', 'completed'), ('c5', 'failed')]
+            assert engine.execute(
+                'SELECT COUNT(*) FROM ' + table_name).scalar() == 5
+
+            # Messages asking not to be coalesced run at once
+            worker.ack.reset_mock()
+            properties = mock.MagicMock(
+                'pika.spec.BasicProperties',
+                correlation_id='c6', reply_to='me')
+            worker.process(self.channel, 'c6', properties, {"parameters": {
+                "command": "sql", "subcommand": "Insert",
+                "database": "testdb", "name": table_name,
+                "rows": [{"a": 6}], "coalesce": False}}, self.logger)
+            worker.ack.assert_called_once_with('c6')
+
+            # Other messages for the table wait for held inserts
+            outputs = [mock.MagicMock(), mock.MagicMock()]
+            for index, corr_id in enumerate(('c7', 'c8')):
+                properties = mock.MagicMock(
+                    'pika.spec.BasicProperties',
+                    correlation_id=corr_id, reply_to='me')
+                worker.process(self.channel, corr_id, properties, {
+                    "parameters": {
+                        "command": "sql", "subcommand": "Insert",
+                        "database": "testdb", "name": table_name,
+                        "rows": [{"a": 7 + index}]}}, outputs[index])
+            properties = mock.MagicMock(
+                'pika.spec.BasicProperties',
+                correlation_id='c9', reply_to='me')
+            worker.process(self.channel, 'c9', properties, {"parameters": {
+                "command": "sql", "subcommand": "Delete",
+                "database": "testdb", "name": table_name,
+                "where": {"a": [7, 8]}}}, self.logger)
+            assert worker.send.call_args[0][2]['data'] == (
+                'Deleted 2 rows in %s.' % table_name)
+            # Each message hears only about its own rows
+            for output in outputs:
+                output.info.assert_called_once_with(
+                    'Inserted 1 rows into table %s.' % table_name)
+
+    def test_late_ack_and_idempotency(self):
+        """
+        Verify late acks and replaying results of redelivered messages.
+        """
+        from replugin.sqlworker.idempotency import ResultStore, message_key
+
+        table_name = 'test_idempotency'
+        tmpdir = tempfile.mkdtemp()
+        try:
+            with nested(
+                    mock.patch('pika.SelectConnection'),
+                    mock.patch('replugin.sqlworker.SQLWorker.notify'),
+                    mock.patch('replugin.sqlworker.SQLWorker.send')):
+
+                worker = sqlworker.SQLWorker(
+                    MQ_CONF,
+                    logger=self.app_logger,
+                    config_file='conf/example.json')
+                worker._late_ack = True
+                worker._results = ResultStore(
+                    os.path.join(tmpdir, 'results.db'))
+                _, engine, conn = worker._db_connect('testdb')
+                conn.execute(
+                    'CREATE TABLE ' + table_name + ' (a INTEGER);')
+                worker._release_connections()
+
+                self.channel.basic_qos = mock.Mock('basic_qos')
+                worker._on_open(self.connection)
+                worker._on_channel_open(self.channel)
+                self.channel.basic_qos.assert_called_once_with(
+                    prefetch_count=1)
+
+                acked = []
+                self.channel.basic_ack.side_effect = (
+                    lambda *a, **k: acked.append(worker.send.call_count))
+                body = {"parameters": {
+                    "command": "sql",
+                    "subcommand": "Insert",
+                    "database": "testdb",
+                    "name": table_name,
+                    "rows": [{"a": 1}]}}
+
+                # Acked only after the started and completed replies
+                worker.process(
+                    self.channel, self.basic_deliver, self.properties,
+                    body, self.logger)
+                assert acked == [2]
+                assert worker.send.call_args[0][2] == {
+                    'status': 'completed',
+                    'data': '1 Insert statements done'}
+
+                # A redelivery is answered without inserting again
+                worker.send.reset_mock()
+                worker.process(
+                    self.channel, self.basic_deliver, self.properties,
+                    body, self.logger)
+                assert acked == [2, 2]
+                assert worker.send.call_args[0][2] == {
+                    'status': 'completed',
+                    'data': '1 Insert statements done'}
+                assert engine.execute(
+                    'SELECT COUNT(*) FROM ' + table_name).scalar() == 1
+
+                # A different message reusing the correlation id still runs
+                other = json.loads(json.dumps(body))
+                other['parameters']['rows'] = [{"a": 2}, {"a": 3}]
+                worker.process(
+                    self.channel, self.basic_deliver, self.properties,
+                    other, self.logger)
+                assert worker.send.call_args[0][2] == {
+                    'status': 'completed',
+                    'data': '2 Insert statements done'}
+                assert engine.execute(
+                    'SELECT COUNT(*) FROM ' + table_name).scalar() == 3
+
+            # Results expire after the ttl
+            key = message_key('123', body)
+            assert key != message_key('123', other)
+            store = ResultStore(os.path.join(tmpdir, 'results.db'), ttl=60)
+            assert store.get(key) is not None
+            with mock.patch('time.time', return_value=time.time() + 120):
+                assert store.get(key) is None
+                store.purge()
+            store.put(key, 'completed', ['a'])
+            store.put(key, 'completed', ['b'])
+            assert store.get(key) == ('completed', ['b'])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_worker_pool_per_database_cap(self):
+        """
+        Verify the worker pool honours per database caps.
+        """
+        pool = sqlworker.WorkerPool(4, {'capped': 1})
+        lock = threading.Lock()
+        running = {'now': 0, 'max': 0}
+
+        def job():
+            with lock:
+                running['now'] += 1
+                running['max'] = max(running['max'], running['now'])
+            time.sleep(0.01)
+            with lock:
+                running['now'] -= 1
+
+        pool.start()
+        for i in range(6):
+            pool.submit('capped', job)
+        pool.join()
+        pool.stop()
+        assert running['max'] == 1
+
+    def test_fair_scheduler(self):
+        """
+        Verify jobs are handed out by weight, lane and database cap.
+        """
+        from replugin.sqlworker.scheduler import FairScheduler
+
+        scheduler = FairScheduler(weights={'b': 2}, limits={'a': 1})
+        for i in range(3):
+            scheduler.put('a', 'a%s' % i)
+        scheduler.put('b', 'b0')
+        scheduler.put('c', 'c0', fast=True)
+        assert scheduler.get() == ('c', 'c0')
+        scheduler.done('c')
+        # b has twice the weight so its first job finishes earliest
+        assert scheduler.get() == ('b', 'b0')
+        scheduler.done('b')
+        assert scheduler.get() == ('a', 'a0')
+        scheduler.put('b', 'b1')
+        # a is at its cap so b runs even though a1 is older
+        assert scheduler.get() == ('b', 'b1')
+        scheduler.done('b')
+        scheduler.done('a')
+        assert scheduler.get() == ('a', 'a1')
+        scheduler.done('a')
+        assert scheduler.unfinished == 1
+
+        scheduler = FairScheduler(fast_lane_burst=1)
+        scheduler.put('a', 'slow', cost='expensive')
+        scheduler.put('a', 'fast0', fast=True)
+        scheduler.put('a', 'fast1', fast=True)
+        assert [scheduler.get()[1] for i in range(3)] == [
+            'fast0', 'slow', 'fast1']
+
+    def test_execute_sql_stream(self):
+        """
+        Verify query results are sent back in pages.
+        """
+        table_name = 'test_execute_sql_stream'
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.sqlworker.SQLWorker.notify'),
+                mock.patch('replugin.sqlworker.SQLWorker.send')):
+
+            worker = sqlworker.SQLWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file='conf/example.json')
+
+            _, engine, conn = worker._db_connect('testdb')
+            self._create_dummy_db(conn, table_name)
+            for i in range(5):
+                conn.execute(
+                    'INSERT INTO ' + table_name + ' VALUES (%s, 0);' % i)
+
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+
+            body = {
+                "parameters": {
+                    "command": "sql",
+                    "subcommand": "ExecuteSQL",
+                    "database": "testdb",
+                    "sql": "SELECT a, b FROM " + table_name + " ORDER BY a",
+                    "stream": True,
+                    "page_rows": 2,
+                    "max_rows": 4,
+                },
+            }
+
+            # Execute the call
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+
+            sent = [c[0][2] for c in worker.send.call_args_list]
+            assert [m['status'] for m in sent] == [
+                'started', 'results', 'results', 'completed']
+            assert sent[1]['columns'] == ['a', 'b']
+            assert sent[1]['rows'] == [[0, 0], [1, 0]]
+            assert sent[2]['rows'] == [[2, 0], [3, 0]]
+            assert 'columns' not in sent[2]
+            assert sent[3]['data'] == (
+                'SQL executed. 4 rows returned in 2 page(s), '
+                'truncated at the requested limit')
+
+            # Without a max_bytes the configured cap still applies
+            del body['parameters']['max_rows']
+            worker._config['stream_max_bytes'] = 12
+            worker.send.reset_mock()
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+            assert worker.send.call_args[0][2]['data'] == (
+                'SQL executed. 2 rows returned in 1 page(s), '
+                'truncated at the requested limit')
+
+            # Pool threads can only queue so many pages for the relay
+            assert worker._channel_calls.maxsize == (
+                sqlworker.DEFAULT_RELAY_QUEUE_SIZE)
+
+    def test_encode_value(self):
+        """
+        Verify column values are made JSON serializable.
+        """
+        import datetime
+        import decimal
+        from replugin.sqlworker.results import encode_value
+
+        assert encode_value(1) == 1
+        assert encode_value(None) is None
+        assert encode_value(decimal.Decimal('1.50')) == '1.50'
+        assert encode_value(datetime.date(2014, 1, 2)) == '2014-01-02'
+        assert encode_value('\xff') == '/w=='
+
+    def test_batch(self):
+        """
+        Verify a batch runs every step and returns per step results.
+        """
+        table_name = 'test_batch'
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.sqlworker.SQLWorker.notify'),
+                mock.patch('replugin.sqlworker.SQLWorker.send')):
+
+            worker = sqlworker.SQLWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file='conf/example.json')
+
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+
+            body = {
+                "parameters": {
+                    "command": "sql",
+                    "subcommand": "Batch",
+                    "database": "testdb",
+                    "steps": [
+                        {
+                            "subcommand": "CreateTable",
+                            "name": table_name,
+                            "columns": {
+                                "a": {"type": "Integer"},
+                            },
+                        },
+                        {
+                            "subcommand": "AddTableColumns",
+                            "name": table_name,
+                            "columns": {
+                                "b": {"type": "Integer"},
+                            },
+                        },
+                        {
+                            "subcommand": "Insert",
+                            "name": table_name,
+                            "rows": [{"a": 1, "b": 2}, {"a": 2, "b": 3}],
+                        },
+                    ],
+                },
+            }
+
+            # Execute the call
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+
+            assert worker.send.call_args[0][2]['status'] == 'completed'
+            results = worker.send.call_args[0][2]['data']
+            assert [r['subcommand'] for r in results] == [
+                'CreateTable', 'AddTableColumns', 'Insert']
+            assert results[2]['result'] == '2 Insert statements done'
+            # Every step ran on the one connection
+            assert worker._checked_out() == []
+
+            _, engine, conn = worker._db_connect('testdb')
+            result = engine.execute(
+                'SELECT COUNT(*) from ' + table_name + ';').fetchall()[0][0]
+            assert result == 2
+
+    def test_batch_rolls_back(self):
+        """
+        Verify a failing step rolls back the earlier steps.
+        """
+        table_name = 'test_batch_rolls_back'
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.sqlworker.SQLWorker.notify'),
+                mock.patch('replugin.sqlworker.SQLWorker.send')):
+
+            worker = sqlworker.SQLWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file='conf/example.json')
+
+            _, engine, conn = worker._db_connect('testdb')
+            self._create_dummy_db(conn, table_name)
+
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+
+            body = {
+                "parameters": {
+                    "command": "sql",
+                    "subcommand": "Batch",
+                    "database": "testdb",
+                    "steps": [
+                        {
+                            "subcommand": "Insert",
+                            "name": table_name,
+                            "rows": [{"a": 1, "b": 2}],
+                        },
+                        {
+                            "subcommand": "ExecuteSQL",
+                            "sql": "INSERT INTO doesnotexist VALUES (1)",
+                        },
+                    ],
+                },
+            }
+
+            # Execute the call
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+
+            assert self.app_logger.error.call_count == 1
+            assert worker.send.call_args[0][2]['status'] == 'failed'
+            result = engine.execute(
+                'SELECT COUNT(*) from ' + table_name + ';').fetchall()[0][0]
+            assert result == 0
+            # Nothing the steps cached survives the rollback
+            assert worker._schema.invalidated_at('testdb') > 0
+            assert ('testdb', table_name) not in worker._schema._tables
+
+    def test_delete_with_predicates(self):
+        """
+        Verify deleting with IN lists, operators and OR groups works.
+        """
+        table_name = 'test_delete_with_predicates'
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.sqlworker.SQLWorker.notify'),
+                mock.patch('replugin.sqlworker.SQLWorker.send')):
+
+            worker = sqlworker.SQLWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file='conf/example.json')
+
+            _, engine, conn = worker._db_connect('testdb')
+            self._create_dummy_db(conn, table_name)
+            for i in range(10):
+                conn.execute(
+                    'INSERT INTO ' + table_name + ' VALUES (%s, %s);' % (
+                        i, i % 2))
+
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+
+            body = {
+                "parameters": {
+                    "command": "sql",
+                    "subcommand": "Delete",
+                    "database": "testdb",
+                    "name": table_name,
+                    "where": [
+                        {"a": {"lt": 2}},
+                        {"a": [5, 6]},
+                        {"a": {"between": [8, 9]}, "b": 1},
+                    ],
+                },
+            }
+
+            # Execute the call
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+
+            remaining = [r[0] for r in engine.execute(
+                'SELECT a from ' + table_name + ' ORDER BY a;').fetchall()]
+            assert remaining == [2, 3, 4, 7, 8]
+
+    def test_delete_bad_column(self):
+        """
+        Verify deleting fails when the where names an unknown column.
+        """
+        table_name = 'test_delete_bad_column'
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.sqlworker.SQLWorker.notify'),
+                mock.patch('replugin.sqlworker.SQLWorker.send')):
+
+            worker = sqlworker.SQLWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file='conf/example.json')
+
+            _, engine, conn = worker._db_connect('testdb')
+            self._create_dummy_db(conn, table_name)
+
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+
+            body = {
+                "parameters": {
+                    "command": "sql",
+                    "subcommand": "Delete",
+                    "database": "testdb",
+                    "name": table_name,
+                    "where": {"c": 1},
+                },
+            }
+
+            # Execute the call
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+
+            assert self.app_logger.error.call_count == 1
+            assert worker.send.call_args[0][2]['status'] == 'failed'
+
+            # An empty list of OR groups deletes nothing
+            conn.execute('INSERT INTO ' + table_name + ' VALUES (1, 2);')
+            body['parameters']['where'] = []
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+            assert worker.send.call_args[0][2]['status'] == 'failed'
+            assert engine.execute(
+                'SELECT COUNT(*) FROM ' + table_name).scalar() == 1
+
+    def test_delete_chunked(self):
+        """
+        Verify chunked deletes remove every matching row.
+        """
+        table_name = 'test_delete_chunked'
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.sqlworker.SQLWorker.notify'),
+                mock.patch('replugin.sqlworker.SQLWorker.send')):
+
+            worker = sqlworker.SQLWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file='conf/example.json')
+
+            _, engine, conn = worker._db_connect('testdb')
+            conn.execute(
+                'CREATE TABLE ' + table_name +
+                ' (id INTEGER PRIMARY KEY, b INTEGER);')
+            for i in range(10):
+                conn.execute(
+                    'INSERT INTO ' + table_name + ' VALUES (%s, %s);' % (
+                        i, i % 2))
+
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+
+            body = {
+                "parameters": {
+                    "command": "sql",
+                    "subcommand": "Delete",
+                    "database": "testdb",
+                    "name": table_name,
+                    "where": {"b": 0},
+                    "chunk_size": 2,
+                },
+            }
+
+            # Execute the call
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+
+            result = engine.execute(
+                'SELECT COUNT(*) from ' + table_name + ';').fetchall()[0][0]
+            assert result == 5
+            assert worker.send.call_args[0][2]['data'] == (
+                'Deleted 5 rows in %s.' % table_name)
+            # Two rows per chunk means three chunks
+            assert self.logger.info.call_count == 4
+
+    def test_metrics(self):
+        """
+        Verify processing records phase timings and counters.
+        """
+        table_name = 'test_metrics'
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.sqlworker.SQLWorker.notify'),
+                mock.patch('replugin.sqlworker.SQLWorker.send')):
+
+            worker = sqlworker.SQLWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file='conf/example.json')
+
+            _, engine, conn = worker._db_connect('testdb')
+            self._create_dummy_db(conn, table_name)
+
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+
+            body = {
+                "parameters": {
+                    "command": "sql",
+                    "subcommand": "Insert",
+                    "database": "testdb",
+                    "name": table_name,
+                    "rows": [{"a": 1, "b": 2}, {"a": 3, "b": 4}],
+                },
+            }
+
+            # Execute the call
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+
+            text = worker._metrics.render()
+            labels = 'database="testdb",phase="%s",subcommand="Insert"'
+            for phase in ('connect', 'reflect', 'execute', 'process'):
+                assert ('sqlworker_phase_seconds_count{%s} ' % (
+                    labels % phase)) in text
+            assert ('sqlworker_rows_total{database="testdb",'
+                    'subcommand="Insert"} 2') in text
+            assert ('sqlworker_messages_total{database="testdb",'
+                    'status="completed",subcommand="Insert"} 1') in text
+
+    def test_metrics_http(self):
+        """
+        Verify metrics are served over HTTP.
+        """
+        import urllib2
+        from replugin.sqlworker.metrics import Metrics
+
+        metrics = Metrics()
+        metrics.incr('sqlworker_errors_total', database='testdb')
+        server = metrics.serve('127.0.0.1', 0)
+        try:
+            text = urllib2.urlopen(
+                'http://127.0.0.1:%s/metrics' % server.server_port).read()
+        finally:
+            server.shutdown()
+        assert 'sqlworker_errors_total{database="testdb"} 1' in text
+
+    def test_statement_cache(self):
+        """
+        Verify compiled statements are reused and dropped on DDL.
+        """
+        table_name = 'test_statement_cache'
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.sqlworker.SQLWorker.notify'),
+                mock.patch('replugin.sqlworker.SQLWorker.send')):
+
+            worker = sqlworker.SQLWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file='conf/example.json')
+
+            _, engine, conn = worker._db_connect('testdb')
+            self._create_dummy_db(conn, table_name)
+
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+
+            for a in (1, 2, 3):
+                body = {
+                    "parameters": {
+                        "command": "sql",
+                        "subcommand": "Insert",
+                        "database": "testdb",
+                        "name": table_name,
+                        "rows": [{"a": a, "b": a}],
+                    },
+                }
+                worker.process(
+                    self.channel,
+                    self.basic_deliver,
+                    self.properties,
+                    body,
+                    self.logger)
+            for a in (1, 2):
+                body = {
+                    "parameters": {
+                        "command": "sql",
+                        "subcommand": "Delete",
+                        "database": "testdb",
+                        "name": table_name,
+                        "where": {"a": [a, 10]},
+                    },
+                }
+                worker.process(
+                    self.channel,
+                    self.basic_deliver,
+                    self.properties,
+                    body,
+                    self.logger)
+
+            remaining = [r[0] for r in engine.execute(
+                'SELECT a from ' + table_name + ';').fetchall()]
+            assert remaining == [3]
+            # One insert and one delete shape
+            assert len(worker._statements) == 2
+
+            body = {
+                "parameters": {
+                    "command": "sql",
+                    "subcommand": "AddTableColumns",
+                    "database": "testdb",
+                    "name": table_name,
+                    "columns": {"c": {"type": "Integer"}},
+                },
+            }
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+            assert len(worker._statements) == 0
+
+    def test_build_where_shape(self):
+        """
+        Verify wheres of the same shape give the same SQL and shape.
+        """
+        table = sqlalchemy.Table(
+            'shape', sqlalchemy.MetaData(),
+            sqlalchemy.Column('a', sqlalchemy.Integer),
+            sqlalchemy.Column('b', sqlalchemy.Integer))
+        from replugin.sqlworker.predicates import build_where
+
+        clause1, params1, shape1 = build_where(
+            table, [{'a': 1}, {'b': {'gt': 2, 'in': [3, 4]}}])
+        clause2, params2, shape2 = build_where(
+            table, [{'a': 5}, {'b': {'gt': 6, 'in': [7, 8]}}])
+        assert shape1 == shape2
+        assert str(clause1) == str(clause2)
+        assert params1 != params2
+        assert build_where(table, [{'a': [1, 2]}])[2] != shape1
+        self.assertRaises(ValueError, build_where, table, {'c': 1})
+        self.assertRaises(ValueError, build_where, table, [])
+        assert build_where(table, {}) == (None, {}, None)
+        self.assertRaises(ValueError, build_where, table, {'a': {'x': 1}})
+
+    def test_alter_table_columns_batch(self):
+        """
+        Verify SQLite columns are altered with one batch table copy.
+        """
+        table_name = 'test_alter_table_columns_batch'
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.sqlworker.SQLWorker.notify'),
+                mock.patch('replugin.sqlworker.SQLWorker.send')):
+
+            worker = sqlworker.SQLWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file='conf/example.json')
+
+            _, engine, conn = worker._db_connect('testdb')
+            self._create_dummy_db(conn, table_name)
+            conn.execute('INSERT INTO ' + table_name + ' VALUES (1, 2);')
+
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+
+            body = {
+                "parameters": {
+                    "command": "sql",
+                    "subcommand": "AlterTableColumns",
+                    "database": "testdb",
+                    "name": table_name,
+                    "columns": {
+                        "a": {"type": "String", "length": 255},
+                        "b": {"type": "String", "length": 10},
+                    },
+                },
+            }
+            columns = dict(body['parameters']['columns'])
+
+            # Execute the call
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+
+            assert worker.send.call_args[0][2]['status'] == 'completed'
+            # The spec given is left untouched
+            assert body['parameters']['columns'] == columns
+            table = worker._schema.get_table('testdb', table_name, conn)
+            assert isinstance(table.c.a.type, sqlalchemy.String)
+            assert table.c.b.type.length == 10
+            assert engine.execute(
+                'SELECT a, b FROM ' + table_name).fetchall() == [
+                    ('1', '2')]
+
+    def test_render_statements_multi_clause(self):
+        """
+        Verify column changes are combined into one ALTER TABLE.
+        """
+        from sqlalchemy.dialects import mysql, postgresql
+        from replugin.sqlworker.ddl import render_statements
+
+        changes = [
+            ('add', sqlalchemy.Column('c', sqlalchemy.Integer)),
+            ('alter', 'a', {'type_': sqlalchemy.String(10)}),
+            ('drop', 'b'),
+        ]
+        statements = render_statements(
+            postgresql.dialect(), 'multi', changes)
+        assert statements == [
+            'ALTER TABLE multi ADD COLUMN c INTEGER, '
+            'ALTER COLUMN a TYPE VARCHAR(10), DROP COLUMN b']
+        statements = render_statements(
+            mysql.dialect(), 'multi',
+            [('add', sqlalchemy.Column('c', sqlalchemy.Integer)),
+             ('drop', 'b')])
+        assert statements == [
+            'ALTER TABLE multi ADD COLUMN c INTEGER, DROP COLUMN b']
+
+    def test_online_change(self):
+        """
+        Verify the pieces of online column changes.
+        """
+        from sqlalchemy.dialects import mysql, postgresql
+        from replugin.sqlworker.online import (
+            OnlineChange, Throttle, trigger_statements)
+
+        # Writes are copied by triggers on both databases
+        statements = trigger_statements(
+            mysql.dialect(), 't', '_t_new', ['id', 'a'], 'id')
+        assert len(statements) == 3
+        assert statements[0].startswith(
+            'CREATE TRIGGER t_osc_ins AFTER INSERT ON t FOR EACH ROW')
+        assert 'REPLACE INTO _t_new (id, a) VALUES (NEW.id, NEW.a)' in (
+            statements[1])
+        statements = trigger_statements(
+            postgresql.dialect(), 't', '_t_new', ['id', 'a'], 'id')
+        assert 'DELETE FROM _t_new WHERE id = OLD.id' in statements[0]
+        # Rows being copied are overwritten rather than failing the write
+        assert (
+            'INSERT INTO _t_new (id, a) VALUES (NEW.id, NEW.a) '
+            'ON CONFLICT (id) DO UPDATE SET a = EXCLUDED.a;') in (
+                statements[0])
+        assert 'ON CONFLICT (id) DO NOTHING;' in trigger_statements(
+            postgresql.dialect(), 't', '_t_new', ['id'], 'id')[0]
+        assert statements[1].endswith('EXECUTE PROCEDURE t_osc()')
+
+        # Chunks grow or shrink towards chunk_time and wait out lag
+        sleeps = []
+        lags = [10, 10, 1]
+        throttle = Throttle(
+            100, chunk_time=1, max_lag=5, lag=lambda: lags.pop(0),
+            sleep=sleeps.append)
+        throttle.after_chunk(100, 0.1)
+        assert throttle.chunk_size == 137
+        assert sleeps == [1, 2]
+        throttle = Throttle(1000, chunk_time=1, sleep=sleeps.append)
+        throttle.after_chunk(1000, 10)
+        assert throttle.chunk_size == 550
+
+        # Rows are copied by primary key, skipping those already there
+        engine = sqlalchemy.create_engine('sqlite://')
+        conn = engine.connect()
+        conn.execute('CREATE TABLE t (id INTEGER PRIMARY KEY, a INTEGER)')
+        conn.execute('CREATE TABLE _t_new (id INTEGER PRIMARY KEY, a INTEGER)')
+        for i in range(1, 6):
+            conn.execute('INSERT INTO t VALUES (?, ?)', (i, i))
+        conn.execute('INSERT INTO _t_new VALUES (2, 20)')
+        table = sqlalchemy.Table(
+            't', sqlalchemy.MetaData(), autoload=True, autoload_with=conn)
+        change = OnlineChange(
+            conn, table, [('drop', 'a')], Throttle(2, chunk_time=0),
+            self.logger)
+        assert change.columns == ['id']
+        change.columns = ['id', 'a']
+        assert change._copy() == 4
+        assert conn.execute('SELECT * FROM _t_new ORDER BY id').fetchall(
+            ) == [(1, 1), (2, 20), (3, 3), (4, 4), (5, 5)]
+        self.logger.info.assert_called_with(
+            'Copied 4 rows of t into _t_new (100%).')
+
+        conn.execute('CREATE TABLE nokey (a INTEGER)')
+        nokey = sqlalchemy.Table(
+            'nokey', sqlalchemy.MetaData(), autoload=True,
+            autoload_with=conn)
+        self.assertRaises(
+            ValueError, OnlineChange, conn, nokey, [], Throttle(),
+            self.logger)
+
+        # Foreign keys are not copied to the shadow table
+        conn.execute('CREATE TABLE parent (id INTEGER PRIMARY KEY)')
+        conn.execute(
+            'CREATE TABLE child (id INTEGER PRIMARY KEY, '
+            'parent_id INTEGER REFERENCES parent (id))')
+        metadata = sqlalchemy.MetaData()
+        for name in ('child', 'parent'):
+            table = sqlalchemy.Table(
+                name, metadata, autoload=True, autoload_with=conn)
+            self.assertRaises(
+                ValueError, OnlineChange, conn, table, [], Throttle(),
+                self.logger)
+
+    def test_online_change_sqlite(self):
+        """
+        Verify online changes fall back to batch mode on SQLite.
+        """
+        table_name = 'test_online_change_sqlite'
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.sqlworker.SQLWorker.notify'),
+                mock.patch('replugin.sqlworker.SQLWorker.send')):
+
+            worker = sqlworker.SQLWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file='conf/example.json')
+
+            _, engine, conn = worker._db_connect('testdb')
+            self._create_dummy_db(conn, table_name)
+
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+
+            body = {
+                "parameters": {
+                    "command": "sql",
+                    "subcommand": "AddTableColumns",
+                    "database": "testdb",
+                    "name": table_name,
+                    "columns": {"c": {"type": "Integer"}},
+                    "online": {"chunk_size": 10},
+                },
+            }
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+
+            assert worker.send.call_args[0][2]['status'] == 'completed'
+            self.logger.info.assert_any_call(
+                'No online mode for sqlite, copying %s in batch mode.' % (
+                    table_name))
+
+    def test_bulk_load_csv(self):
+        """
+        Verify a local CSV file is loaded in chunks in one transaction.
+        """
+        table_name = 'test_bulk_load_csv'
+        directory = tempfile.mkdtemp()
+        with open(os.path.join(directory, 'rows.csv'), 'wb') as csv_file:
+            csv_file.write('b,a\n2,1\n4,3\n,5\n')
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.sqlworker.SQLWorker.notify'),
+                mock.patch('replugin.sqlworker.SQLWorker.send')):
+
+            worker = sqlworker.SQLWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file='conf/example.json')
+            worker._config['bulk_load'] = {'directory': directory}
+
+            _, engine, conn = worker._db_connect('testdb')
+            self._create_dummy_db(conn, table_name)
+
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+
+            body = {
+                "parameters": {
+                    "command": "sql",
+                    "subcommand": "BulkLoad",
+                    "database": "testdb",
+                    "name": table_name,
+                    "path": "rows.csv",
+                    "chunk_size": 2,
+                },
+            }
+
+            # Execute the call
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+
+            assert worker.send.call_args[0][2]['data'] == (
+                'Loaded 3 rows into %s.' % table_name)
+            assert engine.execute(
+                'SELECT a, b FROM ' + table_name + ' ORDER BY a').fetchall(
+                    ) == [(1, 2), (3, 4), (5, None)]
+
+            # Given columns still skip the header line
+            engine.execute('DELETE FROM ' + table_name)
+            body['parameters']['columns'] = ['a', 'b']
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+            assert engine.execute(
+                'SELECT a, b FROM ' + table_name + ' ORDER BY a').fetchall(
+                    ) == [(None, 5), (2, 1), (4, 3)]
+            del body['parameters']['columns']
+
+            # Files outside the configured directory are refused
+            body['parameters']['path'] = '../rows.csv'
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+            assert worker.send.call_args[0][2]['status'] == 'failed'
+        shutil.rmtree(directory)
+
+    def test_bulk_load_chunks(self):
+        """
+        Verify newline delimited JSON sent in chunks is loaded on the
+        final chunk and the spooled chunks are removed.
+        """
+        table_name = 'test_bulk_load_chunks'
+        spool_dir = tempfile.mkdtemp()
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.sqlworker.SQLWorker.notify'),
+                mock.patch('replugin.sqlworker.SQLWorker.send')):
+
+            worker = sqlworker.SQLWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file='conf/example.json')
+            worker._config['bulk_load'] = {'spool_dir': spool_dir}
+
+            _, engine, conn = worker._db_connect('testdb')
+            self._create_dummy_db(conn, table_name)
+
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+
+            chunks = ['{"a": 1, "b": 2}\n{"a": 3,', ' "b": 4}\n', '{"a": 5}']
+            for sequence, data in enumerate(chunks):
+                body = {
+                    "parameters": {
+                        "command": "sql",
+                        "subcommand": "BulkLoad",
+                        "database": "testdb",
+                        "name": table_name,
+                        "format": "ndjson",
+                        "load_id": "load-1",
+                        "sequence": sequence,
+                        "data": data,
+                        "final": sequence == len(chunks) - 1,
+                    },
+                }
+                worker.process(
+                    self.channel,
+                    self.basic_deliver,
+                    self.properties,
+                    body,
+                    self.logger)
+                assert worker.send.call_args[0][2]['status'] == 'completed'
+
+            assert worker.send.call_args[0][2]['data'] == (
+                'Loaded 3 rows into %s.' % table_name)
+            assert engine.execute(
+                'SELECT a, b FROM ' + table_name + ' ORDER BY a').fetchall(
+                    ) == [(1, 2), (3, 4), (5, None)]
+            assert os.listdir(spool_dir) == []
+
+            # A final chunk with chunks missing removes what was spooled
+            for sequence in (0, 2):
+                body['parameters'].update({
+                    'load_id': 'load-2',
+                    'sequence': sequence,
+                    'final': sequence == 2})
+                worker.process(
+                    self.channel,
+                    self.basic_deliver,
+                    self.properties,
+                    body,
+                    self.logger)
+            assert worker.send.call_args[0][2]['status'] == 'failed'
+            assert os.listdir(spool_dir) == []
+        shutil.rmtree(spool_dir)
+
+    def test_bulk_load_streams(self):
+        """
+        Verify the bulk load readers produce the CSV COPY expects.
+        """
+        from replugin.sqlworker import bulkload
+
+        rows = bulkload.iter_ndjson(iter(['{"a": 1, "b": "x\\"y"}\n', '\n']))
+        stream = bulkload.CSVStream(rows, ['a', 'b', 'c'])
+        assert stream.read(4) == '"1",'
+        assert stream.read() == '"x""y",\n'
+        assert stream.read() == ''
+
+    def test_ensure_table(self):
+        """
+        Verify EnsureTable creates a table then only changes what differs.
+        """
+        table_name = 'test_ensure'
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.sqlworker.SQLWorker.notify'),
+                mock.patch('replugin.sqlworker.SQLWorker.send')):
+
+            worker = sqlworker.SQLWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file='conf/example.json')
+
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+
+            columns = {
+                "id": {"type": "Integer", "primary_key": True},
+                "name": {"type": "String", "length": 32},
+                "old": {"type": "Integer"},
+            }
+            body = {
+                "parameters": {
+                    "command": "sql",
+                    "subcommand": "EnsureTable",
+                    "database": "testdb",
+                    "name": table_name,
+                    "columns": columns,
+                },
+            }
+
+            def ensure():
+                worker.process(
+                    self.channel,
+                    self.basic_deliver,
+                    self.properties,
+                    body,
+                    self.logger)
+                return worker.send.call_args[0][2]
+
+            assert ensure()['data'] == 'Table created'
+            assert ensure()['data'] == 'Table already matches'
+
+            # Only the new column and the changed type are sent
+            columns['name'] = {"type": "String", "length": 64}
+            columns['added'] = {"type": "Integer", "nullable": False,
+                                "server_default": "0"}
+            assert ensure()['data'] == '2 column change(s) applied'
+            assert ensure()['data'] == 'Table already matches'
+
+            table = sqlalchemy.Table(
+                table_name, sqlalchemy.MetaData(), autoload=True,
+                autoload_with=worker._engines.get('testdb'))
+            assert sorted(table.c.keys()) == ['added', 'id', 'name', 'old']
+            assert table.c.name.type.length == 64
+            assert table.c.added.nullable is False
+
+            # Extra columns go only when asked to
+            del columns['old']
+            assert ensure()['data'] == 'Table already matches'
+            body['parameters']['drop_columns'] = True
+            assert ensure()['data'] == '1 column change(s) applied'
+
+            body['parameters']['columns'] = {"x": {"type": "NoSuchType"}}
+            assert ensure()['status'] == 'failed'
+
+    def test_upsert(self):
+        """
+        Verify upserting updates existing rows and inserts new ones.
+        """
+        table_name = 'test_upsert'
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.sqlworker.SQLWorker.notify'),
+                mock.patch('replugin.sqlworker.SQLWorker.send')):
+
+            worker = sqlworker.SQLWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file='conf/example.json')
+
+            _, engine, conn = worker._db_connect('testdb')
+            conn.execute(
+                'CREATE TABLE ' + table_name +
+                ' (a INTEGER PRIMARY KEY, b INTEGER, c INTEGER);')
+            conn.execute('INSERT INTO ' + table_name + ' VALUES (1, 1, 1);')
+
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+
+            body = {
+                "parameters": {
+                    "command": "sql",
+                    "subcommand": "Upsert",
+                    "database": "testdb",
+                    "name": table_name,
+                    "keys": ["a"],
+                    "update": ["b"],
+                    "rows": [
+                        {"a": 1, "b": 10, "c": 10},
+                        {"a": 2, "b": 20, "c": 20},
+                    ],
+                },
+            }
+
+            # Running it twice must give the same rows
+            for _ in range(2):
+                worker.process(
+                    self.channel,
+                    self.basic_deliver,
+                    self.properties,
+                    body,
+                    self.logger)
+                assert worker.send.call_args[0][2]['data'] == (
+                    '2 Upsert statements done')
+
+            assert engine.execute(
+                'SELECT a, b, c FROM ' + table_name + ' ORDER BY a').fetchall(
+                    ) == [(1, 10, 1), (2, 20, 20)]
+
+            # Rows must carry the key columns
+            body['parameters']['rows'] = [{"b": 1}]
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+            assert worker.send.call_args[0][2]['status'] == 'failed'
+
+    def test_upsert_dialects(self):
+        """
+        Verify the conflict clause rendered for each dialect.
+        """
+        from sqlalchemy.dialects import mysql, postgresql
+        from replugin.sqlworker.upsert import Upsert
+
+        table = sqlalchemy.Table(
+            'hosts', sqlalchemy.MetaData(),
+            sqlalchemy.Column('a', sqlalchemy.Integer, primary_key=True),
+            sqlalchemy.Column('b', sqlalchemy.Integer))
+        assert str(Upsert(table, ['a'], ['b']).compile(
+            dialect=postgresql.dialect(), column_keys=['a', 'b'])) == (
+                'INSERT INTO hosts (a, b) VALUES (%(a)s, %(b)s) '
+                'ON CONFLICT (a) DO UPDATE SET b = excluded.b')
+        assert str(Upsert(table, ['a'], []).compile(
+            dialect=postgresql.dialect(), column_keys=['a'])) == (
+                'INSERT INTO hosts (a) VALUES (%(a)s) '
+                'ON CONFLICT (a) DO NOTHING')
+        assert str(Upsert(table, ['a'], ['b']).compile(
+            dialect=mysql.dialect(), column_keys=['a', 'b'])) == (
+                'INSERT INTO hosts (a, b) VALUES (%s, %s) '
+                'ON DUPLICATE KEY UPDATE b = VALUES(b)')
+
+    def test_update(self):
+        """
+        Verify updates are batched and max_rows rolls them back.
+        """
+        table_name = 'test_update'
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.sqlworker.SQLWorker.notify'),
+                mock.patch('replugin.sqlworker.SQLWorker.send')):
+
+            worker = sqlworker.SQLWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file='conf/example.json')
+
+            _, engine, conn = worker._db_connect('testdb')
+            self._create_dummy_db(conn, table_name)
+            for a in range(1, 5):
+                conn.execute(
+                    'INSERT INTO ' + table_name + ' VALUES (%s, 0);' % a)
+
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+
+            body = {
+                "parameters": {
+                    "command": "sql",
+                    "subcommand": "Update",
+                    "database": "testdb",
+                    "name": table_name,
+                    "updates": [
+                        {"values": {"b": 1}, "where": {"a": 1}},
+                        {"values": {"b": 2}, "where": {"a": 2}},
+                        {"values": {"b": 3}, "where": {"a": [3, 4]}},
+                    ],
+                },
+            }
+
+            with mock.patch.object(
+                    worker, '_build_update',
+                    side_effect=worker._build_update) as build_update:
+                worker.process(
+                    self.channel,
+                    self.basic_deliver,
+                    self.properties,
+                    body,
+                    self.logger)
+                # One statement per shape
+                assert build_update.call_count == 2
+
+            assert worker.send.call_args[0][2]['data'] == (
+                'Updated 4 rows in %s.' % table_name)
+            assert engine.execute(
+                'SELECT a, b FROM ' + table_name + ' ORDER BY a').fetchall(
+                    ) == [(1, 1), (2, 2), (3, 3), (4, 3)]
+
+            body['parameters']['updates'] = [
+                {"values": {"b": 9}, "where": {"a": {"gt": 1}}}]
+            body['parameters']['max_rows'] = 2
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+            assert worker.send.call_args[0][2]['status'] == 'failed'
+            assert engine.execute(
+                'SELECT COUNT(*) FROM ' + table_name +
+                ' WHERE b = 9').fetchall()[0][0] == 0
+
+            # Every row is only updated when asked for explicitly
+            del body['parameters']['max_rows']
+            for where in ({"values": {"b": 9}}, {"values": {"b": 9},
+                                                  "where": {}}):
+                body['parameters']['updates'] = [where]
+                worker.process(
+                    self.channel,
+                    self.basic_deliver,
+                    self.properties,
+                    body,
+                    self.logger)
+                assert worker.send.call_args[0][2]['status'] == 'failed'
+            assert engine.execute(
+                'SELECT COUNT(*) FROM ' + table_name +
+                ' WHERE b = 9').fetchall()[0][0] == 0
+            body['parameters']['all_rows'] = True
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+            assert worker.send.call_args[0][2]['data'] == (
+                'Updated 4 rows in %s.' % table_name)
+
+    def test_execute_sql_params_and_script(self):
+        """
+        Verify bound values, executemany and multi statement scripts.
+        """
+        table_name = 'test_execute_sql_params'
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.sqlworker.SQLWorker.notify'),
+                mock.patch('replugin.sqlworker.SQLWorker.send')):
+
+            worker = sqlworker.SQLWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file='conf/example.json')
+
+            _, engine, conn = worker._db_connect('testdb')
+            self._create_dummy_db(conn, table_name)
+
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+
+            body = {
+                "parameters": {
+                    "command": "sql",
+                    "subcommand": "ExecuteSQL",
+                    "database": "testdb",
+                    "sql": "INSERT INTO " + table_name + " VALUES (:a, :b)",
+                    "params": [{"a": 1, "b": 2}, {"a": 3, "b": 4}],
+                },
+            }
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+            assert worker.send.call_args[0][2]['data'] == (
+                'SQL executed. 2 rows effected')
+
+            body['parameters']['sql'] = [
+                {"sql": "UPDATE " + table_name + " SET b = :b WHERE a = :a",
+                 "params": {"a": 1, "b": 20}},
+                "DELETE FROM " + table_name + " WHERE a = 3",
+            ]
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+            assert worker.send.call_args[0][2]['data'] == [
+                'SQL executed. 1 rows effected',
+                'SQL executed. 1 rows effected']
+            assert engine.execute(
+                'SELECT a, b FROM ' + table_name).fetchall() == [(1, 20)]
+
+            # A failing statement rolls back the ones before it
+            body['parameters']['sql'] = [
+                "DELETE FROM " + table_name,
+                "INSERT INTO missing_table VALUES (1)",
+            ]
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+            assert worker.send.call_args[0][2]['status'] == 'failed'
+            assert engine.execute(
+                'SELECT a, b FROM ' + table_name).fetchall() == [(1, 20)]
+
+    def test_subcommand_registry(self):
+        """
+        Verify subcommands come from the registry, including plugins.
+        """
+        from replugin.sqlworker.registry import subcommand
+
+        @subcommand('Ping', read_only=True, cost='cheap')
+        def ping(worker, body, corr_id, output):
+            return 'pong'
+
+        entry_point = mock.MagicMock()
+        entry_point.name = 'Ping'
+        entry_point.load.return_value = ping
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('pkg_resources.iter_entry_points',
+                           return_value=[entry_point]),
+                mock.patch('replugin.sqlworker.SQLWorker.notify'),
+                mock.patch('replugin.sqlworker.SQLWorker.send')):
+
+            worker = sqlworker.SQLWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file='conf/example.json')
+
+            assert 'Insert' in worker.subcommands
+            assert 'Ping' in worker.subcommands
+            assert worker._find_subcommand('Insert') == worker.insert
+            info = worker._registry.info('Ping')
+            assert info.is_read_only({}) and info.cost == 'cheap'
+
+            execute_sql = worker._registry.info('ExecuteSQL')
+            assert execute_sql.is_read_only({'sql': ' select 1'})
+            assert not execute_sql.is_read_only(
+                {'sql': ['SELECT 1', {'sql': 'DELETE FROM t'}]})
+            assert worker._registry.info('DropTable').cost == 'expensive'
+
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                {"parameters": {"subcommand": "Ping"}},
+                self.logger)
+            assert worker.send.call_args[0][2]['data'] == 'pong'
+
+    def test_replica_routing(self):
+        """
+        Verify reads and reflection use a replica and writes do not.
+        """
+        table_name = 'test_replica_routing'
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.sqlworker.SQLWorker.notify'),
+                mock.patch('replugin.sqlworker.SQLWorker.send')):
+
+            worker = sqlworker.SQLWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file='conf/example.json')
+            worker._config['databases']['testdb']['replicas'] = [
+                'sqlite:///test_replica.db']
+
+            _, engine, conn = worker._db_connect('testdb')
+            self._create_dummy_db(conn, table_name)
+            replica = sqlalchemy.create_engine('sqlite:///test_replica.db')
+            self._create_dummy_db(replica, table_name)
+            replica.execute('INSERT INTO ' + table_name + ' VALUES (7, 7)')
+
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+
+            body = {
+                "parameters": {
+                    "command": "sql",
+                    "subcommand": "ExecuteSQL",
+                    "database": "testdb",
+                    "sql": "SELECT a, b FROM " + table_name,
+                    "stream": True,
+                },
+            }
+            try:
+                worker.process(
+                    self.channel,
+                    self.basic_deliver,
+                    self.properties,
+                    body,
+                    self.logger)
+                pages = [c[0][2] for c in worker.send.call_args_list
+                         if c[0][2].get('status') == 'results']
+                assert pages[0]['rows'] == [[7, 7]]
+
+                # Writes stay on the primary
+                worker.insert({"parameters": {
+                    "database": "testdb", "name": table_name,
+                    "rows": [{"a": 1, "b": 1}]}}, '1', self.logger)
+                assert engine.execute(
+                    'SELECT a FROM ' + table_name).fetchall() == [(1, )]
+
+                # A lagging replica is skipped
+                worker._config['databases']['testdb'].update({
+                    'replica_lag_sql': 'SELECT 100', 'replica_max_lag': 30})
+                worker._engines.dispose()
+                worker.send.reset_mock()
+                worker.process(
+                    self.channel,
+                    self.basic_deliver,
+                    self.properties,
+                    body,
+                    self.logger)
+                pages = [c[0][2] for c in worker.send.call_args_list
+                         if c[0][2].get('status') == 'results']
+                assert pages[0]['rows'] == [[1, 1]]
+            finally:
+                os.remove('test_replica.db')
+
+    def test_profile_message(self):
+        """
+        Verify a message asking to be profiled writes a report.
+        """
+        from replugin.sqlworker.profiling import Profiler
+
+        table_name = 'test_profile_message'
+        directory = tempfile.mkdtemp()
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.sqlworker.SQLWorker.notify'),
+                mock.patch('replugin.sqlworker.SQLWorker.send')):
+
+            worker = sqlworker.SQLWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file='conf/example.json')
+            worker._profiler.directory = directory
+
+            _, engine, conn = worker._db_connect('testdb')
+            self._create_dummy_db(conn, table_name)
+
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+
+            body = {
+                "parameters": {
+                    "command": "sql",
+                    "subcommand": "Insert",
+                    "database": "testdb",
+                    "name": table_name,
+                    "rows": [{"a": 1, "b": 2}],
+                    "profile": True,
+                },
+            }
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+
+            assert worker.send.call_args[0][2]['status'] == 'completed'
+            names = sorted(os.listdir(directory))
+            assert len(names) == 2
+            assert names[0].startswith('123-') and names[0].endswith('.prof')
+            with open(os.path.join(directory, names[1])) as report:
+                text = report.read()
+            assert 'INSERT INTO ' + table_name in text
+            assert '_handle_message' in text
+        shutil.rmtree(directory)
+
+        profiler = Profiler(sample_every=2)
+        assert [profiler.wanted({}) for i in range(4)] == [
+            False, True, False, True]